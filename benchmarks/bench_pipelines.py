@@ -0,0 +1,294 @@
+"""
+Throughput benchmark for the on_message pipelines.
+
+Generates synthetic ESPHome ``devices/...`` readings and zigbee2mqtt JSON
+payloads and feeds them straight into the on_message callbacks of to_delta,
+zigbee_to_delta and raw_to_delta, flushing to a local spool and Delta path
+as the ingesters would. Each pipeline runs in its own process so peak RSS
+is comparable.
+
+    python benchmarks/bench_pipelines.py --pipeline all --devices 50 --messages 200000
+    python benchmarks/bench_pipelines.py --pipeline raw_to_delta --rate 5000 --json
+"""
+import argparse
+import contextlib
+import json
+import logging
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from array import array
+from itertools import islice
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "mqtt_to_stuff"))
+
+import paho.mqtt.client as mqtt
+
+from devices import MonitoringPlug, MultiPresenceDetector, PresenceDetector
+
+PIPELINES = ["to_delta", "zigbee_to_delta", "raw_to_delta"]
+
+ESPHOME_KINDS = [
+    ("plug", MonitoringPlug),
+    ("multi-presence", MultiPresenceDetector),
+    ("presence", PresenceDetector),
+]
+
+ZIGBEE_MODELS = [
+    ("TS0201", lambda rng: {
+        "temperature": round(rng.uniform(15, 25), 1),
+        "humidity": round(rng.uniform(30, 60), 1),
+        "battery": rng.randint(50, 100),
+        "voltage": rng.randint(2800, 3100),
+        "linkquality": rng.randint(0, 255),
+    }),
+    ("TRADFRI bulb GU10 WW 345lm", lambda rng: {
+        "state": rng.choice(["ON", "OFF"]),
+        "brightness": rng.randint(0, 254),
+        "linkquality": rng.randint(0, 255),
+    }),
+    ("TS0203", lambda rng: {
+        "battery": rng.randint(50, 100),
+        "battery_low": False,
+        "contact": rng.random() < 0.5,
+        "linkquality": rng.randint(0, 255),
+        "tamper": False,
+        "voltage": rng.randint(2800, 3100),
+    }),
+    ("VINDSTYRKA", lambda rng: {
+        "humidity": rng.randint(30, 60),
+        "temperature": round(rng.uniform(15, 25), 1),
+        "pm25": rng.randint(0, 50),
+        "voc_index": rng.randint(50, 150),
+        "linkquality": rng.randint(0, 255),
+    }),
+]
+
+
+def message(topic, payload, retain=False):
+    msg = mqtt.MQTTMessage(topic=topic.encode("utf-8"))
+    msg.payload = payload.encode("utf-8")
+    msg.retain = retain
+    return msg
+
+
+def esphome_value(key, previous, rng):
+    if key[0] in ("binary_sensor", "switch"):
+        return "ON" if rng.random() < 0.5 else "OFF"
+    if key[1] == "uptime_sensor":
+        return str(int(previous or 0) + 60)
+    if key[1].endswith("_count"):
+        return str(rng.randint(0, 3))
+
+    return "%.2f" % (float(previous or rng.uniform(0, 500)) + rng.gauss(0, 2))
+
+
+def esphome_messages(devices, rng):
+    things = []
+    for i in range(devices):
+        kind, klass = ESPHOME_KINDS[i % len(ESPHOME_KINDS)]
+        prefix = "devices/home/area-%d/%s/thing-%d" % (i % 10, kind, i)
+        things.append((prefix, list(klass.sensors), {}))
+
+    while True:
+        prefix, keys, last = rng.choice(things)
+        key = rng.choice(keys)
+        last[key] = value = esphome_value(key, last.get(key), rng)
+        yield message(prefix + "/" + "/".join(key), value)
+
+
+def zigbee_device_definitions(devices):
+    return [
+        {
+            "type": "EndDevice",
+            "ieee_address": "0x%016x" % i,
+            "friendly_name": "area-%d/zigbee/thing-%d" % (i % 10, i),
+            "model_id": ZIGBEE_MODELS[i % len(ZIGBEE_MODELS)][0],
+            "manufacturer": "bench",
+        }
+        for i in range(devices)
+    ]
+
+
+def zigbee_messages(devices, rng):
+    definitions = zigbee_device_definitions(devices)
+
+    while True:
+        i = rng.randrange(devices)
+        payload = ZIGBEE_MODELS[i % len(ZIGBEE_MODELS)][1](rng)
+        yield message("zigbee2mqtt/" + definitions[i]["friendly_name"], json.dumps(payload))
+
+
+def mixed_messages(devices, rng):
+    esphome = esphome_messages(devices, rng)
+    zigbee = zigbee_messages(devices, rng)
+
+    while True:
+        yield next(esphome) if rng.random() < 0.5 else next(zigbee)
+
+
+def setup_to_delta(workdir, devices, rng):
+    import to_delta
+    from delta_client import DeltaLakeClient
+    from spool import Spool
+
+    spool = Spool(os.path.join(workdir, "spool"), DeltaLakeClient(os.path.join(workdir, "delta") + "/", {}))
+    register = to_delta.build_register()
+
+    return (
+        to_delta.generate_on_message(register),
+        None,
+        esphome_messages(devices, rng),
+        lambda: to_delta.write(register, spool),
+        lambda: to_delta.write(register, spool, final=True),
+        spool,
+    )
+
+
+def setup_zigbee_to_delta(workdir, devices, rng):
+    import zigbee_to_delta
+    from delta_client import DeltaLakeClient
+    from spool import Spool
+
+    dlc = DeltaLakeClient(os.path.join(workdir, "delta") + "/", {})
+    spool = Spool(os.path.join(workdir, "spool"), dlc)
+    zigbee_to_delta.ZDR.set_deltalakeclient(dlc)
+    zigbee_to_delta.ZDR.set_spool(spool)
+
+    bridge = message("zigbee2mqtt/bridge/devices", json.dumps(zigbee_device_definitions(devices)), retain=True)
+    zigbee_to_delta.on_message(None, None, bridge)
+
+    flush = lambda: zigbee_to_delta.ZDR.write_all_and_clear(dlc.uri(""))
+
+    return zigbee_to_delta.on_message, None, zigbee_messages(devices, rng), flush, flush, spool
+
+
+def setup_raw_to_delta(workdir, devices, rng):
+    import raw_to_delta
+    from delta_client import DeltaLakeClient
+    from spool import Spool
+    from topics import TopicTrie
+
+    spool = Spool(os.path.join(workdir, "spool"), DeltaLakeClient(os.path.join(workdir, "delta") + "/", {}))
+    raw_to_delta.buffer.set_limits(10 ** 9, 10 ** 12, 10 ** 12)
+
+    ignored = TopicTrie()
+    for pattern in ["zigbee2mqtt/bridge/#", "devices/+/+/+/+/sensor/wifi_signal_db/#", "homeassistant/#"]:
+        ignored.add(pattern)
+
+    flush = lambda: raw_to_delta.do_flush(spool)
+
+    return raw_to_delta.on_message, ignored, mixed_messages(devices, rng), flush, flush, spool
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else 0.0
+
+
+def run(pipeline, devices, messages, rate, flush_every, seed):
+    rng = random.Random(seed)
+    workdir = tempfile.mkdtemp(prefix="bench-" + pipeline + "-")
+
+    logging.disable(logging.INFO)
+
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        on_message, userdata, source, flush, final_flush, spool = globals()["setup_" + pipeline](workdir, devices, rng)
+
+        latencies = array("d")
+        flushes = array("d")
+        interval = 1 / rate if rate else 0
+        next_send = time.perf_counter()
+        started = time.perf_counter()
+
+        for i, msg in enumerate(islice(source, messages)):
+            if interval:
+                next_send += interval
+                if (delay := next_send - time.perf_counter()) > 0:
+                    time.sleep(delay)
+
+            t = time.perf_counter()
+            on_message(None, userdata, msg)
+            latencies.append(time.perf_counter() - t)
+
+            if (i + 1) % flush_every == 0:
+                t = time.perf_counter()
+                flush()
+                flushes.append(time.perf_counter() - t)
+
+        t = time.perf_counter()
+        final_flush()
+        flushes.append(time.perf_counter() - t)
+        elapsed = time.perf_counter() - started
+
+        t = time.perf_counter()
+        spool.drain()
+        upload = time.perf_counter() - t
+
+    return {
+        "pipeline": pipeline,
+        "devices": devices,
+        "messages": messages,
+        "msgs_per_sec": messages / sum(latencies),
+        "wall_msgs_per_sec": messages / elapsed,
+        "p50_callback_us": percentile(latencies, 0.50) * 1e6,
+        "p99_callback_us": percentile(latencies, 0.99) * 1e6,
+        "flushes": len(flushes),
+        "mean_flush_ms": sum(flushes) / len(flushes) * 1e3,
+        "max_flush_ms": max(flushes) * 1e3,
+        "upload_ms": upload * 1e3,
+        # ru_maxrss is in KiB on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def report(results):
+    columns = [
+        ("pipeline", "%-16s"), ("msgs_per_sec", "%12.0f"), ("wall_msgs_per_sec", "%17.0f"),
+        ("p50_callback_us", "%15.1f"), ("p99_callback_us", "%15.1f"), ("mean_flush_ms", "%13.1f"),
+        ("max_flush_ms", "%12.1f"), ("upload_ms", "%10.1f"), ("peak_rss_mb", "%11.1f"),
+    ]
+
+    print(" ".join(("%" + fmt[1:].split(".")[0].rstrip("sdf") + "s") % name for name, fmt in columns))
+    for result in results:
+        print(" ".join(fmt % result[name] for name, fmt in columns))
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description="Benchmark the on_message pipelines.")
+    parser.add_argument("--pipeline", choices=PIPELINES + ["all"], default="all")
+    parser.add_argument("--devices", type=int, default=50, help="Number of synthetic devices")
+    parser.add_argument("--messages", type=int, default=100_000, help="Messages to feed each pipeline")
+    parser.add_argument("--rate", type=float, default=0, help="Target messages per second, 0 for as fast as possible")
+    parser.add_argument("--flush-every", dest="flush_every", type=int, default=20_000, help="Flush after this many messages")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="Print results as JSON lines")
+
+    args = parser.parse_args(args)
+
+    if args.pipeline == "all":
+        results = []
+        for pipeline in PIPELINES:
+            command = [sys.executable, os.path.abspath(__file__), "--json", "--pipeline", pipeline]
+            command += ["--devices", str(args.devices), "--messages", str(args.messages), "--rate", str(args.rate)]
+            command += ["--flush-every", str(args.flush_every), "--seed", str(args.seed)]
+            output = subprocess.run(command, check=True, stdout=subprocess.PIPE, text=True).stdout
+            results.append(json.loads(output.strip().splitlines()[-1]))
+    else:
+        results = [run(args.pipeline, args.devices, args.messages, args.rate, args.flush_every, args.seed)]
+
+    if args.json:
+        for result in results:
+            print(json.dumps(result))
+    else:
+        report(results)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
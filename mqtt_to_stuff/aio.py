@@ -0,0 +1,171 @@
+import asyncio
+import logging
+
+import paho.mqtt.client as mqtt
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncioHelper:
+    """
+    Drives a paho client from an asyncio loop instead of loop_forever.
+
+    paho tells us when its socket opens and closes and when it has something
+    to write; reads and writes are then done by the loop's reader and writer
+    callbacks and keepalives by ``misc_loop``, so on_message runs on the loop
+    thread and nothing else competes with it for the socket. Reading can be
+    paused, which is how the loop pushes back on the broker.
+    """
+
+    def __init__(self, loop, client):
+        self.loop = loop
+        self.client = client
+        self.client.on_socket_open = self.on_socket_open
+        self.client.on_socket_close = self.on_socket_close
+        self.client.on_socket_register_write = self.on_socket_register_write
+        self.client.on_socket_unregister_write = self.on_socket_unregister_write
+        self.misc = None
+        self.sock = None
+        self.paused = False
+
+    def on_socket_open(self, client, userdata, sock):
+        self.sock = sock
+        if not self.paused:
+            self.loop.add_reader(sock, client.loop_read)
+        self.misc = self.loop.create_task(self.misc_loop())
+
+    def on_socket_close(self, client, userdata, sock):
+        self.loop.remove_reader(sock)
+        self.sock = None
+        if self.misc is not None:
+            self.misc.cancel()
+
+    def pause_reading(self):
+        if not self.paused:
+            self.paused = True
+            if self.sock is not None:
+                self.loop.remove_reader(self.sock)
+
+    def resume_reading(self):
+        if self.paused:
+            self.paused = False
+            if self.sock is not None:
+                self.loop.add_reader(self.sock, self.client.loop_read)
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self.loop.add_writer(sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.loop.remove_writer(sock)
+
+    async def misc_loop(self):
+        while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            await asyncio.sleep(1)
+
+
+class Backpressure:
+    """
+    Stops reading from the broker while a buffer is full, rather than
+    blocking the loop until there's room: the flush that makes room is
+    scheduled on that same loop.
+
+    ``check`` goes after each message. Once ``full()``, reading is paused
+    and the blocking ``wait_until_not_full`` runs on an executor; reading
+    resumes when it returns.
+    """
+
+    def __init__(self, helper, full, wait_until_not_full):
+        self.helper = helper
+        self.full = full
+        self.wait_until_not_full = wait_until_not_full
+        self._waiting = None
+
+    def check(self):
+        if self._waiting is not None or not self.full():
+            return
+
+        logger.warning("Buffer full, pausing reads until a flush completes")
+        self.helper.pause_reading()
+        self._waiting = self.helper.loop.create_task(self._resume())
+
+    async def _resume(self):
+        try:
+            await self.helper.loop.run_in_executor(None, self.wait_until_not_full)
+        finally:
+            self._waiting = None
+            self.helper.resume_reading()
+
+
+async def run_client(client, host, port, keepalive, stopping, max_backoff=60, helper=None):
+    """Keep ``client`` connected until ``stopping`` is set, then disconnect cleanly."""
+    if helper is None:
+        AsyncioHelper(asyncio.get_running_loop(), client)
+
+    disconnected = asyncio.Event()
+    client.on_disconnect = lambda *args: disconnected.set()
+    backoff = 1
+
+    while not stopping.is_set():
+        disconnected.clear()
+
+        try:
+            client.connect(host, port, keepalive)
+        except OSError:
+            logger.exception("Can't connect to %s:%s, retrying in %ss", host, port, backoff)
+        else:
+            backoff = 1
+            await first_of(disconnected.wait(), stopping.wait())
+
+        if stopping.is_set():
+            break
+
+        await first_of(asyncio.sleep(backoff), stopping.wait())
+        backoff = min(backoff * 2, max_backoff)
+
+    if client.is_connected():
+        client.disconnect()
+        await first_of(disconnected.wait(), asyncio.sleep(5))
+
+
+async def every(interval, flush, stopping, executor=None, wake=None):
+    """
+    Run the blocking ``flush`` on ``executor`` every ``interval`` seconds
+    until ``stopping`` is set.
+
+    Runs are scheduled on a fixed cadence rather than ``interval`` after the
+    last one finished, so a slow flush doesn't push the next ones back; a
+    flush that overruns whole intervals skips them. ``wake``, a blocking
+    ``wait(timeout)`` like RecordBuffer.wait_for_flush, can ask for a flush
+    before the next one is due.
+    """
+    loop = asyncio.get_running_loop()
+    next_run = loop.time() + interval
+
+    while not stopping.is_set():
+        remaining = max(0, next_run - loop.time())
+
+        if wake is None:
+            await first_of(asyncio.sleep(remaining), stopping.wait())
+        else:
+            await loop.run_in_executor(executor, wake, remaining)
+
+        if stopping.is_set():
+            break
+
+        await loop.run_in_executor(executor, flush)
+
+        if (now := loop.time()) >= next_run:
+            skipped = int((now - next_run) // interval)
+            if skipped:
+                logger.warning("%s overran %d flush intervals", getattr(flush, "__name__", flush), skipped)
+            next_run += interval * (skipped + 1)
+
+
+async def first_of(*awaitables):
+    """Wait for whichever of ``awaitables`` finishes first and cancel the others."""
+    tasks = [asyncio.ensure_future(a) for a in awaitables]
+    done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
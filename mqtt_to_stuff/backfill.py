@@ -0,0 +1,391 @@
+import argparse
+import datetime
+import logging
+import os
+import sys
+from collections import defaultdict
+
+import polars as pl
+
+import to_delta
+import zigbee_to_delta
+from delta_client import DeltaLakeClient, storage_options_from_env
+from devices import ChangeFilter, on_off
+
+logger = logging.getLogger(__name__)
+
+DEVICE = ["kind", "zone", "area", "thing"]
+SOURCE = ["zone", "area", "thing"]
+
+# the columnar form of each cast in the sensor tables; where the live cast
+# raises the reading is dropped, here it comes out null and is dropped too
+CASTS = {
+    float: lambda payload: payload.cast(pl.Float64, strict=False),
+    int: lambda payload: payload.cast(pl.Int64, strict=False),
+    on_off: lambda payload: payload == "ON",
+}
+
+
+def scan_raw(dlc, since, until):
+    """
+    raw-mqtt between two arrival times, reading only the date partitions they fall in.
+
+    Rows raw_to_delta collapsed into runs with ``--dedup`` are expanded back
+    into ``count`` messages, see expand_runs.
+    """
+    raw = pl.scan_delta(dlc.table("raw-mqtt")).filter(pl.col("date").is_between(since.date(), until.date()))
+
+    if "count" in raw.collect_schema():
+        raw = expand_runs(raw.filter(pl.col("arrival_timestamp") < until))
+
+    return (
+        raw.filter(pl.col("arrival_timestamp") >= since, pl.col("arrival_timestamp") < until)
+        .select("topic", "payload", timestamp="arrival_timestamp")
+        .sort("timestamp", maintain_order=True)
+        .with_row_index("seq")
+    )
+
+
+def expand_runs(raw):
+    """
+    One row per message of every run of repeated payloads.
+
+    A run only keeps when its first and last message arrived, so the ones in
+    between are spread evenly over that time. Throttles, deadbands and window
+    sample counts then see about as many messages as there were, though not
+    exactly when. Rows written without deduplication have no count and stay
+    single messages.
+    """
+    count = pl.col("count").fill_null(1)
+    first = pl.col("arrival_timestamp").dt.epoch("us")
+    last = pl.col("last_seen").fill_null(pl.col("arrival_timestamp")).dt.epoch("us")
+
+    return (
+        raw.with_columns(repeat=pl.int_ranges(0, count))
+        .explode("repeat", empty_as_null=False)
+        .with_columns(
+            arrival_timestamp=(first + (last - first) * pl.col("repeat") // pl.max_horizontal(count - 1, 1))
+            .cast(pl.Datetime("us"))
+        )
+        .drop("repeat")
+    )
+
+
+def esphome_readings(raw, type_map):
+    """ESPHome state messages split into device, sensor and payload, like to_delta's on_message."""
+    levels = pl.col("levels")
+
+    return (
+        raw.filter(pl.col("topic").str.starts_with("devices/"))
+        .with_columns(levels=pl.col("topic").str.split("/"))
+        .filter(levels.list.len() > 5)
+        .select(
+            "seq",
+            "timestamp",
+            "payload",
+            zone=levels.list.get(1),
+            area=levels.list.get(2),
+            kind=levels.list.get(3),
+            thing=levels.list.get(4),
+            sensor=levels.list.slice(5).list.join("/"),
+        )
+        .filter(pl.col("kind").is_in(list(type_map)))
+        .with_columns(device=pl.concat_str(DEVICE, separator="/"))
+    )
+
+
+def accepted_readings(readings, type_map):
+    """
+    Cast every reading and keep the ones its sensor's filter accepts.
+
+    Returns the accepted readings per (series, kind), each frame holding the
+    reading under its column name.
+    """
+    accepted = defaultdict(list)
+
+    for (kind, sensor), df in readings.partition_by(["kind", "sensor"], as_dict=True).items():
+        schema = type_map[kind].schema
+        if (compiled := schema.sensors.get(tuple(sensor.split("/")))) is None:
+            continue
+
+        cf, series_name, index, _ = compiled
+        columns, _ = schema.series[series_name]
+
+        df = df.with_columns(value=CASTS[cf.cast](pl.col("payload"))).drop_nulls("value")
+        df = df.filter(changed(df, cf))
+
+        accepted[(series_name, kind)].append(
+            df.select(DEVICE + ["device", "seq", "timestamp", pl.col("value").alias(columns[index])])
+        )
+
+    return accepted
+
+
+def changed(df, cf):
+    if type(cf) is ChangeFilter:
+        # the last accepted value is always the previous reading's, so
+        # comparing each reading with the one before it is the same filter
+        return df.select(pl.col("value").ne_missing(pl.col("value").shift(1).over("device"))).to_series()
+
+    # deadbands compare with the last *accepted* reading, which depends on
+    # everything before it, so they're run once over the column in order
+    state = {}
+    keep = []
+    seconds = (df["timestamp"].dt.epoch("us") / 1_000_000).to_list()
+
+    for device, t, value in zip(df["device"].to_list(), seconds, df["value"].to_list()):
+        previous, accepted = state.get(device, (None, None))
+
+        if cf.changed(previous, value, None if accepted is None else t - accepted):
+            state[device] = (value, t)
+            keep.append(True)
+        else:
+            keep.append(False)
+
+    return pl.Series(keep, dtype=pl.Boolean)
+
+
+def series_rows(series, accepted):
+    """
+    The rows ``series`` would have stored from these accepted readings.
+
+    Each accepted reading makes a record of the device's latest value of
+    every column, once all of them have been seen, which is a forward fill
+    per device. Those records are then throttled or windowed per source the
+    way Series.append does it.
+    """
+    records = []
+
+    for (series_name, kind), frames in accepted.items():
+        if series_name != series.name:
+            continue
+
+        columns = [c for f in frames for c in f.columns[len(DEVICE) + 3:]]
+        records.append(
+            pl.concat(frames, how="diagonal_relaxed")
+            .sort("seq")
+            .with_columns(pl.col(columns).forward_fill().over("device"))
+            .drop_nulls(columns)
+        )
+
+    if not records:
+        return None
+
+    df = pl.concat(records, how="diagonal_relaxed").sort("seq").drop("kind", "device", "seq")
+    columns = df.columns[len(SOURCE) + 1:]
+
+    if series.window is not None:
+        return aggregate_windows(df, series.window, columns)
+
+    if series.throttle is not None:
+        return df.filter(throttled(df, series.throttle).not_())
+
+    return df
+
+
+def throttled(df, throttle):
+    # a record is dropped if it comes within ``throttle`` of the last one
+    # stored for its source, so like deadbands this needs the history
+    last_updates = {}
+    drop = []
+    sources = df.select(pl.concat_str(SOURCE, separator="/")).to_series().to_list()
+    seconds = (df["timestamp"].dt.epoch("us") / 1_000_000).to_list()
+
+    for source, t in zip(sources, seconds):
+        last_update = last_updates.get(source, 0)
+
+        if last_update > 0 and t < last_update + throttle:
+            drop.append(True)
+        else:
+            last_updates[source] = t
+            drop.append(False)
+
+    return pl.Series(drop, dtype=pl.Boolean)
+
+
+def aggregate_windows(df, window, columns):
+    """One row per source and tumbling window, with the columns WindowAggregate.record produces."""
+    numeric = [c for c in columns if df.schema[c].is_numeric()]
+
+    return df.group_by(
+        SOURCE + [pl.col("timestamp").dt.truncate("%dus" % int(window * 1_000_000))],
+        maintain_order=True,
+    ).agg(
+        *[pl.col(c).last() for c in columns],
+        *[pl.col(c).min().alias(c + "_min") for c in numeric],
+        *[pl.col(c).max().alias(c + "_max") for c in numeric],
+        *[pl.col(c).mean().alias(c + "_mean") for c in numeric],
+        samples=pl.len().cast(pl.Int64),
+    )
+
+
+def device_mappings(dlc):
+    """Every friendly name → address and model mapping zigbee_to_delta has recorded, oldest first."""
+    if (dt := dlc.table("zigbee-devices")) is None:
+        return None
+
+    return (
+        pl.scan_delta(dt)
+        .select("address", "model", "friendly_name", mapped_at="timestamp")
+        .sort("mapped_at")
+        .collect()
+    )
+
+
+def zigbee_rows(raw, mappings, handlers_by_model):
+    """
+    Rows per zigbee timeseries from device messages, like ZigbeeDeviceRegister.append.
+
+    Each message takes the mapping its friendly name had when it arrived, or
+    the first one recorded if it arrived before that.
+    """
+    if mappings is None:
+        return {}
+
+    messages = (
+        raw.filter(
+            pl.col("topic").str.starts_with("zigbee2mqtt/"),
+            pl.col("topic").str.starts_with("zigbee2mqtt/bridge/").not_(),
+            pl.col("topic").str.ends_with("/set").not_(),
+            # anything else isn't a device's JSON state
+            pl.col("payload").str.starts_with("{"),
+        )
+        .select("timestamp", "payload", friendly_name=pl.col("topic").str.slice(len("zigbee2mqtt/")))
+        .collect()
+    )
+
+    mapped = [
+        messages.join_asof(
+            mappings, left_on="timestamp", right_on="mapped_at", by="friendly_name", strategy=strategy,
+            check_sortedness=False,
+        ).select("address", "model")
+        for strategy in ("backward", "forward")
+    ]
+    levels = pl.col("friendly_name").str.split("/")
+
+    messages = messages.with_columns(
+        address=pl.coalesce(mapped[0]["address"], mapped[1]["address"]),
+        model=pl.coalesce(mapped[0]["model"], mapped[1]["model"]),
+        zone=pl.lit("home"),
+        area=levels.list.get(0),
+        thing=levels.list.get(2, null_on_oob=True),
+    ).drop_nulls(["address", "thing"])
+
+    rows = defaultdict(list)
+
+    for (model,), df in messages.partition_by("model", as_dict=True).items():
+        if (handler := handlers_by_model.get(model)) is None:
+            continue
+
+        fields, decoded = decode_payloads(df["payload"], handler.schema)
+        identity = df.filter(decoded).select("zone", "area", "thing", "address", "timestamp")
+        rows[handler.timeseries_name].append(identity.hstack(fields))
+
+    return {name: pl.concat(frames, how="diagonal_relaxed") for name, frames in rows.items()}
+
+
+def decode_payloads(payloads, schema):
+    """
+    A handler's fields from a column of JSON payloads, typed by its PayloadSchema.
+
+    Each payload goes through ``schema.decode`` like it does live, so the
+    same values are coerced or refused, and the ones that don't decode are
+    left out. Returns the fields and which payloads they came from.
+    """
+    rows = []
+    decoded = []
+    for payload in payloads.to_list():
+        try:
+            rows.append(schema.decode(payload))
+            decoded.append(True)
+        except ValueError:
+            decoded.append(False)
+
+    return pl.DataFrame(rows, schema=dict(schema.dtypes)), pl.Series(decoded, dtype=pl.Boolean)
+
+
+def derive(raw, register, mappings, handlers_by_model):
+    """Every derived table's rows from a slice of raw-mqtt."""
+    raw = raw.collect()
+    tables = {}
+
+    accepted = accepted_readings(esphome_readings(raw, register.type_map), register.type_map)
+    for series in register.series.values():
+        if (df := series_rows(series, accepted)) is not None:
+            tables[series.name] = df
+
+    tables.update(zigbee_rows(raw.lazy(), mappings, handlers_by_model))
+
+    return tables
+
+
+def backfill(dlc, output, start, end, tables=None, warmup=datetime.timedelta(hours=1), dry_run=False):
+    """
+    Rebuild the derived tables from raw-mqtt, one day at a time.
+
+    Each day's partitions are replaced as a whole. Filters, throttles and
+    windows start from scratch every day, so the day is processed with
+    ``warmup`` worth of the messages before it, which gets them into the
+    state they'd have been in, and only its own rows are kept.
+    """
+    register = to_delta.build_register()
+    handlers_by_model = zigbee_to_delta.ZDR.handlers_by_model
+    mappings = device_mappings(dlc)
+    written = defaultdict(int)
+
+    day = start
+    while day <= end:
+        since = datetime.datetime.combine(day, datetime.time())
+        until = since + datetime.timedelta(days=1)
+
+        for table, df in derive(scan_raw(dlc, since - warmup, until), register, mappings, handlers_by_model).items():
+            if tables and table not in tables:
+                continue
+
+            df = df.filter(pl.col("timestamp") >= since).with_columns(date=pl.col("timestamp").dt.date())
+            if df.is_empty():
+                continue
+
+            logger.info("%s: %s rows for %s", day, len(df), table)
+            written[table] += len(df)
+
+            if not dry_run:
+                output.replace(
+                    df,
+                    table,
+                    "date = '%s'" % day.isoformat(),
+                    {"partition_by": ["date"], "schema_mode": "merge"},
+                )
+
+        day += datetime.timedelta(days=1)
+
+    return dict(written)
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description="Rebuild derived tables from the raw-mqtt archive.")
+    parser.add_argument("-d", "--delta-path", dest="delta_path", help="Base path for DeltaLake tables", default=os.environ.get('DELTA_PATH', '/tmp/deltalake/'))
+    parser.add_argument("-o", "--output-path", dest="output_path", help="Base path to write the rebuilt tables under, defaults to the delta path")
+    parser.add_argument("--from", dest="start", type=datetime.date.fromisoformat, required=True, help="First day to rebuild (YYYY-MM-DD)")
+    parser.add_argument("--to", dest="end", type=datetime.date.fromisoformat, required=True, help="Last day to rebuild (YYYY-MM-DD)")
+    parser.add_argument("-t", "--table", dest="tables", action="append", help="Only rebuild this table (repeatable)")
+    parser.add_argument("--warmup", type=int, help="Seconds of messages before each day to replay first", default=3600)
+    parser.add_argument("--dry-run", dest="dry_run", action="store_true", help="Count the rows without writing them")
+
+    args = parser.parse_args(args)
+
+    logging.getLogger().setLevel(logging.INFO)
+
+    dlc = DeltaLakeClient(args.delta_path, storage_options_from_env())
+    output = DeltaLakeClient(args.output_path, storage_options_from_env()) if args.output_path else dlc
+
+    written = backfill(dlc, output, args.start, args.end, args.tables, datetime.timedelta(seconds=args.warmup), args.dry_run)
+
+    for table, rows in sorted(written.items()):
+        print(table, rows)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
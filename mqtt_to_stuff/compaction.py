@@ -0,0 +1,136 @@
+import logging
+import queue
+import threading
+import time
+
+
+class CompactionPolicy:
+    """
+    When a partition of a table is worth compacting.
+
+    Only files smaller than ``target_size`` count towards the thresholds, so a
+    partition that has already been compacted doesn't trigger again because of
+    its one big file. A partition is due as soon as any one threshold is met.
+    """
+
+    def __init__(self, max_files=60, max_bytes=None, max_age=None, target_size=64 * 1024 * 1024):
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.target_size = target_size
+
+    def is_small(self, size_bytes):
+        return self.target_size is None or size_bytes < self.target_size
+
+    def due(self, stats, now):
+        if stats.files < 2:
+            return False
+
+        if self.max_files is not None and stats.files >= self.max_files:
+            return True
+
+        if self.max_bytes is not None and stats.bytes >= self.max_bytes:
+            return True
+
+        if self.max_age is not None and now - stats.oldest >= self.max_age:
+            return True
+
+        return False
+
+
+class PartitionStats:
+    __slots__ = ("files", "bytes", "oldest")
+
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+        self.oldest = float("inf")
+
+    def add(self, size_bytes, modified):
+        self.files += 1
+        self.bytes += size_bytes
+        self.oldest = min(self.oldest, modified)
+
+    def __repr__(self):
+        return "PartitionStats(files=%s, bytes=%s, oldest=%s)" % (self.files, self.bytes, self.oldest)
+
+
+class CompactionScheduler:
+    """
+    Runs compaction and checkpointing for a DeltaLakeClient on its own workers.
+
+    The client reports partition stats after every append and the scheduler
+    queues the partitions that are due; the append itself never waits. At most
+    ``max_concurrent`` compactions run at once across all tables, and every
+    ``check_interval`` seconds idle workers re-check all known partitions so
+    age-based policies fire even when a table stops receiving writes.
+    """
+
+    def __init__(self, dlc, default_policy=None, max_concurrent=1, check_interval=60):
+        self._dlc = dlc
+        self._default_policy = default_policy or CompactionPolicy()
+        self._policies = {}
+        self._check_interval = check_interval
+        self._queue = queue.Queue()
+        self._queued = set()
+        self._queued_lock = threading.Lock()
+        self._workers = [
+            threading.Thread(target=self._run, name="compaction-%d" % i, daemon=True)
+            for i in range(max_concurrent)
+        ]
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    def set_policy(self, path, policy):
+        self._policies[path] = policy
+
+    def policy(self, path):
+        return self._policies.get(path, self._default_policy)
+
+    def start(self):
+        self._dlc.set_compactor(self)
+        for worker in self._workers:
+            worker.start()
+
+    def stop(self, timeout=None):
+        """Finish the compactions already queued, then stop the workers."""
+        for _ in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join(timeout)
+
+    def check(self, path, stats_by_partition):
+        policy = self.policy(path)
+        now = time.time()
+
+        for partition, stats in stats_by_partition.items():
+            if policy.due(stats, now):
+                self.request(path, partition)
+
+    def request(self, path, partition):
+        with self._queued_lock:
+            if (path, partition) in self._queued:
+                return
+            self._queued.add((path, partition))
+
+        self._queue.put((path, partition))
+
+    def _run(self):
+        while True:
+            try:
+                item = self._queue.get(timeout=self._check_interval)
+            except queue.Empty:
+                self._dlc.check_compaction()
+                continue
+
+            if item is None:
+                break
+
+            path, partition = item
+
+            try:
+                self._dlc.compact(path, partition, self.policy(path).target_size)
+            except Exception:
+                self.logger.exception("Failed to compact %s %s", path, dict(partition))
+            finally:
+                with self._queued_lock:
+                    self._queued.discard((path, partition))
@@ -0,0 +1,274 @@
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+
+import deltalake
+import polars as pl
+
+import metrics
+from compaction import PartitionStats
+
+
+def storage_options_from_env():
+    options = {}
+    if S3_ENDPOINT := os.environ.get('AWS_ENDPOINT_URL_S3'):
+        options["endpoint_url"] = S3_ENDPOINT
+    options["AWS_SESSION_TOKEN"] = os.environ.get('AWS_SESSION_TOKEN', "")
+    # S3 has no atomic rename, so several writers on one table need one of
+    # these for delta-rs to commit safely
+    for name in ("AWS_S3_LOCKING_PROVIDER", "DELTA_DYNAMO_TABLE_NAME", "conditional_put"):
+        if value := os.environ.get(name.upper()):
+            options[name] = value
+
+    return options
+
+
+class DeltaLakeClient:
+    """
+    Writes DataFrames to Delta tables under a common base path.
+
+    Table handles are opened once and kept for the life of the client. After
+    each append the handle is brought up to date with ``update_incremental``,
+    which only reads the commits we haven't seen yet, and the small files per
+    partition are tracked from what we wrote instead of listing the table
+    again. Compaction is left to a CompactionScheduler, if one is attached.
+
+    Frames are conformed to the table before they're written: columns the
+    table has are cast to its types, new columns are added by schema
+    merging, and columns with no type at all (nothing but nulls) are left
+    out, so a batch whose types drifted is written rather than retried.
+    """
+
+    def __init__(self, base_path, storage_options):
+        self._base_path = base_path
+        self._storage_options = storage_options
+        self._compactor = None
+        self._tables = {}
+        self._partition_files = {}
+        # column types of each table, as far as we've seen them
+        self._schemas = {}
+        self._lock = threading.Lock()
+        # appends to different tables run concurrently, appends to one table don't
+        self._table_locks = {}
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    def set_compactor(self, compactor):
+        self._compactor = compactor
+
+    def uri(self, path):
+        return self._base_path + path
+
+    def table(self, path):
+        """Return the cached handle for ``path``, or None if the table doesn't exist yet."""
+        with self._table_lock(path):
+            return self._open(path)
+
+    def get(self, path):
+        dt = self.table(path)
+        if dt is None:
+            return None
+
+        return pl.read_delta(dt)
+
+    def append(self, df, path, write_options=None):
+        self._write(df, path, write_options)
+
+    def replace(self, df, path, predicate, write_options=None):
+        """Overwrite the rows of ``path`` matching ``predicate`` with ``df``, e.g. to rebuild a range of partitions."""
+        self._write(df, path, dict(write_options or {}, predicate=predicate), mode="overwrite")
+
+    def _write(self, df, path, write_options, mode="append"):
+        write_options = dict(write_options or {})
+        write_options["writer_properties"] = deltalake.WriterProperties(compression="zstd")
+        write_options.setdefault("schema_mode", "merge")
+
+        started = time.perf_counter()
+
+        with self._table_lock(path):
+            dt = self._open(path)
+            df = self._conform(path, dt, df)
+
+            if dt is None:
+                dt = self._create(df, path, write_options)
+
+            if dt is not None:
+                self._commit(dt, df, write_options, mode)
+                dt.update_incremental()
+
+                if mode == "append":
+                    self._count_written(path, df, write_options.get("partition_by"))
+                else:
+                    self._partition_files[path] = self._count_files(path, dt)
+
+            self._schemas[path] = {**df.schema, **self._schemas.get(path, {})}
+            self.logger.info("Wrote %s records to %s", len(df), self.uri(path))
+            stats = dict(self._partition_files[path])
+
+        metrics.delta_write_seconds.labels(path).observe(time.perf_counter() - started)
+
+        if self._compactor is not None:
+            self._compactor.check(path, stats)
+
+    def _commit(self, dt, df, write_options, mode, attempts=3):
+        """
+        Write ``df`` to ``dt``, catching up and trying again when another
+        writer's commit conflicts with ours. delta-rs retries plain appends
+        by itself, but not past a concurrent metadata or protocol change.
+        """
+        for attempt in range(1, attempts + 1):
+            try:
+                df.write_delta(dt, delta_write_options=write_options, mode=mode)
+                return
+            except deltalake.exceptions.CommitFailedError:
+                if attempt == attempts:
+                    raise
+                self.logger.info("Commit to %s conflicted with another writer, retrying", dt.table_uri)
+                dt.update_incremental()
+
+    def _create(self, df, path, write_options):
+        """
+        Write the first batch of ``path``, returning the table if another
+        writer created it first and the batch still has to be appended.
+        """
+        # there's nothing to replace in a table that doesn't exist yet
+        write_options = {k: v for k, v in write_options.items() if k != "predicate"}
+
+        try:
+            df.write_delta(
+                self.uri(path),
+                delta_write_options=write_options,
+                storage_options=self._storage_options,
+                mode="append",
+            )
+        except deltalake.exceptions.CommitFailedError:
+            if (dt := self._open(path)) is None:
+                raise
+            self.logger.info("%s was created by another writer meanwhile", self.uri(path))
+            return dt
+
+        # opening the new table seeds the partition counts, this write included
+        self._open(path)
+        return None
+
+    def check_compaction(self):
+        if self._compactor is None:
+            return
+
+        stats = {path: dict(partitions) for path, partitions in list(self._partition_files.items())}
+
+        for path, partitions in stats.items():
+            self._compactor.check(path, partitions)
+
+    def compact(self, path, partition, target_size=None):
+        """
+        Compact one partition of ``path`` and checkpoint the table.
+
+        This works on a handle of its own so appends can carry on meanwhile;
+        delta-rs resolves the optimize commit against any concurrent appends.
+        It doesn't catch two compactions of the same files though, which
+        then both commit and duplicate their rows, so only one process may
+        compact a table.
+        """
+        started = time.perf_counter()
+        dt = deltalake.DeltaTable(self.uri(path), storage_options=self._storage_options)
+        filters = [(column, "=", value) for column, value in partition] or None
+
+        result = dt.optimize.compact(partition_filters=filters, target_size=target_size)
+        dt.create_checkpoint()
+        self.logger.info("Compacted %s %s: %s", path, dict(partition), result)
+        metrics.delta_compaction_seconds.labels(path).observe(time.perf_counter() - started)
+
+        with self._table_lock(path):
+            cached = self._tables[path]
+            cached.update_incremental()
+            self._partition_files[path] = self._count_files(path, cached)
+
+    def _conform(self, path, dt, df):
+        if (table_schema := self._schemas.get(path)) is None and dt is not None:
+            table_schema = self._schemas[path] = dict(pl.scan_delta(dt).collect_schema())
+
+        table_schema = table_schema or {}
+
+        for column, dtype in df.schema.items():
+            expected = table_schema.get(column)
+
+            if expected is None and dtype == pl.Null:
+                df = df.drop(column)
+            elif expected is not None and expected != dtype:
+                self.logger.warning("%s.%s is %s in the table, casting from %s", path, column, expected, dtype)
+                df = df.with_columns(self._cast(path, df[column], expected))
+
+        return df
+
+    def _cast(self, path, values, dtype):
+        """
+        ``values`` as ``dtype``, refusing a cast that would change any of them.
+
+        Values that don't fit come out null with a non-strict cast, and
+        numbers can lose their fraction or precision, which casting back
+        shows. Either way the batch is refused with a SchemaMismatchError,
+        so the Spool sets it aside instead of writing altered values.
+        """
+        try:
+            cast = values.cast(dtype, strict=False)
+            lost = cast.null_count() > values.null_count()
+
+            if not lost and values.dtype.is_numeric() and dtype.is_numeric():
+                lost = cast.cast(values.dtype, strict=False).ne_missing(values).any()
+
+        except pl.exceptions.PolarsError as e:
+            raise deltalake.exceptions.SchemaMismatchError(
+                "Can't cast %s.%s from %s to %s: %s" % (path, values.name, values.dtype, dtype, e)
+            ) from e
+
+        if lost:
+            raise deltalake.exceptions.SchemaMismatchError(
+                "Casting %s.%s from %s to %s would change some of its values" % (path, values.name, values.dtype, dtype)
+            )
+
+        return cast
+
+    def _table_lock(self, path):
+        with self._lock:
+            return self._table_locks.setdefault(path, threading.Lock())
+
+    def _open(self, path):
+        if path in self._tables:
+            return self._tables[path]
+
+        if not deltalake.DeltaTable.is_deltatable(self.uri(path), storage_options=self._storage_options):
+            return None
+
+        dt = deltalake.DeltaTable(self.uri(path), storage_options=self._storage_options)
+        self._tables[path] = dt
+        self._partition_files[path] = self._count_files(path, dt)
+
+        return dt
+
+    def _is_small(self, path, size_bytes):
+        return self._compactor is None or self._compactor.policy(path).is_small(size_bytes)
+
+    def _count_files(self, path, dt):
+        """Small files per partition from the snapshot we already hold in memory."""
+        partition_columns = dt.metadata().partition_columns
+        actions = pl.DataFrame(dt.get_add_actions(flatten=True))
+
+        stats = defaultdict(PartitionStats)
+        columns = ["size_bytes", "modification_time"] + ["partition." + c for c in partition_columns]
+        for size_bytes, modified, *values in actions.select(columns).iter_rows():
+            if self._is_small(path, size_bytes):
+                stats[tuple(zip(partition_columns, map(str, values)))].add(size_bytes, modified / 1000)
+
+        return stats
+
+    def _count_written(self, path, df, partition_by):
+        # delta-rs writes one file per partition for batches of our size, and
+        # the in-memory size is a fair upper bound for what landed on disk
+        stats = self._partition_files[path]
+        now = time.time()
+        partition_by = partition_by or []
+
+        for values, part in df.group_by(partition_by) if partition_by else [((), df)]:
+            stats[tuple(zip(partition_by, map(str, values)))].add(part.estimated_size(), now)
@@ -1,57 +1,172 @@
-from collections import defaultdict
+from types import MappingProxyType
 import datetime
+import time
+
+import msgspec
+import polars as pl
+
+def on_off(x):
+    return True if x == "ON" else False
+
+# the column type each cast in the sensor tables produces
+CAST_DTYPES = {
+    float: pl.Float64,
+    int: pl.Int64,
+    on_off: pl.Boolean,
+}
 
 class ChangeFilter:
-    def __init__(self, cast = lambda x: float(x)):
+    """
+    How a sensor's payload is cast and when a new reading counts as a change.
+
+    Filters live in the class-level ``sensors`` tables and are shared by every
+    device of that class, so they hold no state of their own; the previous
+    value is kept per device and handed in.
+    """
+
+    __slots__ = ("cast",)
+
+    def __init__(self, cast = float):
         self.cast = cast
-        self._previous_value = None
 
-    def set(self, value):
-        cast = self.cast(value)
+    def changed(self, previous, value, elapsed):
+        return previous != value
 
-        if self._previous_value != cast:
-            print("set: return cast value - values different", value, cast, self._previous_value)
-            self._previous_value = cast
-            return cast
 
-        #print("set: return none - values equal", value, cast, self._previous_value)
-        self._previous_value = cast
-        return None
+class DeadbandFilter(ChangeFilter):
+    """
+    A ChangeFilter for noisy numeric readings.
+
+    A reading only counts as a change once it has moved more than
+    ``absolute`` and more than ``relative`` (a fraction of the previous value)
+    away from the last accepted value, so slow drift still gets through once
+    it adds up. ``min_interval`` holds back changes arriving sooner than that
+    many seconds after the last accepted one, and ``max_interval`` lets an
+    unchanged reading through once that long has passed, as a heartbeat.
+    """
+
+    __slots__ = ("absolute", "relative", "min_interval", "max_interval")
+
+    def __init__(self, cast = float, absolute=None, relative=None, min_interval=None, max_interval=None):
+        super().__init__(cast)
+        self.absolute = absolute
+        self.relative = relative
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+
+    def changed(self, previous, value, elapsed):
+        if previous is None or elapsed is None:
+            return True
+
+        if self.max_interval is not None and elapsed >= self.max_interval:
+            return True
+
+        if self.min_interval is not None and elapsed < self.min_interval:
+            return False
+
+        delta = abs(value - previous)
+
+        if delta == 0:
+            return False
+
+        if self.absolute is not None and delta <= self.absolute:
+            return False
+
+        if self.relative is not None and delta <= self.relative * abs(previous):
+            return False
+
+        return True
+
+
+class SensorSchema:
+    """
+    A MonitoredDevice class's ``sensors`` table, compiled once per class.
+
+    Each sensor key maps to its filter, its series and the position and bit
+    of its column in that series, so a device can store readings in a plain
+    list per series and tell a complete record from its bitmask, and
+    ``dtypes`` gives each series' column types. The schema is read-only and
+    shared; everything that varies per device lives in that
+    device's SeriesState.
+    """
+
+    __slots__ = ("sensors", "series", "dtypes")
+
+    def __init__(self, sensors):
+        series_columns = {}
+        dtypes = {}
+        for (cf, (series_name, column_name)) in sensors.values():
+            columns = series_columns.setdefault(series_name, [])
+            if column_name not in columns:
+                columns.append(column_name)
+            dtypes.setdefault(series_name, {})[column_name] = CAST_DTYPES[cf.cast]
+
+        self.dtypes = MappingProxyType(dtypes)
+
+        self.series = MappingProxyType({
+            series_name: (tuple(columns), (1 << len(columns)) - 1)
+            for series_name, columns in series_columns.items()
+        })
+
+        compiled = {}
+        for key, (cf, (series_name, column_name)) in sensors.items():
+            index = series_columns[series_name].index(column_name)
+            compiled[key] = (cf, series_name, index, 1 << index)
+
+        self.sensors = MappingProxyType(compiled)
+
+
+class SeriesState:
+    __slots__ = ("values", "accepted", "mask")
+
+    def __init__(self, width):
+        self.values = [None] * width
+        # monotonic time each value was last accepted
+        self.accepted = [None] * width
+        self.mask = 0
 
 
 class MonitoredDevice:
-    sensors = {}
+    sensors = MappingProxyType({})
+    schema = SensorSchema(sensors)
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.sensors = MappingProxyType(dict(cls.sensors))
+        cls.schema = SensorSchema(cls.sensors)
+
+    __slots__ = ("device_key", "series")
 
     def __init__(self, device_key):
         self.device_key = device_key
-        self.series = defaultdict(dict)
+        self.series = {
+            series_name: SeriesState(len(columns))
+            for series_name, (columns, _) in self.schema.series.items()
+        }
 
     def set(self, key, value):
-        if key in self.sensors:
-            sensor_config = self.sensors[key]
-            cf = sensor_config[0]
-
-            type_cast_value = cf.cast(value)
-
-            series_name = sensor_config[1][0]
-            column_name = sensor_config[1][1]
-
-            current_value = self.series[series_name].get(column_name)
+        if (sensor := self.schema.sensors.get(key)) is None:
+            return None
 
-            if current_value != type_cast_value:
-                self.series[series_name][column_name] = type_cast_value
+        cf, series_name, index, bit = sensor
+        type_cast_value = cf.cast(value)
+        state = self.series[series_name]
 
-                record = self.series[series_name]
-                series_columns = [x[1][1] for x in self.sensors.values() if x[1][0] == series_name]
+        now = time.monotonic()
+        accepted = state.accepted[index]
 
-                record_keys = set(list(record.keys()))
-                column_keys = set(series_columns)
+        if cf.changed(state.values[index], type_cast_value, None if accepted is None else now - accepted):
+            state.values[index] = type_cast_value
+            state.accepted[index] = now
+            state.mask |= bit
 
+            columns, complete = self.schema.series[series_name]
 
-                if len(record) == len(series_columns):
-                    return (series_name, list(record.items()))
-                else:
-                    print(self.device_key, series_name, "specified", series_name + "." + column_name, "=", value, "missing:", column_keys-record_keys)
+            if state.mask == complete:
+                return (series_name, list(zip(columns, state.values)))
+            else:
+                missing = {c for i, c in enumerate(columns) if not state.mask & (1 << i)}
+                print(self.device_key, series_name, "specified", series_name + "." + columns[index], "=", value, "missing:", missing)
 
         return None
 
@@ -59,35 +174,35 @@ class MonitoredDevice:
 class MonitoringPlug(MonitoredDevice):
     sensors = {
         ("sensor", "power", "state"): (
-            ChangeFilter(),
+            DeadbandFilter(absolute=0.5, relative=0.02, max_interval=300),
             ("electricity", "power")
         ),
         ("sensor", "current", "state"): (
-            ChangeFilter(),
+            DeadbandFilter(absolute=0.01, relative=0.02, max_interval=300),
             ("electricity", "current")
         ),
         ("sensor", "voltage", "state"): (
-            ChangeFilter(),
+            DeadbandFilter(absolute=1.0, max_interval=300),
             ("electricity", "voltage")
         ),
         ("sensor", "apparent_power", "state"): (
-            ChangeFilter(),
+            DeadbandFilter(absolute=0.5, relative=0.02, max_interval=300),
             ("electricity", "apparent_power")
         ),
         ("sensor", "power_factor", "state"): (
-            ChangeFilter(),
+            DeadbandFilter(absolute=0.02, max_interval=300),
             ("electricity", "power_factor")
         ),
         ("sensor", "reactive_power", "state"): (
-            ChangeFilter(),
+            DeadbandFilter(absolute=0.5, relative=0.02, max_interval=300),
             ("electricity", "reactive_power")
         ),
         ("sensor", "energy", "state"): (
-            ChangeFilter(),
+            DeadbandFilter(min_interval=60),
             ("electricity", "energy")
         ),
         ("switch", "switch", "state"): (
-            ChangeFilter(lambda x: True if x == "ON" else False),
+            ChangeFilter(on_off),
             ("electricity", "switch")
         ),
 
@@ -97,6 +212,16 @@ class MonitoringPlug(MonitoredDevice):
         ),
     }
 
+# the radar reports positions in mm, angles in degrees and speed in cm/s,
+# and jitters by a few units even for someone sitting still
+multi_presence_target_deadbands = {
+    "x": 20,
+    "y": 20,
+    "distance": 20,
+    "angle": 2,
+    "speed": 5,
+}
+
 class MultiPresenceDetector(MonitoredDevice):
     sensors = {
         ("sensor", "uptime_sensor", "state"): (
@@ -104,7 +229,7 @@ class MultiPresenceDetector(MonitoredDevice):
             ("iot_device_uptime", "uptime")
         ),
         ("binary_sensor", "presence", "state"): (
-            ChangeFilter(lambda x: True if x == "ON" else False),
+            ChangeFilter(on_off),
             ("multi-presence", "occupancy")
         ),
         ("sensor", "presence_target_count", "state"): (
@@ -121,25 +246,24 @@ class MultiPresenceDetector(MonitoredDevice):
         ),
     }
 
-    def __init__(self, device_key):
-        super().__init__(device_key)
-
-        for target_index in [1, 2, 3]:
-            for prop in ["x", "y", "distance", "angle", "speed"]:
-                self.sensors[("sensor", f"target-{target_index}_{prop}", "state")] = (
-                    ChangeFilter(),
-                    ("multi-presence", f"target_{target_index}_{prop}")
-                )
+    sensors.update({
+        ("sensor", f"target-{target_index}_{prop}", "state"): (
+            DeadbandFilter(absolute=deadband),
+            ("multi-presence", f"target_{target_index}_{prop}")
+        )
+        for target_index in [1, 2, 3]
+        for prop, deadband in multi_presence_target_deadbands.items()
+    })
 
 class PresenceDetector(MonitoredDevice):
     sensors = {
         ("binary_sensor", "occupancy", "state"): (
-            ChangeFilter(lambda x: True if x == "ON" else False),
+            ChangeFilter(on_off),
             ("presence", "occupancy")
         ),
 
         ("sensor", "light_sensor", "state"): (
-            ChangeFilter(),
+            DeadbandFilter(absolute=1.0, relative=0.05, max_interval=600),
             ("habitat", "light_level")
         ),
 
@@ -149,8 +273,88 @@ class PresenceDetector(MonitoredDevice):
         ),
     }
 
+DTYPES = {
+    float: pl.Float64,
+    int: pl.Int64,
+    bool: pl.Boolean,
+    str: pl.String,
+}
+
+
+class Field:
+    """
+    One column a zigbee handler keeps from a device's JSON state.
+
+    ``type`` is what the value is in the payload, under ``key`` (the column
+    name by default). ``convert`` turns it into the column's value, and
+    ``dtype`` is the column's type when that's not simply ``type``'s.
+    """
+
+    __slots__ = ("type", "key", "convert", "dtype")
+
+    def __init__(self, type, key=None, convert=None, dtype=None):
+        self.type = type
+        self.key = key
+        self.convert = convert
+        self.dtype = dtype or DTYPES[type]
+
+
+class PayloadSchema:
+    """
+    The typed fields a zigbee handler keeps, decoded straight from the payload.
+
+    A payload is decoded with msgspec into a struct of just these fields, so
+    keys nobody asked for are skipped by the parser instead of being built
+    into a dict first. ``decode`` returns one value per field, None where
+    the key is missing, and raises ValueError for a payload that isn't a
+    JSON object or has a value of the wrong type. ``dtypes`` is the frame schema for the
+    fields, so flushes don't infer one.
+    """
+
+    __slots__ = ("fields", "dtypes", "_decoder")
+
+    def __init__(self, fields):
+        for name, field in fields.items():
+            field.key = field.key or name
+
+        self.fields = MappingProxyType(fields)
+        self.dtypes = MappingProxyType({name: field.dtype for name, field in fields.items()})
+
+        attributes = ["f%d" % i for i in range(len(fields))]
+        struct = msgspec.defstruct(
+            "Payload",
+            [(a, field.type | None, None) for a, field in zip(attributes, fields.values())],
+            rename={a: field.key for a, field in zip(attributes, fields.values())},
+        )
+        # lax, so a number sent as a string still decodes
+        self._decoder = msgspec.json.Decoder(struct, strict=False)
+
+    def decode(self, payload):
+        try:
+            values = msgspec.structs.astuple(self._decoder.decode(payload))
+        except msgspec.DecodeError as e:
+            raise ValueError(str(e)) from e
+
+        return {
+            name: value if value is None or field.convert is None else field.convert(value)
+            for (name, field), value in zip(self.fields.items(), values)
+        }
+
+
 class ContactSensor:
     timeseries_name = 'contact-sensors'
+    model_ids = (
+        'TS0203',
+    )
+
+    schema = PayloadSchema({
+        "battery": Field(int),
+        "battery_low": Field(bool),
+        "contact": Field(bool),
+        "linkquality": Field(int),
+        "tamper": Field(bool),
+        "voltage": Field(int),
+    })
 
     def friendly_name_to_id(self, friendly_name):
         split_friendly_name = friendly_name.split("/")
@@ -165,18 +369,24 @@ class ContactSensor:
         }
 
     def match_device(self, device_definition):
-        model_ids = [
-            'TS0203'
-        ]
-
-        return device_definition.get('model_id') in model_ids
+        return device_definition.get('model_id') in self.model_ids
 
-    def cast_payload(self, payload):
-        # {'battery': 100, 'battery_low': False, 'contact': True, 'linkquality': 72, 'tamper': False, 'vo
-        return payload
+    def decode(self, payload):
+        return self.schema.decode(payload)
 
 class ThermometerAndHygrometer:
     timeseries_name = 'temperature-and-humidity'
+    model_ids = (
+        'TS0201',
+    )
+
+    schema = PayloadSchema({
+        "temperature": Field(float),
+        "humidity": Field(float),
+        "battery": Field(int),
+        "voltage": Field(int),
+        "linkquality": Field(int),
+    })
 
     def friendly_name_to_id(self, friendly_name):
         split_friendly_name = friendly_name.split("/")
@@ -191,23 +401,24 @@ class ThermometerAndHygrometer:
         }
 
     def match_device(self, device_definition):
-        model_ids = [
-            'TS0201'
-        ]
-
-        return device_definition.get('model_id') in model_ids
+        return device_definition.get('model_id') in self.model_ids
 
-    def cast_payload(self, payload):
-        return {
-            "temperature": payload['temperature'],
-            "humidity": payload['humidity'],
-            "battery": payload['battery'],
-            "voltage": payload['voltage'],
-            "linkquality": payload['linkquality'],
-        }
+    def decode(self, payload):
+        return self.schema.decode(payload)
 
 class TradfriBulbHandler:
     timeseries_name = 'smart-bulbs'
+    model_ids = (
+        'TRADFRI bulb E27 WW globe 806lm',
+        'TRADFRI bulb GU10 WW 345lm',
+        'CK-BL702-AL-01(7009_Z102LG03-1)',
+    )
+
+    schema = PayloadSchema({
+        "on": Field(str, key="state", convert=on_off, dtype=pl.Boolean),
+        "brightness": Field(int),
+        "linkquality": Field(int),
+    })
 
     def friendly_name_to_id(self, friendly_name):
         split_friendly_name = friendly_name.split("/")
@@ -220,24 +431,25 @@ class TradfriBulbHandler:
 
 
     def match_device(self, device_definition):
-        model_ids = [
-            'TRADFRI bulb E27 WW globe 806lm',
-            'TRADFRI bulb GU10 WW 345lm',
-            'CK-BL702-AL-01(7009_Z102LG03-1)',
-        ]
+        return device_definition.get('model_id') in self.model_ids
 
-        return device_definition.get('model_id') in model_ids
-
-    def cast_payload(self, payload):
-        return {
-            "on": True if payload['state'] == 'ON' else False,
-            "brightness": payload['brightness'],
-            "linkquality": payload['linkquality']
-        }
+    def decode(self, payload):
+        return self.schema.decode(payload)
 
 
 class ActionButtons:
     timeseries_name = 'buttons'
+    model_ids = (
+        'TS004F', # rotary
+        'ZG-101ZL', # simple push
+    )
+
+    schema = PayloadSchema({
+        "action": Field(str),
+        "battery": Field(int),
+        "linkquality": Field(int),
+        "voltage": Field(int),
+    })
 
     def friendly_name_to_id(self, friendly_name):
         split_friendly_name = friendly_name.split("/")
@@ -250,19 +462,27 @@ class ActionButtons:
 
 
     def match_device(self, device_definition):
-        model_ids = [
-            'TS004F', # rotary
-            'ZG-101ZL' # simple push
-        ]
+        return device_definition.get('model_id') in self.model_ids
 
-        return device_definition.get('model_id') in model_ids
-
-    def cast_payload(self, payload):
-        return payload
+    def decode(self, payload):
+        return self.schema.decode(payload)
 
 
 class MotionLuminance:
     timeseries_name = 'motion-sensor'
+    model_ids = (
+        'ZG-204ZL', # motion & luminance
+    )
+
+    schema = PayloadSchema({
+        "battery": Field(int),
+        "illuminance": Field(int),
+        "illuminance_interval": Field(int),
+        "keep_time": Field(str),
+        "linkquality": Field(int),
+        "occupancy": Field(bool),
+        "sensitivity": Field(str),
+    })
 
     def friendly_name_to_id(self, friendly_name):
         split_friendly_name = friendly_name.split("/")
@@ -275,20 +495,26 @@ class MotionLuminance:
 
 
     def match_device(self, device_definition):
-        model_ids = [
-            'ZG-204ZL' # motion & luminance
-        ]
-
-        return device_definition.get('model_id') in model_ids
+        return device_definition.get('model_id') in self.model_ids
 
-    def cast_payload(self, payload):
-        #payload['motion'] = payload.get('occupancy')
-        #del payload['occupancy']
-        # {'battery': 100, 'illuminance': None, 'illuminance_interval': None, 'keep_time': None, 'linkquality': 84, 'occupancy': None, 'sensitivity': None}
-        return payload
+    def decode(self, payload):
+        return self.schema.decode(payload)
 
 class RainSensor:
     timeseries_name = 'rain'
+    model_ids = (
+        'TS0207',
+    )
+
+    schema = PayloadSchema({
+        "rain_intensity": Field(int),
+        "illuminance": Field(int),
+        "illuminance_average_20min": Field(int),
+        "illuminance_maximum_today": Field(int),
+        "cleaning_reminder": Field(bool),
+        "battery": Field(int),
+        "linkquality": Field(int),
+    })
 
     def friendly_name_to_id(self, friendly_name):
         split_friendly_name = friendly_name.split("/")
@@ -301,17 +527,24 @@ class RainSensor:
 
 
     def match_device(self, device_definition):
-        model_ids = [
-            'TS0207'
-        ]
+        return device_definition.get('model_id') in self.model_ids
 
-        return device_definition.get('model_id') in model_ids
-
-    def cast_payload(self, payload):
-        return payload
+    def decode(self, payload):
+        return self.schema.decode(payload)
 
 class VINDSTYRKA:
     timeseries_name = 'air-quality'
+    model_ids = (
+        'VINDSTYRKA',
+    )
+
+    schema = PayloadSchema({
+        "humidity": Field(float),
+        "temperature": Field(float),
+        "pm25": Field(int),
+        "voc_index": Field(int),
+        "linkquality": Field(int),
+    })
 
     def friendly_name_to_id(self, friendly_name):
         split_friendly_name = friendly_name.split("/")
@@ -323,17 +556,7 @@ class VINDSTYRKA:
         }
 
     def match_device(self, device_definition):
-        model_ids = [
-            'VINDSTYRKA'
-        ]
-
-        return device_definition.get('model_id') in model_ids
+        return device_definition.get('model_id') in self.model_ids
 
-    def cast_payload(self, payload):
-        return {
-            "humidity": payload["humidity"],
-            "temperature": payload["temperature"],
-            "pm25": payload["linkquality"],
-            "voc_index": payload["voc_index"],
-            "linkquality": payload["linkquality"],
-        }
+    def decode(self, payload):
+        return self.schema.decode(payload)
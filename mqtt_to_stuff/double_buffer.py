@@ -0,0 +1,54 @@
+import threading
+import time
+
+
+class DoubleBuffer:
+    """
+    Hands a buffer from the thread filling it to the thread writing it out.
+
+    There's one producer, the MQTT network thread, and it wraps every write
+    in ``acquire``/``release``. The consumer calls ``swap``, which puts a
+    fresh buffer in place and then waits for the producer to be done with the
+    old one before returning it, so nothing appended around the swap is lost
+    and the producer never takes a lock. Consumers are serialised among
+    themselves.
+
+    The handshake relies on attribute stores being atomic under the GIL: the
+    producer marks the buffer it is about to use as busy and then checks it
+    is still the active one, while the consumer replaces the active buffer
+    before checking what is busy. Either the consumer sees the old buffer
+    busy and waits, or the producer sees it was replaced and moves on to the
+    new one.
+    """
+
+    __slots__ = ("_factory", "_active", "_busy", "_swap_lock")
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._active = factory()
+        self._busy = None
+        self._swap_lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            buffer = self._active
+            self._busy = buffer
+            if buffer is self._active:
+                return buffer
+
+    def release(self):
+        self._busy = None
+
+    def peek(self):
+        """The active buffer, for reading only."""
+        return self._active
+
+    def swap(self):
+        with self._swap_lock:
+            old = self._active
+            self._active = self._factory()
+
+            while self._busy is old:
+                time.sleep(0)
+
+            return old
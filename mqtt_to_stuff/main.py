@@ -8,6 +8,8 @@ import polars
 from typing import Dict, Tuple
 from collections.abc import Callable
 
+from topics import TopicTrie
+
 
 labels = ['zone', 'area', 'thing']
 
@@ -75,11 +77,19 @@ def unsupported(zone, area, kind, thing, rest, payload):
     print("unsupported: " + kind)
 
 
+# format: devices/{zone}/{area}/{type}/{thing}/...
+# first matching filter wins
+routes = TopicTrie()
+routes.add("devices/+/+/plug/+/#", handle_esphome)
+routes.add("devices/+/+/presence/+/#", handle_esphome)
+routes.add("devices/+/+/lgtv/+/#", handle_lgtv)
+routes.add("devices/#", unsupported)
+
+
 def on_message(client, userdata, msg):
     payload = msg.payload.decode("utf-8")
 
-    # format: devices/{zone}/{area}/{type}/{thing}/...
-    if msg.topic.startswith("devices/"):
+    if handler := routes.first(msg.topic):
         try:
             _, zone, area, kind, thing, *rest = msg.topic.split("/")
         except ValueError as e:
@@ -87,18 +97,7 @@ def on_message(client, userdata, msg):
             print("exception: " + msg.topic)
             return
 
-        match kind:
-            case "plug":
-                handle_esphome(zone, area, kind, thing, rest, payload)
-
-            case "presence":
-                handle_esphome(zone, area, kind, thing, rest, payload)
-
-            case "lgtv":
-                handle_lgtv(zone, area, kind, thing, rest, payload)
-
-            case _:
-                unsupported(zone, area, kind, thing, rest, payload)
+        handler(zone, area, kind, thing, rest, payload)
 
     else:
         print(msg.topic)
@@ -0,0 +1,51 @@
+import functools
+import time
+
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.05, 0.1, 1.0)
+IO_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+ROW_BUCKETS = (1, 10, 100, 1_000, 10_000, 100_000, 1_000_000)
+
+messages = Counter("pipeline_messages", "MQTT messages handled, by first topic level", ["pipeline", "prefix"])
+callback_seconds = Histogram("pipeline_callback_seconds", "Time spent in on_message", ["pipeline"], buckets=LATENCY_BUCKETS)
+buffered_records = Gauge("pipeline_buffered_records", "Records waiting for the next flush", ["pipeline", "series"])
+buffered_bytes = Gauge("pipeline_buffered_bytes", "Estimated size of the records waiting for the next flush", ["pipeline", "series"])
+flush_seconds = Histogram("pipeline_flush_seconds", "Time taken by a flush", ["pipeline"], buckets=IO_BUCKETS)
+flush_rows = Histogram("pipeline_flush_rows", "Rows per table per flush", ["pipeline", "table"], buckets=ROW_BUCKETS)
+delta_write_seconds = Histogram("delta_write_seconds", "Time taken by a Delta append", ["table"], buckets=IO_BUCKETS)
+delta_compaction_seconds = Histogram("delta_compaction_seconds", "Time taken to compact and checkpoint a partition", ["table"], buckets=IO_BUCKETS)
+delta_write_failures = Counter("delta_write_failures", "Delta appends that failed and will be retried", ["table"])
+dropped_records = Counter("pipeline_dropped_records", "Records dropped on purpose or lost", ["pipeline", "reason"])
+worker_restarts = Counter("pipeline_worker_restarts", "Worker processes that died and were restarted", ["pipeline"])
+
+
+def start_metrics_server(port):
+    if port:
+        start_http_server(int(port))
+
+
+def instrument_callback(pipeline):
+    """Wrap an on_message callback to count messages per topic prefix and time it."""
+    by_prefix = {}
+    latency = callback_seconds.labels(pipeline)
+
+    def decorator(on_message):
+        @functools.wraps(on_message)
+        def wrapper(client, userdata, msg):
+            started = time.perf_counter()
+
+            prefix = msg.topic.partition("/")[0]
+            if (counter := by_prefix.get(prefix)) is None:
+                counter = by_prefix[prefix] = messages.labels(pipeline, prefix)
+            counter.inc()
+
+            try:
+                return on_message(client, userdata, msg)
+            finally:
+                latency.observe(time.perf_counter() - started)
+
+        return wrapper
+
+    return decorator
@@ -1,87 +1,322 @@
 import argparse
 import sys
-import datetime
 import logging
 import os
 import signal
+import socket
 import time
 import threading
+from array import array
+from collections import OrderedDict
 
 import paho.mqtt.client as mqtt
-import deltalake
 import polars as pl
 
+import metrics
+import schemas
+from compaction import CompactionPolicy, CompactionScheduler
+from delta_client import DeltaLakeClient, storage_options_from_env
+from spool import Spool
+from topics import TopicTrie
+
 logging.basicConfig(encoding='utf-8', level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-buffer = []
-buffer_lock = threading.Lock()
+RAW_SCHEMA = {
+    "topic": pl.String,
+    "arrival_timestamp": pl.Datetime("us"),
+    "payload": pl.String,
+    "retain": pl.Boolean,
+}
+
+RAW_MQTT = schemas.register("raw-mqtt", {
+    **RAW_SCHEMA,
+    # only written with deduplication, see PayloadDeduplicator
+    "last_seen": pl.Datetime("us"),
+    "count": pl.Int64,
+    "writer_id": pl.String,
+    "date": pl.Date,
+})
+
+# tells apart the rows of replicas sharing one subscription
+WRITER_ID = socket.gethostname()
+
+# rough per-record cost of the str headers and list slots on top of the raw bytes
+RECORD_OVERHEAD = 120
+
+
+class RawBatchBuilder:
+    """
+    Column-wise storage for one batch of raw messages.
+
+    Timestamps and retain flags go into typed arrays rather than Python
+    objects, and ``to_frame`` builds the DataFrame with RAW_SCHEMA, so there's
+    no dict per message and no schema inference at flush time.
+
+    With ``runs`` every row is a run of identical payloads on its topic:
+    ``extend`` counts a repeat against the topic's last row, and the frame
+    gets the ``last_seen`` and ``count`` of each run, arrival_timestamp being
+    when it was first seen.
+    """
+
+    __slots__ = ("topics", "timestamps", "payloads", "retains", "last_seen", "counts", "_rows", "_utc_offset")
+
+    def __init__(self, runs=False):
+        self.topics = []
+        self.timestamps = array("q")
+        self.payloads = []
+        self.retains = bytearray()
+        self.last_seen = array("q") if runs else None
+        self.counts = array("q") if runs else None
+        # row of each topic's latest run
+        self._rows = {} if runs else None
+        # arrival_timestamp has always been naive local time
+        self._utc_offset = time.localtime().tm_gmtoff * 1_000_000
+
+    def append(self, topic, payload, retain):
+        timestamp = time.time_ns() // 1000 + self._utc_offset
+
+        self.topics.append(topic)
+        self.timestamps.append(timestamp)
+        self.payloads.append(payload)
+        self.retains.append(retain)
+
+        if self._rows is not None:
+            self._rows[topic] = len(self.topics) - 1
+            self.last_seen.append(timestamp)
+            self.counts.append(1)
+
+    def extend(self, topic):
+        """Count a repeat of ``topic``'s last payload, if its run started in this batch."""
+        if self._rows is None or (row := self._rows.get(topic)) is None:
+            return False
+
+        self.last_seen[row] = time.time_ns() // 1000 + self._utc_offset
+        self.counts[row] += 1
+        return True
+
+    def __len__(self):
+        return len(self.topics)
+
+    def to_frame(self):
+        columns = [
+            pl.Series("topic", self.topics, dtype=RAW_SCHEMA["topic"]),
+            pl.Series("arrival_timestamp", self.timestamps, dtype=pl.Int64).cast(RAW_SCHEMA["arrival_timestamp"]),
+            pl.Series("payload", self.payloads, dtype=RAW_SCHEMA["payload"]),
+            pl.Series("retain", self.retains, dtype=pl.UInt8).cast(RAW_SCHEMA["retain"]),
+        ]
+
+        if self._rows is not None:
+            columns.append(pl.Series("last_seen", self.last_seen, dtype=pl.Int64).cast(RAW_MQTT.columns["last_seen"]))
+            columns.append(pl.Series("count", self.counts, dtype=RAW_MQTT.columns["count"]))
+
+        return pl.DataFrame(columns)
+
+
+class PayloadDeduplicator:
+    """
+    The hash of the last payload of up to ``max_topics`` topics.
+
+    ``repeated`` tells whether a payload is the same as the one before it on
+    its topic. Topics are evicted least recently seen first, after which
+    their next payload counts as new, so memory stays bounded however many
+    topics come and go.
+    """
+
+    def __init__(self, max_topics=100_000):
+        self.max_topics = max_topics
+        self._hashes = OrderedDict()
+
+    def __len__(self):
+        return len(self._hashes)
+
+    def repeated(self, topic, payload):
+        digest = hash(payload)
+        previous = self._hashes.pop(topic, None)
+        self._hashes[topic] = digest
+
+        if len(self._hashes) > self.max_topics:
+            self._hashes.popitem(last=False)
+
+        return previous == digest
+
+
+class RecordBuffer:
+    """
+    Messages waiting to be flushed, with limits on how big a batch may get.
+
+    A flush is requested once ``max_records`` or ``max_batch_bytes`` is
+    reached. Bytes taken for a flush stay accounted for until ``done`` is
+    called, and while buffered plus in-flight bytes are over
+    ``max_buffered_bytes`` ``append`` blocks. It's called from the paho network
+    thread, so blocking there stops reading from the socket and pushes back on
+    the broker instead of growing memory. On an event loop, where nothing may
+    block, ``block=False`` makes ``append`` take the record regardless, and
+    the caller stops reading while ``full`` until ``wait_until_not_full``
+    returns.
+
+    With a PayloadDeduplicator, a payload that repeats the last one on its
+    topic only extends that topic's run instead of adding a row. Runs are cut
+    at every flush, so each batch still tells when its topics were last seen.
+    """
+
+    def __init__(self, max_records=50_000, max_batch_bytes=64 * 1024 * 1024, max_buffered_bytes=256 * 1024 * 1024, dedup=None, block=True):
+        self.max_records = max_records
+        self.max_batch_bytes = max_batch_bytes
+        self.max_buffered_bytes = max_buffered_bytes
+        self.dedup = dedup
+        self.block = block
+        self._batch = RawBatchBuilder(runs=dedup is not None)
+        self._bytes = 0
+        self._in_flight = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        self._flush_requested = threading.Event()
+
+    def set_limits(self, max_records, max_batch_bytes, max_buffered_bytes):
+        with self._cond:
+            self.max_records = max_records
+            self.max_batch_bytes = max_batch_bytes
+            self.max_buffered_bytes = max_buffered_bytes
+            self._cond.notify_all()
+
+    def set_dedup(self, dedup):
+        """Start collapsing repeated payloads, right away if nothing's buffered yet, else from the next batch on."""
+        with self._cond:
+            self.dedup = dedup
+            if not len(self._batch):
+                self._batch = RawBatchBuilder(runs=dedup is not None)
+
+    def append(self, topic, payload, retain, size):
+        with self._cond:
+            while self.block and not self._closed and self._full():
+                self._flush_requested.set()
+                logger.warning("Buffer full (%d bytes), pausing until a flush completes", self._bytes + self._in_flight)
+                self._cond.wait()
+
+            if self.dedup is not None and self.dedup.repeated(topic, payload) and self._batch.extend(topic):
+                collapsed.inc()
+                return
+
+            self._batch.append(topic, payload, retain)
+            self._bytes += size
+
+            if len(self._batch) >= self.max_records or self._bytes >= self.max_batch_bytes or self._full():
+                self._flush_requested.set()
+
+    def take(self):
+        with self._cond:
+            batch = self._batch
+            size = self._bytes
+            self._batch = RawBatchBuilder(runs=self.dedup is not None)
+            self._bytes = 0
+            self._in_flight += size
+            self._flush_requested.clear()
+
+        return batch, size
+
+    def done(self, size):
+        with self._cond:
+            self._in_flight -= size
+            self._cond.notify_all()
+
+    def __len__(self):
+        return len(self._batch)
+
+    def _full(self):
+        return self._bytes + self._in_flight >= self.max_buffered_bytes
+
+    def full(self):
+        with self._cond:
+            return self._full()
+
+    def wait_until_not_full(self, timeout=None):
+        """Block until a flush has made room, or the buffer is closed."""
+        with self._cond:
+            return self._cond.wait_for(lambda: self._closed or not self._full(), timeout)
+
+    def buffered_bytes(self):
+        return self._bytes + self._in_flight
+
+    def wait_for_flush(self, timeout):
+        return self._flush_requested.wait(timeout)
+
+    def close(self):
+        """Stop blocking producers, e.g. so shutdown can get past a full buffer, and wake the flusher."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._flush_requested.set()
+
+
+buffer = RecordBuffer()
+
+
+ignored = metrics.dropped_records.labels("raw_to_delta", "ignored")
+spool_failed = metrics.dropped_records.labels("raw_to_delta", "spool_failed")
+# repeats counted against a run rather than stored as rows of their own
+collapsed = metrics.dropped_records.labels("raw_to_delta", "collapsed")
+
+
+@metrics.instrument_callback("raw_to_delta")
+def on_message(client, userdata, msg):
+    if userdata and userdata.match(msg.topic):
+        logger.debug("ignored %s", msg.topic)
+        ignored.inc()
+        return
 
+    payload = msg.payload.decode("utf-8", errors="replace")
+    logger.debug("recv %s retain=%s %s", msg.topic, bool(msg.retain), payload)
+    buffer.append(msg.topic, payload, msg.retain, len(msg.topic) + len(msg.payload) + RECORD_OVERHEAD)
 
-class DeltaLakeClient:
-    def __init__(self, base_path, storage_options):
-        self._base_path = base_path
-        self._storage_options = storage_options
-        self._logger = logging.getLogger(self.__class__.__name__)
 
-    def append(self, df, path, write_options=None):
-        if write_options is None:
-            write_options = {}
+def do_flush(spool, writer_id=WRITER_ID):
+    batch, size = buffer.take()
+    if not len(batch):
+        buffer.done(size)
+        return
 
-        write_options["writer_properties"] = deltalake.WriterProperties(compression="zstd")
+    started = time.perf_counter()
 
-        df.write_delta(
-            self._base_path + path,
-            delta_write_options=write_options,
-            storage_options=self._storage_options,
-            mode="append",
+    try:
+        df = batch.to_frame().with_columns(
+            writer_id=pl.lit(writer_id, dtype=pl.String),
+            date=pl.col("arrival_timestamp").dt.date(),
         )
+        spool.append(df, "raw-mqtt", RAW_MQTT.write_options)
+        metrics.flush_rows.labels("raw_to_delta", "raw-mqtt").observe(len(df))
+    except Exception:
+        logger.exception("Failed to spool batch")
+        spool_failed.inc(len(batch))
+    finally:
+        buffer.done(size)
+        metrics.flush_seconds.labels("raw_to_delta").observe(time.perf_counter() - started)
 
-        self._logger.info("Wrote %s records to %s", len(df), self._base_path + path)
 
-        dt = deltalake.DeltaTable(self._base_path + path, storage_options=self._storage_options)
-        if len(dt.file_uris()) >= 60:
-            dt.optimize.compact()
-            dt.create_checkpoint()
-            self._logger.info("Compacted %s", path)
+def expose_buffer_metrics():
+    metrics.buffered_records.labels("raw_to_delta", "raw-mqtt").set_function(buffer.__len__)
+    metrics.buffered_bytes.labels("raw_to_delta", "raw-mqtt").set_function(buffer.buffered_bytes)
 
 
-def on_message(client, userdata, msg):
-    ignored_topics = userdata or []
-    if any(mqtt.topic_matches_sub(pattern, msg.topic) for pattern in ignored_topics):
-        logger.debug("ignored %s", msg.topic)
-        return
+def flush_buffer(spool, interval, writer_id=WRITER_ID):
+    """Flush every ``interval`` seconds, or sooner when the buffer asks for it."""
+    while True:
+        buffer.wait_for_flush(interval)
+        do_flush(spool, writer_id)
 
-    payload = msg.payload.decode("utf-8", errors="replace")
-    logger.debug("recv %s retain=%s %s", msg.topic, bool(msg.retain), payload)
-    record = {
-        "topic": msg.topic,
-        "arrival_timestamp": datetime.datetime.now(),
-        "payload": payload,
-        "retain": bool(msg.retain),
-    }
-    with buffer_lock:
-        buffer.append(record)
-
-
-def do_flush(dlc):
-    with buffer_lock:
-        if not buffer:
-            return
-        batch = buffer.copy()
-        buffer.clear()
 
-    try:
-        df = pl.DataFrame(batch).with_columns(date=pl.col("arrival_timestamp").dt.date())
-        dlc.append(df, "raw-mqtt", {"partition_by": ["date"]})
-    except Exception:
-        logger.exception("Failed to write batch to Delta Lake")
+def shared(topic, group):
+    """``topic`` as an MQTT v5 shared subscription, so the broker splits its messages between the group's clients."""
+    if group is None:
+        return topic
 
+    return "$share/%s/%s" % (group, topic)
 
-def flush_buffer(dlc, interval):
-    while True:
-        time.sleep(interval)
-        do_flush(dlc)
+
+def share_group(name):
+    if not name or any(c in name for c in "/+#"):
+        raise argparse.ArgumentTypeError("share group names can't be empty or contain /, + or #")
+    return name
 
 
 def generate_on_connect(topics):
@@ -98,27 +333,56 @@ def main(args):
     parser.add_argument("--host", help="The MQTT host address.", default=os.environ.get('MQTT_HOST'))
     parser.add_argument("-d", "--delta-path", dest="delta_path", help="Base path for DeltaLake tables", default=os.environ.get('DELTA_PATH', '/tmp/deltalake/'))
     parser.add_argument("-i", "--interval", type=int, help="Batch write interval in seconds", default=os.environ.get('INTERVAL', 60))
+    parser.add_argument("--spool-path", dest="spool_path", help="Local directory batches are staged in before upload", default=os.environ.get('SPOOL_PATH', '/tmp/spool/raw-to-delta/'))
+    parser.add_argument("--max-records", dest="max_records", type=int, help="Flush once this many messages are buffered", default=os.environ.get('MAX_RECORDS', 50_000))
+    parser.add_argument("--max-batch-bytes", dest="max_batch_bytes", type=int, help="Flush once the buffered messages reach this estimated size", default=os.environ.get('MAX_BATCH_BYTES', 64 * 1024 * 1024))
+    parser.add_argument("--max-buffered-bytes", dest="max_buffered_bytes", type=int, help="Stop reading from the broker while buffered and in-flight messages exceed this size", default=os.environ.get('MAX_BUFFERED_BYTES', 256 * 1024 * 1024))
+    parser.add_argument("--metrics-port", dest="metrics_port", type=int, help="Port to expose Prometheus metrics on, 0 to disable", default=os.environ.get('METRICS_PORT', 9104))
     parser.add_argument("--ignore", dest="ignored_topics", action="append", default=[], metavar="TOPIC", help="Topic filter to ignore (repeatable, supports MQTT wildcards)")
+    parser.add_argument("--share-group", dest="share_group", type=share_group, help="Subscribe as a member of this MQTT v5 shared subscription group, splitting messages with the group's other replicas. Brokers don't send retained messages to shared subscriptions.", default=os.environ.get('SHARE_GROUP'))
+    parser.add_argument("--compaction", action=argparse.BooleanOptionalAction, help="Compact raw-mqtt from this process. On by default, off with --share-group, where only one replica may compact.", default=os.environ.get('COMPACTION'))
+    parser.add_argument("--dedup", action=argparse.BooleanOptionalAction, help="Collapse payloads that repeat the last one on their topic into runs with a last_seen and count", default=os.environ.get('DEDUP', '').lower() in ("1", "true", "yes"))
+    parser.add_argument("--dedup-max-topics", dest="dedup_max_topics", type=int, help="Topics whose last payload is remembered for --dedup", default=os.environ.get('DEDUP_MAX_TOPICS', 100_000))
+    parser.add_argument("--writer-id", dest="writer_id", help="Written to the writer_id column, and the MQTT client id with --share-group, so it has to be unique per replica", default=os.environ.get('WRITER_ID', WRITER_ID))
 
     args = parser.parse_args()
 
-    options = {}
-    if S3_ENDPOINT := os.environ.get('AWS_ENDPOINT_URL_S3'):
-        options["endpoint_url"] = S3_ENDPOINT
-    options["AWS_SESSION_TOKEN"] = os.environ.get('AWS_SESSION_TOKEN', "")
+    buffer.set_limits(args.max_records, args.max_batch_bytes, args.max_buffered_bytes)
+    if args.dedup:
+        buffer.set_dedup(PayloadDeduplicator(args.dedup_max_topics))
+
+    expose_buffer_metrics()
+    metrics.start_metrics_server(args.metrics_port)
+
+    dlc = DeltaLakeClient(args.delta_path, storage_options_from_env())
+    if args.compaction is None:
+        args.compaction = args.share_group is None
+    elif isinstance(args.compaction, str):
+        args.compaction = args.compaction.lower() in ("1", "true", "yes")
+
+    if args.compaction:
+        CompactionScheduler(dlc, CompactionPolicy(max_files=60)).start()
 
-    dlc = DeltaLakeClient(args.delta_path, options)
+    spool = Spool(args.spool_path, dlc)
+    spool.start()
 
-    flush_thread = threading.Thread(target=flush_buffer, args=(dlc, args.interval), daemon=True)
+    flush_thread = threading.Thread(target=flush_buffer, args=(spool, args.interval, args.writer_id), daemon=True)
     flush_thread.start()
 
-    mqttc = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
-    mqttc.on_connect = generate_on_connect(["#"])
+    if args.share_group is None:
+        mqttc = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+    else:
+        mqttc = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=args.writer_id, protocol=mqtt.MQTTv5)
+    mqttc.on_connect = generate_on_connect([shared("#", args.share_group)])
     mqttc.on_message = on_message
-    mqttc.user_data_set(args.ignored_topics)
+    ignored_topics = TopicTrie()
+    for pattern in args.ignored_topics:
+        ignored_topics.add(pattern)
+    mqttc.user_data_set(ignored_topics)
 
     def handle_shutdown(signum, frame):
         logger.info("Received signal %d, shutting down", signum)
+        buffer.close()
         mqttc.disconnect()
 
     signal.signal(signal.SIGTERM, handle_shutdown)
@@ -128,7 +392,8 @@ def main(args):
     mqttc.loop_forever()
 
     logger.info("Flushing remaining messages before exit")
-    do_flush(dlc)
+    do_flush(spool, args.writer_id)
+    spool.drain()
 
     return 0
 
@@ -1,24 +1,61 @@
 import datetime
+import sys
+
+import polars as pl
+
+import schemas
+from double_buffer import DoubleBuffer
+
+# the columns every Series row starts with
+SOURCE_SCHEMA = {
+    "timestamp": pl.Datetime("us"),
+    "zone": pl.String,
+    "area": pl.String,
+    "thing": pl.String,
+}
 
 class DeviceRegister:
-    type_map = {}
-    devices = {}
-    series = {}
+    def __init__(self):
+        self.type_map = {}
+        self.devices = {}
+        self.series = {}
 
     def add_device_type(self, kind, klass):
         self.type_map[kind] = klass
 
+        for series in self.series.values():
+            self._register_schema(series)
+
     def add_series(self, series):
         self.series[series.name] = series
-
-    def append_data(self, kind, key, rest, value):
+        self._register_schema(series)
+
+    def _register_schema(self, series):
+        """Declare the columns ``series`` gets from the device types that feed it."""
+        columns = dict(SOURCE_SCHEMA)
+        for klass in self.type_map.values():
+            for column_name, dtype in klass.schema.dtypes.get(series.name, {}).items():
+                # e.g. uptime is an int on some devices and a float on others
+                columns[column_name] = pl.Float64 if columns.get(column_name, dtype) != dtype else dtype
+
+        if series.window is not None:
+            for column_name, dtype in list(columns.items())[len(SOURCE_SCHEMA):]:
+                if dtype.is_numeric():
+                    columns[column_name + "_min"] = dtype
+                    columns[column_name + "_max"] = dtype
+                    columns[column_name + "_mean"] = pl.Float64
+            columns["samples"] = pl.Int64
+
+        series.schema = schemas.register(series.name, {**columns, "date": pl.Date})
+
+    def append_data(self, kind, key, rest, value, timestamp=None):
         if device := self.get_or_create(kind, key):
             if series_and_record := device.set(rest, value):
                 series_name = series_and_record[0]
                 record = series_and_record[1]
 
-                if series := self.series.get(series_name):
-                    series.append(datetime.datetime.now(), key, record)
+                if (series := self.series.get(series_name)) is not None:
+                    series.append(timestamp or datetime.datetime.now(), key, record)
                     return
                 else:
                     raise Exception("Undefined series: %s" % series_name)
@@ -47,37 +84,171 @@ class DeviceRegister:
         return records
 
 
+class WindowAggregate:
+    """
+    Running aggregates of one source's records over one tumbling window.
+
+    Numeric columns keep min, max, sum and last; anything else (booleans
+    included) only keeps the last value.
+    """
+
+    __slots__ = ("start", "count", "numeric", "other")
+
+    def __init__(self, start):
+        self.start = start
+        self.count = 0
+        self.numeric = {}
+        self.other = {}
+
+    def add(self, record):
+        self.count += 1
+
+        for column_name, value in record:
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                if (agg := self.numeric.get(column_name)) is None:
+                    self.numeric[column_name] = [value, value, value, value]
+                else:
+                    if value < agg[0]:
+                        agg[0] = value
+                    if value > agg[1]:
+                        agg[1] = value
+                    agg[2] += value
+                    agg[3] = value
+            else:
+                self.other[column_name] = value
+
+    def record(self):
+        items = list(self.other.items())
+
+        for column_name, (minimum, maximum, total, last) in self.numeric.items():
+            items.append((column_name, last))
+            items.append((column_name + "_min", minimum))
+            items.append((column_name + "_max", maximum))
+            items.append((column_name + "_mean", total / self.count))
+
+        items.append(("samples", self.count))
+
+        return items
+
+
 class Series:
-    def __init__(self, name, throttle : int | float | None = None):
+    """
+    Rows for one table, stored column by column.
+
+    Each append adds one value to every column; a column first seen part way
+    through a batch is back-filled with None so all columns stay the same
+    length. ``take`` swaps the columns out through a DoubleBuffer and hands
+    them to Polars as they are, typed by ``schema`` (which DeviceRegister
+    declares from the device types feeding the series), so the writer thread
+    never races the MQTT thread for them and nothing is inferred.
+
+    With a ``window`` (in seconds) records aren't stored as they come in.
+    They're folded into a WindowAggregate per source, and one row per source
+    and tumbling window is stored once the window is over: the last value of
+    every column under its own name, plus ``_min``, ``_max`` and ``_mean`` of
+    the numeric ones and the number of ``samples``, timestamped with the
+    window's start. ``throttle`` is ignored for windowed series. Windows are
+    closed by the appending thread as later records come in, and by
+    ``close_windows`` once nothing is appending any more.
+    """
+
+    def __init__(self, name, throttle : int | float | None = None, window : int | float | None = None):
         self.name = name
-        self.records = []
         self.last_updates_by_source = {}
         self.throttle = throttle
+        self.window = window
+        self.windows_by_source = {}
+        self._next_close = float("inf")
+        self._buffer = DoubleBuffer(lambda: {"timestamp": []})
+        self.schema = schemas.TableSchema(name, SOURCE_SCHEMA)
+
+    def __len__(self):
+        return len(self._buffer.peek()["timestamp"])
+
+    def estimated_size(self):
+        """Rough size of what's waiting to be taken: the lists plus a boxed value per cell."""
+        columns = list(self._buffer.peek().values())
+        return sum(sys.getsizeof(c) + len(c) * 32 for c in columns)
 
     def append(self, timestamp, source, record):
-        thing = (
-            ('timestamp', timestamp),
-            source,
-            record
-        )
-        #print(datetime.datetime.now(), "appended:", self.name, thing[1], record)
+        #print(datetime.datetime.now(), "appended:", self.name, source, record)
 
-        throttled = False
+        columns = self._buffer.acquire()
+        try:
+            if self.window is not None:
+                self._aggregate(columns, timestamp, source, record)
+                return
 
-        last_update = self.last_updates_by_source.get(source, 0)
+            throttled = False
 
-        if self.throttle is not None and last_update > 0:
-            if timestamp.timestamp() < (last_update + self.throttle):
-                throttled = True
+            last_update = self.last_updates_by_source.get(source, 0)
 
-        if not throttled:
-            self.records.append(thing)
-            self.last_updates_by_source[source] = timestamp.timestamp()
-            print(timestamp, source, record)
+            if self.throttle is not None and last_update > 0:
+                if timestamp.timestamp() < (last_update + self.throttle):
+                    throttled = True
 
+            if not throttled:
+                self._store(columns, timestamp, source, record)
+                self.last_updates_by_source[source] = timestamp.timestamp()
+                print(timestamp, source, record)
+        finally:
+            self._buffer.release()
 
-    def to_list(self):
-        return [ dict(**{"timestamp": r[0][1]}, **dict(r[1]), **dict(r[2])) for r in self.records ]
+    def _aggregate(self, columns, timestamp, source, record):
+        seconds = timestamp.timestamp()
+        start = seconds - seconds % self.window
+
+        if seconds >= self._next_close:
+            self._close_windows(columns, seconds)
+
+        aggregate = self.windows_by_source.get(source)
+
+        if aggregate is None:
+            aggregate = self.windows_by_source[source] = WindowAggregate(start)
+            self._next_close = min(self._next_close, start + self.window)
+
+        aggregate.add(record)
+
+    def _close_windows(self, columns, until):
+        for source, aggregate in list(self.windows_by_source.items()):
+            if until is None or aggregate.start + self.window <= until:
+                timestamp = datetime.datetime.fromtimestamp(aggregate.start)
+                record = aggregate.record()
+                self._store(columns, timestamp, source, record)
+                print(timestamp, source, record)
+                del self.windows_by_source[source]
+
+        self._next_close = min(
+            (a.start + self.window for a in self.windows_by_source.values()),
+            default=float("inf")
+        )
 
-    def clear(self):
-        self.records.clear()
+    def _store(self, columns, timestamp, source, record):
+        length = len(columns["timestamp"])
+        columns["timestamp"].append(timestamp)
+
+        for items in (source, record):
+            for column_name, value in items:
+                if (column := columns.get(column_name)) is None:
+                    column = columns[column_name] = [None] * length
+                column.append(value)
+
+        for column in columns.values():
+            if len(column) == length:
+                column.append(None)
+
+    def close_windows(self, until=None):
+        """
+        Store the windows that ended before ``until``, or all of them.
+
+        Only call this from the appending thread, or once it has stopped.
+        """
+        columns = self._buffer.acquire()
+        try:
+            self._close_windows(columns, None if until is None else until.timestamp())
+        finally:
+            self._buffer.release()
+
+    def take(self):
+        """Swap out everything stored so far and return it as a DataFrame typed by ``schema``."""
+        return self.schema.frame(self._buffer.swap())
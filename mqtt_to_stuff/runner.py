@@ -0,0 +1,267 @@
+import argparse
+import asyncio
+import functools
+import logging
+import os
+import signal
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import paho.mqtt.client as mqtt
+
+import aio
+import metrics
+import raw_to_delta
+import to_delta
+import zigbee_to_delta
+from compaction import CompactionPolicy, CompactionScheduler
+from delta_client import DeltaLakeClient, storage_options_from_env
+from spool import Spool
+from topics import TopicTrie, covers
+
+logger = logging.getLogger(__name__)
+
+PIPELINES = ["raw_to_delta", "to_delta", "zigbee_to_delta", "esphome_metrics"]
+
+
+class Pipeline:
+    """
+    One ingester as the runner drives it.
+
+    ``topics`` are the filters it wants messages for, ``on_message`` and
+    ``userdata`` are what it would have given its own paho client. ``flush``
+    is called with the spool every ``interval`` seconds, or when ``wake``
+    returns early, and ``final_flush`` writes what's left once the
+    connection is closed. While ``full()``, reading from the broker is
+    paused until ``wait_until_not_full`` returns.
+    """
+
+    def __init__(self, name, topics, on_message, userdata=None, flush=None, interval=None, wake=None, final_flush=None, full=None, wait_until_not_full=None):
+        self.name = name
+        self.topics = topics
+        self.on_message = on_message
+        self.userdata = userdata
+        self.flush = flush
+        self.interval = interval
+        self.wake = wake
+        self.final_flush = final_flush
+        self.full = full
+        self.wait_until_not_full = wait_until_not_full
+
+
+class Dispatcher:
+    """
+    Fans each message from one connection out to every pipeline that wants it.
+
+    Pipelines are routed through a TopicTrie, so a message costs one match
+    whatever the number of pipelines, and a pipeline whose callback raises
+    doesn't keep the message from the others.
+    """
+
+    def __init__(self):
+        self.routes = TopicTrie()
+        self.topics = []
+
+    def add(self, pipeline):
+        for topic in pipeline.topics:
+            self.routes.add(topic, pipeline)
+            self.topics.append(topic)
+
+    def subscriptions(self):
+        """The filters to subscribe to, leaving out any another one already covers."""
+        subscriptions = []
+        for topic in self.topics:
+            if not any(covers(other, topic) for other in subscriptions):
+                subscriptions = [other for other in subscriptions if not covers(topic, other)]
+                subscriptions.append(topic)
+
+        return subscriptions
+
+    def on_message(self, client, userdata, msg):
+        # a pipeline with overlapping filters still gets the message once
+        for pipeline in dict.fromkeys(self.routes.match(msg.topic)):
+            try:
+                pipeline.on_message(client, pipeline.userdata, msg)
+            except Exception:
+                logger.exception("%s failed on %s", pipeline.name, msg.topic)
+
+
+def raw_pipeline(args):
+    ignored_topics = TopicTrie()
+    for pattern in args.ignored_topics:
+        ignored_topics.add(pattern)
+
+    if args.raw_dedup:
+        raw_to_delta.buffer.set_dedup(raw_to_delta.PayloadDeduplicator())
+
+    raw_to_delta.expose_buffer_metrics()
+    # on_message runs on the event loop, which mustn't wait for a flush
+    raw_to_delta.buffer.block = False
+
+    return Pipeline(
+        "raw_to_delta",
+        ["#"],
+        raw_to_delta.on_message,
+        userdata=ignored_topics,
+        flush=raw_to_delta.do_flush,
+        interval=args.raw_interval,
+        wake=raw_to_delta.buffer.wait_for_flush,
+        final_flush=raw_to_delta.do_flush,
+        full=raw_to_delta.buffer.full,
+        wait_until_not_full=raw_to_delta.buffer.wait_until_not_full,
+    )
+
+
+def to_delta_pipeline(args, compactor):
+    register = to_delta.build_register()
+    to_delta.expose_buffer_metrics(register)
+
+    for series in register.series.values():
+        compactor.set_policy(series.name, CompactionPolicy(max_files=24))
+
+    return Pipeline(
+        "to_delta",
+        ["devices/#"],
+        metrics.instrument_callback("to_delta")(to_delta.generate_on_message(register)),
+        flush=lambda spool: to_delta.write(register, spool),
+        interval=args.to_delta_interval,
+        final_flush=lambda spool: to_delta.write(register, spool, final=True),
+    )
+
+
+def zigbee_pipeline(args, dlc, spool):
+    zigbee_to_delta.ZDR.set_deltalakeclient(dlc)
+    zigbee_to_delta.ZDR.load_persisted_mappings()
+    zigbee_to_delta.ZDR.set_spool(spool)
+    zigbee_to_delta.expose_buffer_metrics()
+
+    return Pipeline(
+        "zigbee_to_delta",
+        ["zigbee2mqtt/#"],
+        zigbee_to_delta.on_message,
+        flush=lambda spool: zigbee_to_delta.ZDR.write_all_and_clear(args.delta_path),
+        interval=args.zigbee_interval,
+        final_flush=lambda spool: zigbee_to_delta.ZDR.write_all_and_clear(args.delta_path),
+    )
+
+
+def esphome_metrics_pipeline(args):
+    # main.py exports ESPHome readings as Prometheus metrics and registers
+    # them on import, so it's only imported when asked for
+    import main as esphome_metrics
+
+    return Pipeline("esphome_metrics", ["devices/#"], esphome_metrics.on_message)
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description="Run several ingest pipelines off one MQTT connection.")
+    parser.add_argument("--host", help="The MQTT host address.", default=os.environ.get('MQTT_HOST'))
+    parser.add_argument("-p", "--pipelines", type=lambda s: s.split(","), help="Comma separated pipelines to run, out of %s" % ", ".join(PIPELINES), default=os.environ.get('PIPELINES', "raw_to_delta,to_delta,zigbee_to_delta").split(","))
+    parser.add_argument("-d", "--delta-path", dest="delta_path", help="Base path for DeltaLake tables", default=os.environ.get('DELTA_PATH', '/tmp/deltalake/'))
+    parser.add_argument("--spool-path", dest="spool_path", help="Local directory batches are staged in before upload", default=os.environ.get('SPOOL_PATH', '/tmp/spool/runner/'))
+    parser.add_argument("--upload-workers", dest="upload_workers", type=int, help="Tables uploaded in parallel, shared by all pipelines", default=os.environ.get('UPLOAD_WORKERS', 4))
+    parser.add_argument("--raw-interval", dest="raw_interval", type=int, help="raw_to_delta batch write interval in seconds", default=os.environ.get('RAW_INTERVAL', 60))
+    parser.add_argument("--to-delta-interval", dest="to_delta_interval", type=int, help="to_delta batch write interval in seconds", default=os.environ.get('TO_DELTA_INTERVAL', 300))
+    parser.add_argument("--zigbee-interval", dest="zigbee_interval", type=int, help="zigbee_to_delta batch write interval in seconds", default=os.environ.get('ZIGBEE_INTERVAL', 60))
+    parser.add_argument("--ignore", dest="ignored_topics", action="append", default=[], metavar="TOPIC", help="Topic filter raw_to_delta ignores (repeatable, supports MQTT wildcards)")
+    parser.add_argument("--raw-dedup", dest="raw_dedup", action=argparse.BooleanOptionalAction, help="Collapse repeated payloads in raw-mqtt into runs", default=os.environ.get('RAW_DEDUP', '').lower() in ("1", "true", "yes"))
+    parser.add_argument("--metrics-port", dest="metrics_port", type=int, help="Port to expose Prometheus metrics on, 0 to disable", default=os.environ.get('METRICS_PORT', 9100))
+    parser.add_argument("--log-level", dest="log_level", help="Logging level for every pipeline", default=os.environ.get('LOG_LEVEL', 'INFO'))
+
+    args = parser.parse_args(args)
+
+    if unknown := set(args.pipelines) - set(PIPELINES):
+        parser.error("unknown pipelines: %s" % ", ".join(sorted(unknown)))
+
+    # the pipeline modules each configure logging for themselves on import
+    logging.getLogger().setLevel(args.log_level)
+
+    dlc = DeltaLakeClient(args.delta_path, storage_options_from_env())
+    compactor = CompactionScheduler(dlc, CompactionPolicy(max_files=60))
+
+    spool = Spool(args.spool_path, dlc, max_workers=args.upload_workers)
+
+    pipelines = []
+    if "raw_to_delta" in args.pipelines:
+        pipelines.append(raw_pipeline(args))
+    if "to_delta" in args.pipelines:
+        pipelines.append(to_delta_pipeline(args, compactor))
+    if "zigbee_to_delta" in args.pipelines:
+        pipelines.append(zigbee_pipeline(args, dlc, spool))
+    if "esphome_metrics" in args.pipelines:
+        pipelines.append(esphome_metrics_pipeline(args))
+
+    metrics.start_metrics_server(args.metrics_port)
+    compactor.start()
+    spool.start()
+
+    dispatcher = Dispatcher()
+    for pipeline in pipelines:
+        dispatcher.add(pipeline)
+
+    asyncio.run(serve(args, pipelines, dispatcher, spool))
+
+    return 0
+
+
+async def serve(args, pipelines, dispatcher, spool):
+    """
+    Run the MQTT client on the event loop and each pipeline's flushes as a
+    task next to it, until SIGTERM or SIGINT.
+
+    Messages are dispatched on the loop thread. Flushes, which block on
+    Polars and the disk, run on an executor with a thread per pipeline, so a
+    pipeline has at most one flush running and never holds up the others.
+    Uploads and compaction stay on the Spool's and CompactionScheduler's
+    own workers.
+    """
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=len(pipelines), thread_name_prefix="flush")
+    stopping = asyncio.Event()
+
+    def handle_shutdown(signum):
+        logger.info("Received signal %d, shutting down", signum)
+        stopping.set()
+        # unblocks an append waiting on a full buffer, and wakes raw_to_delta's flush task
+        raw_to_delta.buffer.close()
+
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, handle_shutdown, signum)
+
+    flushes = [
+        asyncio.create_task(aio.every(p.interval, functools.partial(p.flush, spool), stopping, executor, p.wake))
+        for p in pipelines
+        if p.flush is not None
+    ]
+
+    topics = dispatcher.subscriptions()
+
+    mqttc = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+    mqttc.on_connect = raw_to_delta.generate_on_connect(topics)
+
+    helper = aio.AsyncioHelper(loop, mqttc)
+    pressure = [aio.Backpressure(helper, p.full, p.wait_until_not_full) for p in pipelines if p.full is not None]
+
+    def on_message(client, userdata, msg):
+        dispatcher.on_message(client, userdata, msg)
+        for p in pressure:
+            p.check()
+
+    mqttc.on_message = on_message
+
+    logger.info("Running %s, subscribed to %s", [p.name for p in pipelines], topics)
+
+    await aio.run_client(mqttc, args.host, 1883, 60, stopping, helper=helper)
+    # let flushes that are under way finish before the final ones
+    await asyncio.gather(*flushes)
+
+    for pipeline in pipelines:
+        if pipeline.final_flush is not None:
+            await loop.run_in_executor(executor, pipeline.final_flush, spool)
+
+    await loop.run_in_executor(executor, spool.drain)
+    executor.shutdown()
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
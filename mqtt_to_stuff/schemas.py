@@ -0,0 +1,87 @@
+import threading
+from types import MappingProxyType
+
+import polars as pl
+from deltalake.exceptions import SchemaMismatchError
+
+
+class TableSchema:
+    """
+    The columns of one Delta table and their dtypes.
+
+    Frames for the table are built with ``frame``, so flushes never infer
+    types, and written with ``write_options``, which lets Delta add new
+    columns to the table.
+    """
+
+    __slots__ = ("name", "columns", "partition_by")
+
+    def __init__(self, name, columns, partition_by=("date",)):
+        self.name = name
+        self.columns = MappingProxyType(dict(columns))
+        self.partition_by = list(partition_by)
+
+    def merge(self, columns):
+        """This schema with ``columns`` added; a column in both gets a type that holds either."""
+        merged = pl.concat(
+            [pl.DataFrame(schema=dict(self.columns)), pl.DataFrame(schema=dict(columns))],
+            how="diagonal_relaxed",
+        ).schema
+
+        return TableSchema(self.name, merged, self.partition_by)
+
+    def frame(self, data):
+        """
+        A frame typed by this schema, from a dict of columns or a list of row dicts.
+
+        Columns of a dict the schema doesn't declare are kept, with the
+        narrowest type that holds all their values. Rows only keep the
+        declared columns, apart from the partition columns, which are derived
+        after the fact. Values aren't cast: one that doesn't fit its column's
+        type raises SchemaMismatchError instead of being truncated or nulled.
+        """
+        if not isinstance(data, dict):
+            # polars casts row values to the schema silently, column values
+            # it checks
+            data = {
+                c: [row.get(c) for row in data]
+                for c in self.columns if c not in self.partition_by
+            }
+
+        try:
+            return pl.DataFrame([
+                pl.Series(c, values, dtype=self.columns[c]) if c in self.columns
+                # ints and floats from different devices come out as floats
+                else pl.Series(c, values, strict=False)
+                for c, values in data.items()
+            ])
+        except (TypeError, pl.exceptions.PolarsError) as e:
+            raise SchemaMismatchError("%s doesn't fit its schema: %s" % (self.name, e)) from e
+
+    @property
+    def write_options(self):
+        options = {"schema_mode": "merge"}
+        if self.partition_by:
+            options["partition_by"] = self.partition_by
+        return options
+
+
+_schemas = {}
+_lock = threading.Lock()
+
+
+def register(name, columns, partition_by=("date",)):
+    """Declare ``name``'s columns, adding to what's already declared for it."""
+    with _lock:
+        if (schema := _schemas.get(name)) is None:
+            schema = TableSchema(name, columns, partition_by)
+        else:
+            schema = schema.merge(columns)
+
+        _schemas[name] = schema
+
+    return schema
+
+
+def get(name):
+    return _schemas.get(name)
@@ -0,0 +1,203 @@
+import datetime
+import logging
+import multiprocessing
+import queue
+import signal
+import threading
+import time
+import zlib
+
+import metrics
+from spool import Spool
+
+logger = logging.getLogger(__name__)
+
+unroutable = metrics.dropped_records.labels("to_delta", "unroutable")
+worker_failed = metrics.dropped_records.labels("to_delta", "worker_failed")
+restarts = metrics.worker_restarts.labels("to_delta")
+
+
+def run_worker(index, batches, spool_path, interval, failures):
+    """
+    One shard of to_delta: a DeviceRegister of its own, fed from ``batches``
+    and written to the shared spool every ``interval`` seconds, until the
+    parent sends None. Messages it fails on are counted in ``failures``,
+    which the parent reports, as this process exports no metrics.
+    """
+    # imported here as to_delta starts the pool
+    import to_delta
+
+    # the parent decides when to stop, after it has sent everything
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    register = to_delta.build_register()
+    # only appends segments, the parent's Spool uploads them
+    spool = Spool(spool_path, None)
+    next_write = time.monotonic() + interval
+
+    while True:
+        try:
+            batch = batches.get(timeout=max(0, next_write - time.monotonic()))
+        except queue.Empty:
+            batch = []
+
+        if batch is None:
+            break
+
+        for topic, payload, timestamp in batch:
+            try:
+                to_delta.ingest(register, topic, payload, datetime.datetime.fromtimestamp(timestamp))
+            except Exception:
+                logger.exception("Shard %d failed on %s", index, topic)
+                with failures.get_lock():
+                    failures.value += 1
+
+        if time.monotonic() >= next_write:
+            to_delta.write(register, spool)
+            next_write += interval
+
+    to_delta.write(register, spool, final=True)
+    logger.info("Shard %d done", index)
+
+
+class ShardPool:
+    """
+    to_delta's decoding, change filtering and buffering spread over worker
+    processes, so they aren't bound by the GIL of the MQTT thread.
+
+    ``on_message`` only hashes the (zone, area, thing) of the topic and adds
+    the raw (topic, payload, arrival time) to that shard's pending batch; all
+    messages of a device go to the same worker, in order, so its filters and
+    windows behave as they would in one process. Batches are handed over when
+    they reach ``batch_size`` or are ``max_delay`` seconds old. Each worker
+    queue holds at most ``max_queued`` batches, after which ``on_message``
+    blocks and pushes back on the broker. Workers spool their Arrow segments
+    into ``spool_path``, where the parent's Spool uploads them.
+
+    A worker that dies is restarted, when a hand-over to it times out after
+    ``put_timeout`` seconds or at the latest on the next ``max_delay`` tick,
+    so a crashed shard can't block the MQTT thread. What it hadn't written
+    yet is lost, and logged as such.
+    """
+
+    def __init__(self, workers, spool_path, interval, batch_size=256, max_delay=0.05, max_queued=64, put_timeout=1):
+        # fork would copy the parent's threads' locks in whatever state they're in
+        self._context = multiprocessing.get_context("spawn")
+        self._spool_path = spool_path
+        self._interval = interval
+        self._max_queued = max_queued
+        self._put_timeout = put_timeout
+        self._queues = [None] * workers
+        self._processes = [None] * workers
+        self._failures = [self._context.Value("q", 0) for _ in range(workers)]
+        self._failures_reported = 0
+        self._pending = [[] for _ in range(workers)]
+        self._batch_size = batch_size
+        self._max_delay = max_delay
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._pump = threading.Thread(target=self._run, name="shard-pump", daemon=True)
+
+    def start(self):
+        for shard in range(len(self._processes)):
+            self._start_worker(shard)
+        self._pump.start()
+
+    def failures(self):
+        """Messages the workers failed on so far."""
+        return sum(failures.value for failures in self._failures)
+
+    def shard(self, topic):
+        """The worker for ``topic``'s device, or None if it isn't a devices/<zone>/<area>/<kind>/<thing>/... topic."""
+        levels = topic.split("/", 5)
+        if len(levels) < 5:
+            return None
+
+        key = "%s/%s/%s" % (levels[1], levels[2], levels[4])
+        return zlib.crc32(key.encode("utf-8")) % len(self._queues)
+
+    def on_message(self, client, userdata, msg):
+        if (shard := self.shard(msg.topic)) is None:
+            logger.warning("Can't route %s to a shard", msg.topic)
+            unroutable.inc()
+            return
+
+        with self._lock:
+            pending = self._pending[shard]
+            pending.append((msg.topic, msg.payload, time.time()))
+
+            if len(pending) >= self._batch_size:
+                # still under the lock, so batches of a shard can't overtake each other
+                self._put(shard, pending)
+                self._pending[shard] = []
+
+    def close(self, timeout=None):
+        """Hand over what's pending, then wait for every worker to write its last batch."""
+        self._closed.set()
+        self._pump.join()
+        self._send_pending()
+
+        with self._lock:
+            for shard in range(len(self._queues)):
+                self._put(shard, None)
+        for process in self._processes:
+            process.join(timeout)
+
+        self._report_failures()
+
+    def _start_worker(self, shard):
+        batches = self._context.Queue(self._max_queued)
+        process = self._context.Process(
+            target=run_worker,
+            args=(shard, batches, self._spool_path, self._interval, self._failures[shard]),
+            name="to-delta-shard-%d" % shard,
+        )
+        process.start()
+
+        self._queues[shard] = batches
+        self._processes[shard] = process
+
+    def _restart_if_dead(self, shard):
+        process = self._processes[shard]
+        if process.is_alive():
+            return False
+
+        logger.error(
+            "Shard %d exited with code %s, restarting it; the messages it hadn't written are lost",
+            shard, process.exitcode,
+        )
+        restarts.inc()
+        # nobody reads the old queue any more, don't wait on it at exit
+        self._queues[shard].cancel_join_thread()
+        self._queues[shard].close()
+        self._start_worker(shard)
+        return True
+
+    def _put(self, shard, batch):
+        while True:
+            try:
+                self._queues[shard].put(batch, timeout=self._put_timeout)
+                return
+            except queue.Full:
+                if not self._restart_if_dead(shard):
+                    logger.warning("Shard %d is falling behind, still waiting to hand it a batch", shard)
+
+    def _send_pending(self):
+        with self._lock:
+            for shard, pending in enumerate(self._pending):
+                if pending:
+                    self._put(shard, pending)
+                    self._pending[shard] = []
+
+    def _report_failures(self):
+        failures = self.failures()
+        worker_failed.inc(failures - self._failures_reported)
+        self._failures_reported = failures
+
+    def _run(self):
+        while not self._closed.wait(self._max_delay):
+            with self._lock:
+                for shard in range(len(self._processes)):
+                    self._restart_if_dead(shard)
+            self._send_pending()
+            self._report_failures()
@@ -0,0 +1,152 @@
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import polars as pl
+from deltalake.exceptions import SchemaMismatchError
+
+import metrics
+
+
+class Spool:
+    """
+    Local, append-only staging area in front of a DeltaLakeClient.
+
+    ``append`` writes the DataFrame to an Arrow IPC segment under
+    ``<directory>/<table>/`` and returns straight away, so a flush only costs
+    a local disk write and the caller can drop its copy of the data. A
+    background thread uploads pending segments oldest first, several at a
+    time per table, and deletes them once the Delta commit has gone through.
+    Tables are uploaded in parallel on up to ``max_workers`` threads, so a
+    round takes about as long as the slowest table, and a table that fails
+    doesn't hold up the others. After a failed round the uploader backs off
+    exponentially, up to ``max_backoff`` seconds, and tries again; segments
+    survive restarts. A segment whose
+    schema the table refuses is moved aside as ``.rejected`` rather than
+    retried forever. Other processes may append to the same directory,
+    leaving the uploads to the one that started the Spool.
+    """
+
+    def __init__(self, directory, dlc, initial_backoff=1, max_backoff=300, max_segments_per_upload=32, max_workers=4):
+        self._directory = directory
+        self._dlc = dlc
+        self._initial_backoff = initial_backoff
+        self._max_backoff = max_backoff
+        self._max_segments_per_upload = max_segments_per_upload
+        self._pending = threading.Event()
+        self._upload_lock = threading.Lock()
+        self._sequence = 0
+        self._sequence_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="spool-upload", daemon=True)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="spool-table")
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        os.makedirs(directory, exist_ok=True)
+
+    def start(self):
+        self._pending.set()
+        self._thread.start()
+
+    def append(self, df, path, write_options=None):
+        table_directory = os.path.join(self._directory, path)
+        os.makedirs(table_directory, exist_ok=True)
+
+        # several processes may spool into one directory, so nothing is
+        # written in place and segment names include the pid
+        options = os.path.join(table_directory, "options.json")
+        options_tmp = "%s.%d.tmp" % (options, os.getpid())
+        with open(options_tmp, "w") as f:
+            json.dump(write_options or {}, f)
+        os.replace(options_tmp, options)
+
+        with self._sequence_lock:
+            self._sequence += 1
+            name = "%020d-%d-%06d.arrow" % (time.time_ns(), os.getpid(), self._sequence)
+
+        segment = os.path.join(table_directory, name)
+        df.write_ipc(segment + ".tmp", compression="zstd")
+        os.replace(segment + ".tmp", segment)
+
+        self.logger.info("Spooled %s records for %s", len(df), path)
+        self._pending.set()
+
+    def drain(self):
+        """Try to upload everything that's pending once, e.g. on shutdown."""
+        return self._upload_pending()
+
+    def pending(self):
+        return {table: len(self._segments(table)) for table in self._tables()}
+
+    def _run(self):
+        backoff = self._initial_backoff
+
+        while True:
+            self._pending.wait()
+            self._pending.clear()
+
+            if self._upload_pending():
+                backoff = self._initial_backoff
+            else:
+                self.logger.warning("Upload failed, retrying in %ss", backoff)
+                time.sleep(backoff)
+                backoff = min(backoff * 2, self._max_backoff)
+                self._pending.set()
+
+    def _upload_pending(self):
+        with self._upload_lock:
+            results = list(self._executor.map(self._upload_table, self._tables()))
+
+        return all(results)
+
+    def _upload_table(self, table):
+        while segments := self._segments(table)[:self._max_segments_per_upload]:
+            if not self._upload(table, segments):
+                return False
+
+        return True
+
+    def _upload(self, table, segments):
+        table_directory = os.path.join(self._directory, table)
+
+        try:
+            with open(os.path.join(table_directory, "options.json")) as f:
+                write_options = json.load(f)
+
+            df = pl.concat([pl.read_ipc(s, memory_map=False) for s in segments], how="diagonal_relaxed")
+            self._dlc.append(df, table, write_options)
+
+        except SchemaMismatchError:
+            if len(segments) > 1:
+                # find out which segments are at fault
+                return all([self._upload(table, [segment]) for segment in segments])
+
+            self.logger.exception("%s rejected %s, setting it aside", table, segments[0])
+            os.replace(segments[0], segments[0] + ".rejected")
+            metrics.dropped_records.labels("spool", "rejected").inc(len(df))
+            return True
+
+        except Exception:
+            self.logger.exception("Failed to upload %s segments to %s", len(segments), table)
+            metrics.delta_write_failures.labels(table).inc()
+            return False
+
+        for segment in segments:
+            os.remove(segment)
+
+        return True
+
+    def _tables(self):
+        return sorted(
+            entry.name for entry in os.scandir(self._directory) if entry.is_dir()
+        )
+
+    def _segments(self, table):
+        table_directory = os.path.join(self._directory, table)
+        return sorted(
+            os.path.join(table_directory, name)
+            for name in os.listdir(table_directory)
+            if name.endswith(".arrow")
+        )
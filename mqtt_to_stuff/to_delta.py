@@ -1,7 +1,6 @@
 import argparse
 import sys
 import paho.mqtt.client as mqtt
-import deltalake
 import polars as pl
 import os
 import threading
@@ -12,8 +11,15 @@ import datetime
 from typing import Dict, Tuple
 from collections.abc import Callable
 
+from deltalake.exceptions import SchemaMismatchError
+
+import metrics
+from compaction import CompactionPolicy, CompactionScheduler
+from delta_client import DeltaLakeClient, storage_options_from_env
+from spool import Spool
 from devices import MonitoringPlug, PresenceDetector, MultiPresenceDetector
 from register import DeviceRegister, Series
+from shards import ShardPool
 
 def generate_on_connect(topics):
     def on_connect(client, userdata, flags, reason_code, properties):
@@ -22,62 +28,49 @@ def generate_on_connect(topics):
 
     return on_connect
 
-def write(register, base_path):
-    print("going to write", base_path)
-
-    write_options = {
-        "writer_properties": deltalake.WriterProperties(compression="zstd"),
-        "partition_by":['date']
-    }
+def write(register, spool, final=False):
+    print("going to write")
 
-    if S3_ENDPOINT := os.environ.get('AWS_ENDPOINT_URL_S3'):
-        options = {
-            "endpoint_url": S3_ENDPOINT
-        }
-    else:
-        options = {}
+    started = time.perf_counter()
 
     for series_name in register.series:
         series = register.series[series_name]
-        df = pl.DataFrame(series.to_list())
 
-        if df.shape[0] > 0:
-            print(df)
+        if final:
+            series.close_windows()
 
-            delta_path = base_path + series_name
-            df.with_columns(
-                pl.col("timestamp").dt.date().alias("date")
-            ).write_delta(
-                delta_path,
-                mode="append",
-                delta_write_options=write_options,
-                storage_options=options
-            )
+        records = len(series)
+        try:
+            df = series.take()
+        except SchemaMismatchError as e:
+            # retrying wouldn't make the values fit, so they're dropped
+            print("rejected", series_name, e)
+            metrics.dropped_records.labels("to_delta", "rejected").inc(records)
+            continue
 
-            series.clear()
+        if df.shape[0] > 0:
+            print(df)
 
-            dt = deltalake.DeltaTable(delta_path,storage_options=options)
+            try:
+                spool.append(
+                    df.with_columns(pl.col("timestamp").dt.date().alias("date")),
+                    series_name,
+                    series.schema.write_options
+                )
+                metrics.flush_rows.labels("to_delta", series_name).observe(len(df))
+            except Exception as e:
+                print("failed to write", series_name, e)
+                metrics.dropped_records.labels("to_delta", "spool_failed").inc(len(df))
 
-            if len(dt.file_uris()) >= 24:
-                dt.optimize.compact()
-                dt.create_checkpoint()
+    metrics.flush_seconds.labels("to_delta").observe(time.perf_counter() - started)
 
 
-def periodic_batch_writer(register, base_path, interval):
-    while True:
-        time.sleep(interval)
-        write(register, base_path)
+def periodic_batch_writer(register, spool, interval, stopping):
+    while not stopping.wait(interval):
+        write(register, spool)
 
 
-def main(args):
-    parser = argparse.ArgumentParser(description="Copy MQTT events to DeltaLake.")
-    parser.add_argument("--host", help="The MQTT host address.", default=os.environ.get('MQTT_HOST'))
-    parser.add_argument("-t", "--topic", dest="topics", action="append", help="The MQTT topic to subscribe to.", default=os.environ.get('MQTT_TOPIC'))
-    parser.add_argument("-d", "--delta-path", dest="delta_path", help="Base path for DeltaLake tables", default=os.environ.get('DELTA_PATH', '/tmp/deltalake/'))
-    parser.add_argument("-i", "--interval", type=int, help="Batch write interval in seconds", default=os.environ.get('INTERVAL', 300))
-
-    args = parser.parse_args()
-
+def build_register():
     register = DeviceRegister()
     register.add_device_type("plug", MonitoringPlug)
     register.add_device_type("presence", PresenceDetector)
@@ -87,8 +80,8 @@ def main(args):
     uptime = Series("iot_device_uptime", 1)
     habitat = Series("habitat", 1)
     presence = Series("presence", 1)
-    multi_presence = Series("multi-presence", 0.6)
-    electricity = Series("electricity", 1)
+    multi_presence = Series("multi-presence", window=1)
+    electricity = Series("electricity", window=10)
 
     series = [
         uptime,
@@ -101,27 +94,76 @@ def main(args):
     for s in series:
         register.add_series(s)
 
+    return register
+
+
+def expose_buffer_metrics(register):
+    for s in register.series.values():
+        metrics.buffered_records.labels("to_delta", s.name).set_function(s.__len__)
+        metrics.buffered_bytes.labels("to_delta", s.name).set_function(s.estimated_size)
+
+
+def ingest(register, topic, payload, timestamp=None):
+    try:
+        payload = payload.decode("utf-8")
+        _, zone, area, kind, thing, *rest = topic.split("/")
+        print(timestamp or datetime.datetime.now(), topic, payload)
+        key = (("zone", zone), ("area", area), ("thing", thing))
+        register.append_data(kind, key, tuple(rest), payload, timestamp)
+
+    except ValueError as e:
+        print(e)
+        print("exception: " + topic)
+        return
+
+
+def generate_on_message(register):
     def on_message(client, userdata, msg):
-        try:
-            payload = msg.payload.decode("utf-8")
-            _, zone, area, kind, thing, *rest = msg.topic.split("/")
-            print(datetime.datetime.now(),msg.topic, payload)
-            key = (("zone", zone), ("area", area), ("thing", thing))
-            register.append_data(kind, key, tuple(rest), payload)
-
-        except ValueError as e:
-            print(e)
-            print("exception: " + msg.topic)
-            return
-
-
-    # Start periodic batch writer thread
-    batch_thread = threading.Thread(
-        target=periodic_batch_writer, 
-        args=(register, args.delta_path, args.interval), 
-        daemon=True
-    )
-    batch_thread.start()
+        ingest(register, msg.topic, msg.payload)
+
+    return on_message
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description="Copy MQTT events to DeltaLake.")
+    parser.add_argument("--host", help="The MQTT host address.", default=os.environ.get('MQTT_HOST'))
+    parser.add_argument("-t", "--topic", dest="topics", action="append", help="The MQTT topic to subscribe to.", default=os.environ.get('MQTT_TOPIC'))
+    parser.add_argument("-d", "--delta-path", dest="delta_path", help="Base path for DeltaLake tables", default=os.environ.get('DELTA_PATH', '/tmp/deltalake/'))
+    parser.add_argument("-i", "--interval", type=int, help="Batch write interval in seconds", default=os.environ.get('INTERVAL', 300))
+    parser.add_argument("--spool-path", dest="spool_path", help="Local directory batches are staged in before upload", default=os.environ.get('SPOOL_PATH', '/tmp/spool/to-delta/'))
+    parser.add_argument("--metrics-port", dest="metrics_port", type=int, help="Port to expose Prometheus metrics on, 0 to disable", default=os.environ.get('METRICS_PORT', 9102))
+    parser.add_argument("-w", "--workers", type=int, help="Worker processes to shard devices over, 0 to handle them on the MQTT thread", default=os.environ.get('WORKERS', 0))
+
+    args = parser.parse_args()
+
+    dlc = DeltaLakeClient(args.delta_path, storage_options_from_env())
+    CompactionScheduler(dlc, CompactionPolicy(max_files=24)).start()
+
+    spool = Spool(args.spool_path, dlc)
+    spool.start()
+
+    if args.workers:
+        # the buffers live in the workers, so there are no buffer gauges here
+        pool = ShardPool(args.workers, args.spool_path, args.interval)
+        pool.start()
+        on_message = pool.on_message
+    else:
+        pool = None
+        stopping = threading.Event()
+        register = build_register()
+        expose_buffer_metrics(register)
+        on_message = generate_on_message(register)
+
+        # Start periodic batch writer thread
+        batch_thread = threading.Thread(
+            target=periodic_batch_writer, 
+            args=(register, spool, args.interval, stopping), 
+            daemon=True
+        )
+        batch_thread.start()
+
+    metrics.start_metrics_server(args.metrics_port)
+    on_message = metrics.instrument_callback("to_delta")(on_message)
 
     mqttc = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
     mqttc.on_connect = generate_on_connect(args.topics)
@@ -129,8 +171,9 @@ def main(args):
 
 
     def sigterm_handler(SIGNAL, STACK_FRAME):
-        write(register, args.delta_path)
-        sys.exit(0)
+        # the handler runs on the network thread, possibly mid-append, so
+        # only stop the loop here and write once it has returned
+        mqttc.disconnect()
 
     signal.signal(signal.SIGTERM, sigterm_handler)
     signal.signal(signal.SIGINT, sigterm_handler)
@@ -139,6 +182,15 @@ def main(args):
 
     mqttc.loop_forever()
 
+    if pool is not None:
+        pool.close()
+    else:
+        # let a periodic write that is under way finish before the final one
+        stopping.set()
+        batch_thread.join()
+        write(register, spool, final=True)
+    spool.drain()
+
     return 0
 
 if __name__ == "__main__":
@@ -0,0 +1,107 @@
+from functools import lru_cache
+
+
+class _Node:
+    __slots__ = ("children", "values", "multi")
+
+    def __init__(self):
+        self.children = {}
+        self.values = []
+        # values of a "#" filter ending here
+        self.multi = []
+
+
+class TopicTrie:
+    """
+    MQTT topic filters compiled into a trie, one level per node.
+
+    Matching walks the topic once, following the literal level and ``+`` at
+    each step and collecting ``#`` on the way, so the cost depends on the
+    topic's depth rather than on the number of filters. Results are cached
+    per topic in an LRU, and values come back in the order their filters
+    were added, which lets callers use the trie for first-match dispatch.
+    """
+
+    def __init__(self, cache_size=4096):
+        self._root = _Node()
+        self._order = 0
+        self._filters = 0
+        self._match = lru_cache(maxsize=cache_size)(self._match_uncached)
+
+    def __len__(self):
+        return self._filters
+
+    def add(self, topic_filter, value=True):
+        levels = topic_filter.split("/")
+        if "#" in levels[:-1] or any(("#" in l or "+" in l) and len(l) > 1 for l in levels):
+            raise ValueError("Invalid topic filter: %s" % topic_filter)
+
+        node = self._root
+        for level in levels:
+            if level == "#":
+                node.multi.append((self._order, value))
+                break
+            node = node.children.setdefault(level, _Node())
+        else:
+            node.values.append((self._order, value))
+
+        self._order += 1
+        self._filters += 1
+        self._match.cache_clear()
+
+    def match(self, topic):
+        """Values of every filter matching ``topic``, oldest filter first."""
+        return self._match(topic)
+
+    def first(self, topic, default=None):
+        if matches := self._match(topic):
+            return matches[0]
+        return default
+
+    def _match_uncached(self, topic):
+        levels = topic.split("/")
+        found = []
+        nodes = [self._root]
+
+        for depth, level in enumerate(levels):
+            # wildcards at the first level don't match $SYS-style topics
+            wildcards = depth > 0 or not level.startswith("$")
+            next_nodes = []
+
+            for node in nodes:
+                if wildcards:
+                    found.extend(node.multi)
+                if (child := node.children.get(level)) is not None:
+                    next_nodes.append(child)
+                if wildcards and (child := node.children.get("+")) is not None:
+                    next_nodes.append(child)
+
+            if not (nodes := next_nodes):
+                break
+        else:
+            for node in nodes:
+                # "a/#" also matches "a" itself
+                found.extend(node.values)
+                found.extend(node.multi)
+
+        return tuple(value for _, value in sorted(found, key=lambda item: item[0]))
+
+
+def covers(general, specific):
+    """Whether every topic filter ``specific`` matches is also matched by ``general``."""
+    general_levels = general.split("/")
+    specific_levels = specific.split("/")
+
+    # wildcards at the first level don't match $SYS-style topics
+    if specific.startswith("$") and general_levels[0] in ("+", "#"):
+        return False
+
+    for depth, level in enumerate(general_levels):
+        if level == "#":
+            return True
+        if depth >= len(specific_levels) or specific_levels[depth] == "#":
+            return False
+        if level != "+" and level != specific_levels[depth]:
+            return False
+
+    return len(general_levels) == len(specific_levels)
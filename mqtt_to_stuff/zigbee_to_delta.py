@@ -1,70 +1,120 @@
 import argparse
 import sys
 import paho.mqtt.client as mqtt
-import deltalake
 import polars as pl
 import datetime
 import json
 from collections import defaultdict
+from types import MappingProxyType
 import logging
 import os
+import signal
 import time
 import threading
 import code
 
+from deltalake.exceptions import SchemaMismatchError
+
+import metrics
+import schemas
+from compaction import CompactionPolicy, CompactionScheduler
+from delta_client import DeltaLakeClient, storage_options_from_env
+from double_buffer import DoubleBuffer
+from spool import Spool
+from topics import TopicTrie
 from devices import ActionButtons, ContactSensor, ThermometerAndHygrometer, TradfriBulbHandler, MotionLuminance, VINDSTYRKA
 
 logging.basicConfig(encoding='utf-8', level=logging.DEBUG)
 
+# columns every zigbee timeseries has ahead of its handler's fields
+IDENTITY_SCHEMA = {
+    "zone": pl.String,
+    "area": pl.String,
+    "thing": pl.String,
+    "address": pl.String,
+    "timestamp": pl.Datetime("us"),
+}
+
+DEVICE_MAPPINGS = schemas.register("zigbee-devices", {
+    "timestamp": pl.Datetime("us"),
+    "address": pl.String,
+    "manufacturer": pl.String,
+    "model": pl.String,
+    "friendly_name": pl.String,
+}, partition_by=())
+
 class ZigbeeDeviceRegister:
     def __init__(self):
-        self.timeseries = defaultdict(list)
+        self.timeseries = DoubleBuffer(lambda: defaultdict(list))
+        # records whose flush failed, written ahead of the next batch
+        self.unwritten = defaultdict(list)
+        # the periodic writer and the shutdown flush both move records
+        # through unwritten, one at a time
+        self._write_lock = threading.Lock()
         self.handlers = {}
+        self.handlers_by_model = {}
         self.device_mappings = {}
+        # latest friendly name recorded in zigbee-devices, per address
+        self.persisted_mappings = None
         self.logger = logging.getLogger(self.__class__.__name__)
 
     def set_deltalakeclient(self, dlc):
         self.dlc = dlc
 
+    def set_spool(self, spool):
+        self.spool = spool
+
     def write_all_and_clear(self, base_path):
-        try:
-            for name in self.timeseries:
-                if len(self.timeseries[name]) > 0:
-                    self._write_timeseries(base_path,name, self.timeseries[name])
-        except Exception as e:
-            print(e)
+        started = time.perf_counter()
 
-    def _write_timeseries(self, base_path, name, timeseries):
-        write_options = {
-            "writer_properties": deltalake.WriterProperties(compression="zstd"),
-            "partition_by":['date']
-        }
+        with self._write_lock:
+            for name, records in self.timeseries.swap().items():
+                self.unwritten[name].extend(records)
+
+            for name in list(self.unwritten):
+                if len(self.unwritten[name]) > 0:
+                    try:
+                        self._write_timeseries(base_path,name, self.unwritten[name])
+                    except Exception as e:
+                        self.logger.warning("failed to write %s: %s" % (name, e))
+
+        metrics.flush_seconds.labels("zigbee_to_delta").observe(time.perf_counter() - started)
 
-        options = {}
-        if S3_ENDPOINT := os.environ.get('AWS_ENDPOINT_URL_S3'):
-            options["endpoint_url"] = S3_ENDPOINT
+    def buffered_records(self, name):
+        return len(self.timeseries.peek().get(name, ())) + len(self.unwritten.get(name, ()))
 
-        df = pl.DataFrame(timeseries).with_columns(date=pl.col('timestamp').dt.date())
+    def buffered_bytes(self, name):
+        records = list(self.timeseries.peek().get(name, ())) + list(self.unwritten.get(name, ()))
+        return sum(sys.getsizeof(r) + sum(sys.getsizeof(v) for v in list(r.values())) for r in records)
+
+    def _write_timeseries(self, base_path, name, timeseries):
+        schema = schemas.get(name)
 
         try:
-            self.dlc.append(df, name, write_options)
+            df = schema.frame(timeseries).with_columns(date=pl.col('timestamp').dt.date())
+        except SchemaMismatchError as e:
+            # retrying wouldn't make the values fit, so they're dropped
+            self.logger.error(e)
+            metrics.dropped_records.labels("zigbee_to_delta", "rejected").inc(len(timeseries))
             timeseries.clear()
-            self.logger.info("wrote %s records to %s/%s" % (len(df), base_path, name))
+            return
+
+        try:
+            self.spool.append(df, name, schema.write_options)
+            metrics.flush_rows.labels("zigbee_to_delta", name).observe(len(df))
+            timeseries.clear()
+            self.logger.info("spooled %s records for %s/%s" % (len(df), base_path, name))
 
         except Exception as e:
+            # keep the records, the next flush tries again
             self.logger.warning(e)
-            self.logger.info("Typically a schema mismatch")
-            self.logger.debug(df.schema)
-
-            print(df)
-
-            csv_path = "/tmp/" + name + "-" + datetime.datetime.now().isoformat() + ".csv"
-            df.write_csv(csv_path)
-            self.logger.info("wrote %s records to %s" % (len(df), csv_path))
-            self.timeseries[name].clear()
 
 
     def register_devices(self, device_definitions):
+        # the bridge sends the full list, so devices that were renamed or
+        # removed don't keep their old mappings
+        self.device_mappings = {}
+
         for dd in device_definitions:
             result = self.try_registering_device(dd)
 
@@ -80,55 +130,84 @@ class ZigbeeDeviceRegister:
 
         self._persist_device_mappings()
 
+    def load_persisted_mappings(self):
+        """
+        Read the latest mapping per address from zigbee-devices, once.
+
+        If the table can't be read, say while S3 is down, the mappings stay
+        unknown and the next registration tries again.
+        """
+        try:
+            if (dt := self.dlc.table("zigbee-devices")) is None:
+                self.persisted_mappings = {}
+                return
+
+            latest = (
+                pl.scan_delta(dt)
+                .select("timestamp", "address", "friendly_name")
+                .sort("timestamp")
+                .group_by("address")
+                .agg(pl.col("friendly_name").last())
+                .collect()
+            )
+        except Exception as e:
+            self.logger.warning("failed to read zigbee-devices, will try again on the next registration: %s" % e)
+            return
+
+        self.persisted_mappings = dict(latest.iter_rows())
+
     def _persist_device_mappings(self):
-        for_df = []
+        if self.persisted_mappings is None:
+            self.load_persisted_mappings()
+
+        if self.persisted_mappings is None:
+            # without the recorded mappings every one would look new
+            return
 
-        for (friendly_name, mapping) in self.device_mappings.items():
-            now = datetime.datetime.now()
-            for_df.append({
+        now = datetime.datetime.now()
+        changed = [
+            {
                 "timestamp": now,
                 "address": mapping['address'],
                 "manufacturer": mapping['manufacturer'],
                 "model": mapping['model'],
                 "friendly_name": friendly_name,
-            })
-
-        current = pl.DataFrame(for_df)
-
-        try:
-            previous = self.dlc.get("zigbee-devices")
-        except:
-            previous = None
-
-        if previous is None:
-            self.dlc.append(current, "zigbee-devices")
-            print("had nothing - write all of current")
-            print(current)
-
-        latest = previous.sort(by=['timestamp']).group_by(["address"], maintain_order=True).last()
-        anti = current.join(latest, on=['address','friendly_name'], how='anti')
+            }
+            for (friendly_name, mapping) in self.device_mappings.items()
+            if self.persisted_mappings.get(mapping['address']) != friendly_name
+        ]
 
+        if not changed:
+            self.logger.info("device mappings unchanged")
+            return
 
-        print("latest")
-        print(latest)
+        # through the spool, as this runs on the MQTT thread (or event loop)
+        self.spool.append(DEVICE_MAPPINGS.frame(changed), "zigbee-devices", DEVICE_MAPPINGS.write_options)
 
-        if len(anti) > 0:
-            print("anti: should write this")
-            print(anti)
+        for row in changed:
+            self.persisted_mappings[row['address']] = row['friendly_name']
 
-            self.dlc.append(anti, 'zigbee-devices')
-        else:
-            print("nothing to write")
+        self.logger.info("recorded %s new device mappings" % len(changed))
 
 
     def try_registering_device(self, device_definition):
         if handler := self._match_device_to_handler(device_definition):
             #print(device_definition)
-            self.device_mappings[device_definition.get('friendly_name')] = {
+            friendly_name = device_definition.get('friendly_name')
+            address = device_definition.get('ieee_address')
+
+            try:
+                identity = handler.friendly_name_to_id(friendly_name)
+            except IndexError:
+                identity = None
+
+            self.device_mappings[friendly_name] = {
                 "manufacturer": device_definition.get('manufacturer'),
                 "model": device_definition.get('model_id'),
-                "address": device_definition.get('ieee_address'),
-                "handler": handler
+                "address": address,
+                "handler": handler,
+                # the columns every record from this device starts with
+                "identity": None if identity is None else MappingProxyType({**identity, "address": address}),
             }
             return True
 
@@ -137,29 +216,28 @@ class ZigbeeDeviceRegister:
 
 
     def _match_device_to_handler(self, device_definition):
-        for handler in self.handlers.values():
-            if handler.match_device(device_definition):
-                return handler
-
-        return None
+        return self.handlers_by_model.get(device_definition.get('model_id'))
 
     def add_handler(self, handler):
         self.handlers[handler.__class__.__name__] = handler
+        schemas.register(handler.timeseries_name, {**IDENTITY_SCHEMA, **handler.schema.dtypes, "date": pl.Date})
+
+        for model_id in handler.model_ids:
+            # the handler added first keeps a model both claim
+            self.handlers_by_model.setdefault(model_id, handler)
 
     def append(self, friendly_name, payload):
-        if handler_and_address := self.device_mappings.get(friendly_name):
-            handler = handler_and_address['handler']
-            address = handler_and_address['address']
-            cast_payload = handler.cast_payload(payload)
+        if mapping := self.device_mappings.get(friendly_name):
+            handler = mapping['handler']
 
-            if id := handler.friendly_name_to_id(friendly_name):
-                id['address'] = address
-                id['timestamp'] = datetime.datetime.now()
+            if (identity := mapping['identity']) is not None:
+                record = {**identity, "timestamp": datetime.datetime.now(), **handler.decode(payload)}
 
-                id.update(cast_payload)
+                timeseries = self.timeseries.acquire()
+                timeseries[handler.timeseries_name].append(record)
+                self.timeseries.release()
 
-                self.timeseries[handler.timeseries_name].append(id)
-                self.logger.info(["appending", handler.timeseries_name, id])
+                self.logger.info(["appending", handler.timeseries_name, record])
 
             else:
                 self.logger.info(["not-appending", handler.timeseries_name, "%s didn't match to an id" % friendly_name])
@@ -188,84 +266,60 @@ vindstyrka = VINDSTYRKA()
 ZDR.add_handler(vindstyrka)
 
 
-class DeltaLakeClient:
-    def __init__(self, base_path, storage_options):
-        self._base_path = base_path
-        self._storage_options = storage_options
-        self.logger = logging.getLogger(self.__class__.__name__)
+def on_bridge_devices(msg):
+    o = json.loads(msg.payload.decode('utf-8'))
+    ZDR.register_devices(o)
 
-    def get(self, path):
-        p = self._base_path + path
-        print("going to read", p)
-        return pl.read_delta(
-            p,
-            storage_options = self._storage_options
-        )
-
-    # self.dlc.write(df, name, write_options)
-    def append(self, df, path, write_options = None):
-        if write_options is None:
-            write_options = {}
-
-        write_options.update({
-            "writer_properties": deltalake.WriterProperties(compression="zstd"),
-        })
-
-        df.write_delta(
-            self._base_path + path,
-            delta_write_options = write_options,
-            storage_options = self._storage_options,
-            mode = "append"
-        )
-
-        dt = deltalake.DeltaTable(
-            self._base_path + path,
-            storage_options = self._storage_options
-        )
-
-        if len(dt.file_uris()) >= 60:
-            dt.optimize.compact()
-            dt.create_checkpoint()
-            self.logger.info("Compacting")
 
+def on_bridge(msg):
+    print("don't care: %s" % msg.topic)
 
-def on_message(client, userdata, msg):
-    if msg.topic.startswith('zigbee2mqtt/bridge/devices'):
-        o = json.loads(msg.payload.decode('utf-8'))
-        ZDR.register_devices(o)
 
-    elif msg.topic.startswith("zigbee2mqtt/bridge"):
-        print("don't care: %s" % msg.topic)
+def on_device(msg):
+    all_split = msg.topic.split("/")
+    if all_split[-1] == 'set':
+        print(["not an update", all_split])
         return
 
-    elif msg.topic.startswith('zigbee2mqtt/'):
+    split = msg.topic.split("/", 1)
 
-        all_split = msg.topic.split("/")
-        if all_split[-1] == 'set':
-            print(["not an update", all_split])
-            return
+    try:
+        if len(split) == 2:
+            maybe_friendly_name = split[1]
+            # decoded by the device's handler, into just the fields it keeps
+            ZDR.append(maybe_friendly_name, msg.payload)
+        else:
+            print(["not an update", split])
 
-        split = msg.topic.split("/", 1)
-        maybe_friendly_name = split[1]
+    except ValueError as e:
+        print(["failed-to-parse", msg.topic, msg.payload.decode("utf-8")])
+        print(msg.payload.decode("utf-8"))
 
-        try:
-            if len(split) == 2:
-                o = json.loads(msg.payload.decode('utf-8'))
-                ZDR.append(maybe_friendly_name, o)
-            else:
-                print(["not an update", split])
 
-        except json.decoder.JSONDecodeError as e:
-            print(["failed-to-parse", msg.topic, msg.payload.decode("utf-8")])
-            print(msg.payload.decode("utf-8"))
+def on_other(msg):
+    print("msg", msg.topic, msg.payload.decode("utf-8"))
 
-    else:
-        print("msg", msg.topic, msg.payload.decode("utf-8"))
-        pass
 
-def periodic_batch_writer(register, base_path, interval):
-    while True:
-        time.sleep(interval)
+# first matching filter wins
+routes = TopicTrie()
+routes.add('zigbee2mqtt/bridge/devices', on_bridge_devices)
+routes.add('zigbee2mqtt/bridge/#', on_bridge)
+routes.add('zigbee2mqtt/#', on_device)
+
+
+@metrics.instrument_callback("zigbee_to_delta")
+def on_message(client, userdata, msg):
+    routes.first(msg.topic, on_other)(msg)
+
+def expose_buffer_metrics():
+    for handler in ZDR.handlers.values():
+        name = handler.timeseries_name
+        metrics.buffered_records.labels("zigbee_to_delta", name).set_function(lambda name=name: ZDR.buffered_records(name))
+        metrics.buffered_bytes.labels("zigbee_to_delta", name).set_function(lambda name=name: ZDR.buffered_bytes(name))
+
+
+def periodic_batch_writer(register, base_path, interval, stopping):
+    while not stopping.wait(interval):
         register.write_all_and_clear(base_path)
 
 
@@ -281,28 +335,32 @@ def main(args):
     parser.add_argument("--host", help="The MQTT host address.", default=os.environ.get('MQTT_HOST'))
     parser.add_argument("-d", "--delta-path", dest="delta_path", help="Base path for DeltaLake tables", default=os.environ.get('DELTA_PATH', '/tmp/deltalake/'))
     parser.add_argument("-i", "--interval", type=int, help="Batch write interval in seconds", default=os.environ.get('INTERVAL', 60))
+    parser.add_argument("--spool-path", dest="spool_path", help="Local directory batches are staged in before upload", default=os.environ.get('SPOOL_PATH', '/tmp/spool/zigbee-to-delta/'))
+    parser.add_argument("--metrics-port", dest="metrics_port", type=int, help="Port to expose Prometheus metrics on, 0 to disable", default=os.environ.get('METRICS_PORT', 9103))
 
     args = parser.parse_args()
 
+    expose_buffer_metrics()
+    metrics.start_metrics_server(args.metrics_port)
+
     # Start periodic batch writer thread
+    stopping = threading.Event()
     batch_thread = threading.Thread(
         target=periodic_batch_writer, 
-        args=(ZDR, args.delta_path, args.interval), 
+        args=(ZDR, args.delta_path, args.interval, stopping), 
         daemon=True
     )
     batch_thread.start()
 
-    options = {}
-    if S3_ENDPOINT := os.environ.get('AWS_ENDPOINT_URL_S3'):
-        options["endpoint_url"] = S3_ENDPOINT
-
-    options["AWS_SESSION_TOKEN"] = os.environ.get('AWS_SESSION_TOKEN', "")
-
-    print(options)
-
-    dlc = DeltaLakeClient(args.delta_path, options)
+    dlc = DeltaLakeClient(args.delta_path, storage_options_from_env())
+    CompactionScheduler(dlc, CompactionPolicy(max_files=60)).start()
 
     ZDR.set_deltalakeclient(dlc)
+    ZDR.load_persisted_mappings()
+
+    spool = Spool(args.spool_path, dlc)
+    spool.start()
+    ZDR.set_spool(spool)
 
 
 
@@ -313,10 +371,22 @@ def main(args):
     mqttc.on_connect = generate_on_connect(topics)
     mqttc.on_message = on_message
 
+    def handle_shutdown(signum, frame):
+        mqttc.disconnect()
+
+    signal.signal(signal.SIGTERM, handle_shutdown)
+    signal.signal(signal.SIGINT, handle_shutdown)
+
     mqttc.connect(args.host, 1883, 60)
 
     mqttc.loop_forever()
 
+    # let a periodic flush that is under way finish before the final one
+    stopping.set()
+    batch_thread.join()
+    ZDR.write_all_and_clear(args.delta_path)
+    spool.drain()
+
     return 0
 
 if __name__ == "__main__":
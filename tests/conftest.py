@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the modules import each other as scripts (`from devices import ...`)
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "mqtt_to_stuff"))
@@ -0,0 +1,101 @@
+import asyncio
+import threading
+import time
+import types
+
+from aio import AsyncioHelper, Backpressure, every
+from raw_to_delta import RecordBuffer
+
+
+def run_for(seconds, interval, flush, wake=None):
+    async def main():
+        stopping = asyncio.Event()
+        asyncio.get_running_loop().call_later(seconds, stopping.set)
+        await every(interval, flush, stopping, wake=wake)
+
+    asyncio.run(main())
+
+
+def test_flushes_keep_a_fixed_cadence():
+    started = []
+
+    def slow_flush():
+        started.append(time.monotonic())
+        time.sleep(0.03)
+
+    run_for(0.5, 0.1, slow_flush)
+
+    gaps = [b - a for a, b in zip(started, started[1:])]
+    assert len(started) >= 3
+    # a flush taking 30ms doesn't push the next one back by 30ms
+    assert all(abs(gap - 0.1) < 0.025 for gap in gaps), gaps
+
+
+def test_overrunning_flushes_skip_missed_intervals():
+    started = []
+
+    def slower_than_interval():
+        started.append(time.monotonic())
+        time.sleep(0.15)
+
+    run_for(0.55, 0.1, slower_than_interval)
+
+    assert all(b - a >= 0.15 for a, b in zip(started, started[1:]))
+    assert len(started) <= 3
+
+
+def test_wake_asks_for_an_early_flush():
+    requested = threading.Event()
+    flushed = []
+
+    def flush():
+        flushed.append(time.monotonic())
+        requested.clear()
+
+    def wake(timeout):
+        return requested.wait(timeout)
+
+    threading.Timer(0.05, requested.set).start()
+    # like RecordBuffer.close, releases the waiting wake once it's time to stop
+    threading.Timer(0.35, requested.set).start()
+    started = time.monotonic()
+    run_for(0.3, 10, flush, wake)
+
+    assert len(flushed) == 1
+    assert flushed[0] - started < 0.2
+
+
+def test_a_full_buffer_pauses_reading_instead_of_blocking_the_loop():
+    buffer = RecordBuffer(max_records=1000, max_batch_bytes=10 ** 6, max_buffered_bytes=500, block=False)
+    flushed = []
+
+    def flush():
+        batch, size = buffer.take()
+        flushed.append(len(batch))
+        buffer.done(size)
+
+    async def main():
+        helper = AsyncioHelper(asyncio.get_running_loop(), types.SimpleNamespace())
+        pressure = Backpressure(helper, buffer.full, buffer.wait_until_not_full)
+        stopping = asyncio.Event()
+        flushes = asyncio.create_task(every(60, flush, stopping, wake=buffer.wait_for_flush))
+
+        paused = []
+        for _ in range(10):
+            # what paho's on_message does on the loop thread
+            buffer.append("a", "x" * 100, False, 200)
+            pressure.check()
+            paused.append(helper.paused)
+            # no reads while paused
+            while helper.paused:
+                await asyncio.sleep(0.01)
+
+        stopping.set()
+        buffer.close()
+        await flushes
+        return paused
+
+    paused = asyncio.run(asyncio.wait_for(main(), 5))
+
+    assert any(paused)
+    assert sum(flushed) + len(buffer) == 10
@@ -0,0 +1,140 @@
+import datetime
+
+import polars as pl
+
+from backfill import backfill, scan_raw
+from delta_client import DeltaLakeClient
+from raw_to_delta import RAW_SCHEMA
+
+DAY = datetime.date(2025, 1, 1)
+NOON = datetime.datetime(2025, 1, 1, 12)
+PRESENCE = "devices/home/kitchen/presence/p1/"
+PLUG = "devices/home/kitchen/plug/fridge/"
+
+
+def _archive(dlc, messages):
+    df = pl.DataFrame(
+        [(topic, NOON + datetime.timedelta(seconds=s), payload, False) for s, topic, payload in messages],
+        schema=RAW_SCHEMA,
+        orient="row",
+    ).with_columns(date=pl.col("arrival_timestamp").dt.date())
+    dlc.append(df, "raw-mqtt", {"partition_by": ["date"]})
+
+
+def _read(dlc, table):
+    return pl.read_delta(dlc.uri(table)).sort("timestamp")
+
+
+def test_change_filters_deadbands_and_throttles_are_replayed(tmp_path):
+    dlc = DeltaLakeClient(str(tmp_path) + "/", {})
+    _archive(dlc, [
+        (0, PRESENCE + "binary_sensor/occupancy/state", "ON"),
+        (2, PRESENCE + "binary_sensor/occupancy/state", "ON"),
+        (4, PRESENCE + "binary_sensor/occupancy/state", "OFF"),
+        (4.5, PRESENCE + "binary_sensor/occupancy/state", "ON"),
+        (6, PRESENCE + "sensor/light_sensor/state", "100"),
+        (8, PRESENCE + "sensor/light_sensor/state", "100.5"),
+        (10, PRESENCE + "sensor/light_sensor/state", "120"),
+        (12, PRESENCE + "sensor/uptime_sensor/state", "not a number"),
+        (14, PRESENCE + "sensor/unknown/state", "1"),
+    ])
+
+    written = backfill(dlc, dlc, DAY, DAY)
+
+    assert written == {"presence": 2, "habitat": 2}
+    # the ON half a second after OFF is accepted by the filter but throttled
+    assert _read(dlc, "presence")["occupancy"].to_list() == [True, False]
+    assert _read(dlc, "habitat")["light_level"].to_list() == [100.0, 120.0]
+
+
+def test_windowed_series_are_aggregated_per_source(tmp_path):
+    dlc = DeltaLakeClient(str(tmp_path) + "/", {})
+    readings = ["power", "current", "voltage", "apparent_power", "power_factor", "reactive_power", "energy"]
+    messages = [(i * 0.1, PLUG + "sensor/%s/state" % name, "100") for i, name in enumerate(readings)]
+    messages.append((1, PLUG + "switch/switch/state", "ON"))
+    messages.append((2, PLUG + "sensor/power/state", "150"))
+    messages.append((12, PLUG + "sensor/power/state", "200"))
+    _archive(dlc, messages)
+
+    backfill(dlc, dlc, DAY, DAY)
+
+    df = _read(dlc, "electricity")
+    assert df["timestamp"].to_list() == [NOON, NOON + datetime.timedelta(seconds=10)]
+    assert df["samples"].to_list() == [2, 1]
+    assert df["power"].to_list() == [150.0, 200.0]
+    assert df["power_min"].to_list() == [100.0, 200.0]
+    assert df["switch"].to_list() == [True, True]
+
+
+def test_zigbee_messages_use_the_recorded_mapping_and_days_are_replaced(tmp_path):
+    dlc = DeltaLakeClient(str(tmp_path) + "/", {})
+    dlc.append(pl.DataFrame({
+        "timestamp": [NOON + datetime.timedelta(seconds=5)],
+        "address": ["0x01"],
+        "manufacturer": ["bench"],
+        "model": ["TS0201"],
+        "friendly_name": ["kitchen/zigbee/thermometer"],
+    }), "zigbee-devices")
+
+    payload = '{"temperature": %s, "humidity": 40, "battery": 90, "voltage": 3000, "linkquality": 80, "extra": 1}'
+    _archive(dlc, [
+        (0, "zigbee2mqtt/kitchen/zigbee/thermometer", payload % 20.5),
+        (10, "zigbee2mqtt/kitchen/zigbee/thermometer", payload % 21),
+        (11, "zigbee2mqtt/kitchen/zigbee/thermometer/availability", "online"),
+        (12, "zigbee2mqtt/kitchen/zigbee/unknown", payload % 22),
+        (13, "zigbee2mqtt/bridge/devices", "[]"),
+        (14, "zigbee2mqtt/kitchen/zigbee/thermometer", payload % '"broken"'),
+    ])
+
+    backfill(dlc, dlc, DAY, DAY)
+    backfill(dlc, dlc, DAY, DAY)
+
+    df = _read(dlc, "temperature-and-humidity")
+    assert df["temperature"].to_list() == [20.5, 21.0]
+    assert df["address"].to_list() == ["0x01", "0x01"]
+    assert df["thing"].to_list() == ["thermometer", "thermometer"]
+    assert "extra" not in df.columns
+
+
+def test_zigbee_payloads_are_decoded_like_the_live_pipeline(tmp_path):
+    dlc = DeltaLakeClient(str(tmp_path) + "/", {})
+    dlc.append(pl.DataFrame({
+        "timestamp": [NOON],
+        "address": ["0x01"],
+        "manufacturer": ["bench"],
+        "model": ["TS0201"],
+        "friendly_name": ["kitchen/zigbee/thermometer"],
+    }), "zigbee-devices")
+
+    _archive(dlc, [
+        (0, "zigbee2mqtt/kitchen/zigbee/thermometer", '{"temperature": 20.5, "linkquality": 80}'),
+        # a fraction for an integer field refuses the message
+        (1, "zigbee2mqtt/kitchen/zigbee/thermometer", '{"temperature": 21, "linkquality": 80.5}'),
+    ])
+    backfill(dlc, dlc, DAY, DAY)
+    assert _read(dlc, "temperature-and-humidity")["temperature"].to_list() == [20.5]
+
+    # a number sent as a string is coerced, not a reason to refuse the day
+    _archive(dlc, [(2, "zigbee2mqtt/kitchen/zigbee/thermometer", '{"temperature": "21.5", "linkquality": 80}')])
+    backfill(dlc, dlc, DAY, DAY)
+    assert _read(dlc, "temperature-and-humidity")["temperature"].to_list() == [20.5, 21.5]
+
+
+def test_collapsed_runs_are_expanded_into_their_messages(tmp_path):
+    dlc = DeltaLakeClient(str(tmp_path) + "/", {})
+    _archive(dlc, [(0, PLUG + "sensor/power/state", "100")])
+    dlc.append(pl.DataFrame({
+        "topic": [PLUG + "sensor/power/state", PLUG + "switch/switch/state"],
+        "arrival_timestamp": [NOON + datetime.timedelta(seconds=1), NOON + datetime.timedelta(seconds=2)],
+        "payload": ["150", "ON"],
+        "retain": [False, False],
+        "last_seen": [NOON + datetime.timedelta(seconds=9), None],
+        "count": [5, 1],
+    }).with_columns(date=pl.col("arrival_timestamp").dt.date()), "raw-mqtt", {"partition_by": ["date"], "schema_mode": "merge"})
+
+    raw = scan_raw(dlc, NOON, NOON + datetime.timedelta(seconds=8)).collect()
+
+    # the run's messages past the end of the slice are left out
+    assert [(t - NOON).total_seconds() for t in raw["timestamp"]] == [0, 1, 2, 3, 5, 7]
+    assert raw["payload"].to_list() == ["100", "150", "ON", "150", "150", "150"]
+    assert raw["seq"].to_list() == list(range(6))
@@ -0,0 +1,122 @@
+import datetime
+import os
+import threading
+
+import polars as pl
+import pytest
+from deltalake.exceptions import SchemaMismatchError
+
+from compaction import CompactionPolicy, CompactionScheduler, PartitionStats
+from delta_client import DeltaLakeClient
+from spool import Spool
+
+
+def _frame(day, n=2):
+    ts = datetime.datetime.combine(day, datetime.time(12))
+    return pl.DataFrame({"value": list(range(n)), "timestamp": [ts] * n}).with_columns(
+        date=pl.col("timestamp").dt.date()
+    )
+
+
+def test_append_reuses_table_handle_and_counts_partition_files(tmp_path):
+    dlc = DeltaLakeClient(str(tmp_path) + "/", {})
+    day = datetime.date(2025, 1, 1)
+
+    dlc.append(_frame(day), "t", {"partition_by": ["date"]})
+    dt = dlc.table("t")
+    dlc.append(_frame(day), "t", {"partition_by": ["date"]})
+    dlc.append(_frame(datetime.date(2025, 1, 2)), "t", {"partition_by": ["date"]})
+
+    assert dlc.table("t") is dt
+    assert dt.version() == 2
+    files = {k: v.files for k, v in dlc._partition_files["t"].items()}
+    assert files == {
+        (("date", "2025-01-01"),): 2,
+        (("date", "2025-01-02"),): 1,
+    }
+
+
+def test_compaction_runs_in_the_background_for_the_due_partition(tmp_path):
+    dlc = DeltaLakeClient(str(tmp_path) + "/", {})
+    compactor = CompactionScheduler(dlc, CompactionPolicy(max_files=3))
+    compactor.start()
+    day = datetime.date(2025, 1, 1)
+
+    dlc.append(_frame(datetime.date(2025, 1, 2)), "t", {"partition_by": ["date"]})
+    for _ in range(3):
+        dlc.append(_frame(day), "t", {"partition_by": ["date"]})
+
+    compactor.stop()
+
+    files = {k: v.files for k, v in dlc._partition_files["t"].items()}
+    assert files == {
+        (("date", "2025-01-01"),): 1,
+        (("date", "2025-01-02"),): 1,
+    }
+    assert len(dlc.get("t")) == 8
+
+
+def test_policy_thresholds():
+    stats = PartitionStats()
+    stats.add(10, 100.0)
+    stats.add(10, 200.0)
+
+    assert not CompactionPolicy(max_files=3).due(stats, 300.0)
+    assert CompactionPolicy(max_files=None, max_bytes=20).due(stats, 300.0)
+    assert CompactionPolicy(max_files=None, max_age=150).due(stats, 300.0)
+    assert not CompactionPolicy(max_files=None, max_age=250).due(stats, 300.0)
+
+
+def test_appends_are_conformed_to_the_table_schema(tmp_path):
+    dlc = DeltaLakeClient(str(tmp_path) + "/", {})
+    dlc.append(pl.DataFrame({"value": [1]}), "t")
+
+    dlc.append(pl.DataFrame({"value": [2.0], "empty": [None], "new": ["x"]}), "t")
+
+    df = pl.read_delta(dlc.uri("t"))
+    assert df.schema == pl.Schema({"value": pl.Int64, "new": pl.String})
+    assert df.sort("value")["value"].to_list() == [1, 2]
+
+
+@pytest.mark.parametrize("values", [[2.0, 2.5], [3.0, float("nan")], [2.0**63]])
+def test_appends_that_would_change_values_are_refused(tmp_path, values):
+    dlc = DeltaLakeClient(str(tmp_path) + "/", {})
+    dlc.append(pl.DataFrame({"value": [1]}), "t")
+
+    with pytest.raises(SchemaMismatchError):
+        dlc.append(pl.DataFrame({"value": values}), "t")
+
+    assert pl.read_delta(dlc.uri("t"))["value"].to_list() == [1]
+
+
+def test_spool_sets_aside_a_batch_that_would_change_values(tmp_path):
+    dlc = DeltaLakeClient(str(tmp_path) + "/", {})
+    dlc.append(pl.DataFrame({"value": [1]}), "t")
+    spool = Spool(str(tmp_path / "spool"), dlc)
+
+    spool.append(pl.DataFrame({"value": [2.0]}), "t")
+    spool.append(pl.DataFrame({"value": [2.5]}), "t")
+
+    assert spool.drain()
+    assert pl.read_delta(dlc.uri("t")).sort("value")["value"].to_list() == [1, 2]
+    assert len([n for n in os.listdir(tmp_path / "spool" / "t") if n.endswith(".rejected")]) == 1
+
+
+def test_concurrent_writers_keep_every_row(tmp_path):
+    day = datetime.date(2025, 1, 1)
+    writers = [DeltaLakeClient(str(tmp_path) + "/", {}) for _ in range(4)]
+    barrier = threading.Barrier(len(writers))
+
+    def write(dlc):
+        # all of them race to create the table, then keep appending to it
+        barrier.wait()
+        for _ in range(3):
+            dlc.append(_frame(day), "t", {"partition_by": ["date"]})
+
+    threads = [threading.Thread(target=write, args=(dlc,)) for dlc in writers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(pl.read_delta(str(tmp_path / "t"))) == len(writers) * 3 * 2
@@ -0,0 +1,128 @@
+import polars as pl
+import pytest
+
+import devices
+from devices import DeadbandFilter, MonitoringPlug, MultiPresenceDetector, TradfriBulbHandler, VINDSTYRKA
+
+KEY = (("zone", "home"), ("area", "kitchen"), ("thing", "fridge"))
+
+
+def test_record_is_returned_once_every_column_is_known():
+    plug = MonitoringPlug(KEY)
+    readings = {
+        "power": "1.5",
+        "current": "0.1",
+        "voltage": "230",
+        "apparent_power": "2",
+        "power_factor": "0.9",
+        "reactive_power": "0.5",
+        "energy": "10",
+    }
+
+    for name, value in readings.items():
+        assert plug.set(("sensor", name, "state"), value) is None
+
+    series_name, record = plug.set(("switch", "switch", "state"), "ON")
+
+    assert series_name == "electricity"
+    assert dict(record) == {**{k: float(v) for k, v in readings.items()}, "switch": True}
+
+
+def test_power_wobble_within_deadband_is_not_a_change():
+    plug = MonitoringPlug(KEY)
+    for key, _ in MonitoringPlug.sensors.items():
+        if key[1] != "uptime_sensor":
+            plug.set(key, "ON" if key[0] == "switch" else "100")
+
+    assert plug.set(("sensor", "power", "state"), "100.3") is None
+    assert plug.set(("sensor", "power", "state"), "101.5") is None
+    assert plug.set(("sensor", "power", "state"), "103") is not None
+
+
+def test_deadband_thresholds():
+    f = DeadbandFilter(absolute=1, relative=0.1)
+
+    assert f.changed(None, 5.0, None)
+    assert not f.changed(100.0, 101.0, 1)
+    assert not f.changed(100.0, 109.0, 1)
+    assert f.changed(100.0, 111.0, 1)
+    assert f.changed(5.0, 6.5, 1)
+
+
+def test_deadband_intervals():
+    f = DeadbandFilter(min_interval=10, max_interval=60)
+
+    assert not f.changed(1.0, 2.0, 5)
+    assert f.changed(1.0, 2.0, 15)
+    assert not f.changed(1.0, 1.0, 15)
+    assert f.changed(1.0, 1.0, 60)
+
+
+def test_unchanged_value_is_not_reported_again():
+    plug = MonitoringPlug(KEY)
+
+    assert plug.set(("sensor", "uptime_sensor", "state"), "10") == ("iot_device_uptime", [("uptime", 10)])
+    assert plug.set(("sensor", "uptime_sensor", "state"), "10") is None
+    assert plug.set(("sensor", "uptime_sensor", "state"), "11") == ("iot_device_uptime", [("uptime", 11)])
+
+
+def test_unknown_sensor_is_ignored():
+    assert MonitoringPlug(KEY).set(("sensor", "wifi_signal_db", "state"), "-60") is None
+
+
+def test_multi_presence_schema_includes_targets():
+    columns, _ = MultiPresenceDetector.schema.series["multi-presence"]
+
+    assert len(columns) == 4 + 15
+    assert "target_3_speed" in columns
+
+
+def test_devices_of_a_class_keep_separate_state():
+    kitchen = MonitoringPlug(KEY)
+    office = MonitoringPlug((("zone", "home"), ("area", "office"), ("thing", "desk")))
+
+    assert kitchen.set(("sensor", "uptime_sensor", "state"), "10") is not None
+    assert office.set(("sensor", "uptime_sensor", "state"), "10") is not None
+    assert kitchen.set(("sensor", "uptime_sensor", "state"), "10") is None
+
+
+def test_sensor_tables_are_read_only():
+    MultiPresenceDetector(KEY)
+
+    with pytest.raises(TypeError):
+        MultiPresenceDetector.sensors[("sensor", "extra", "state")] = None
+
+    assert len(MultiPresenceDetector.sensors) == 20
+
+
+def test_payload_is_decoded_into_the_declared_fields_only():
+    schema = devices.PayloadSchema(dict(TradfriBulbHandler.schema.fields))
+    payload = b'{"state": "ON", "brightness": 120, "color_mode": "color_temp", "update": {"state": "idle"}}'
+
+    assert schema.decode(payload) == {"on": True, "brightness": 120, "linkquality": None}
+    assert TradfriBulbHandler.schema.dtypes == {"on": pl.Boolean, "brightness": pl.Int64, "linkquality": pl.Int64}
+
+
+def test_payload_numbers_are_coerced_to_the_field_type():
+    schema = devices.PayloadSchema(dict(VINDSTYRKA.schema.fields))
+
+    decoded = schema.decode(b'{"humidity": 40, "temperature": "21.5", "pm25": 3, "voc_index": 90, "linkquality": 80}')
+
+    assert decoded == {"humidity": 40.0, "temperature": 21.5, "pm25": 3, "voc_index": 90, "linkquality": 80}
+    assert isinstance(decoded["humidity"], float)
+
+
+def test_payload_booleans_are_decoded_laxly():
+    schema = devices.PayloadSchema(dict(devices.ContactSensor.schema.fields))
+
+    decoded = schema.decode(b'{"contact": "true", "tamper": 0, "battery_low": false}')
+
+    assert (decoded["contact"], decoded["tamper"], decoded["battery_low"]) == (True, False, False)
+
+
+@pytest.mark.parametrize("payload", [b'{"humidity": "damp"}', b'{"pm25": 3.7}', b'[1, 2]', b'not json'])
+def test_undecodable_payload_raises_value_error(payload):
+    schema = devices.PayloadSchema(dict(VINDSTYRKA.schema.fields))
+
+    with pytest.raises(ValueError):
+        schema.decode(payload)
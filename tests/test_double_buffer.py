@@ -0,0 +1,27 @@
+import threading
+
+from double_buffer import DoubleBuffer
+
+
+def test_nothing_is_lost_or_duplicated_across_swaps():
+    buffer = DoubleBuffer(list)
+    done = threading.Event()
+    total = 200_000
+
+    def producer():
+        for i in range(total):
+            b = buffer.acquire()
+            b.append(i)
+            buffer.release()
+        done.set()
+
+    thread = threading.Thread(target=producer)
+    thread.start()
+
+    taken = []
+    while not done.is_set():
+        taken.extend(buffer.swap())
+    thread.join()
+    taken.extend(buffer.swap())
+
+    assert taken == list(range(total))
@@ -0,0 +1,22 @@
+from types import SimpleNamespace
+
+from prometheus_client import REGISTRY
+
+import metrics
+
+
+def test_instrument_callback_counts_by_prefix_and_times_the_callback():
+    calls = []
+
+    @metrics.instrument_callback("test_pipeline")
+    def on_message(client, userdata, msg):
+        calls.append(msg.topic)
+
+    on_message(None, None, SimpleNamespace(topic="zigbee2mqtt/kitchen/sensor"))
+    on_message(None, None, SimpleNamespace(topic="zigbee2mqtt/bridge/state"))
+    on_message(None, None, SimpleNamespace(topic="devices/home"))
+
+    assert calls == ["zigbee2mqtt/kitchen/sensor", "zigbee2mqtt/bridge/state", "devices/home"]
+    assert REGISTRY.get_sample_value("pipeline_messages_total", {"pipeline": "test_pipeline", "prefix": "zigbee2mqtt"}) == 2
+    assert REGISTRY.get_sample_value("pipeline_messages_total", {"pipeline": "test_pipeline", "prefix": "devices"}) == 1
+    assert REGISTRY.get_sample_value("pipeline_callback_seconds_count", {"pipeline": "test_pipeline"}) == 3
@@ -0,0 +1,123 @@
+import datetime
+import threading
+
+import argparse
+
+import polars as pl
+import pytest
+
+import raw_to_delta
+from raw_to_delta import RAW_SCHEMA, PayloadDeduplicator, RawBatchBuilder, RecordBuffer, share_group, shared
+
+
+def test_batch_builder_produces_fixed_schema():
+    batch = RawBatchBuilder()
+    batch.append("a/b", "1", False)
+    batch.append("a/c", "{}", True)
+
+    df = batch.to_frame()
+
+    assert df.schema == pl.Schema(RAW_SCHEMA)
+    assert df["topic"].to_list() == ["a/b", "a/c"]
+    assert df["retain"].to_list() == [False, True]
+    assert abs(df["arrival_timestamp"][0] - datetime.datetime.now()) < datetime.timedelta(seconds=5)
+
+
+def test_flush_requested_on_record_count():
+    buffer = RecordBuffer(max_records=2, max_batch_bytes=1000, max_buffered_bytes=10_000)
+
+    buffer.append("a", "1", False, 10)
+    assert not buffer.wait_for_flush(0)
+    buffer.append("a", "2", False, 10)
+    assert buffer.wait_for_flush(0)
+
+    batch, size = buffer.take()
+    assert batch.payloads == ["1", "2"]
+    assert size == 20
+    assert not buffer.wait_for_flush(0)
+
+
+def test_flush_requested_on_batch_bytes():
+    buffer = RecordBuffer(max_records=100, max_batch_bytes=50, max_buffered_bytes=10_000)
+
+    buffer.append("a", "1", False, 60)
+    assert buffer.wait_for_flush(0)
+
+
+def test_append_blocks_until_in_flight_batch_is_done():
+    buffer = RecordBuffer(max_records=100, max_batch_bytes=50, max_buffered_bytes=100)
+    buffer.append("a", "1", False, 100)
+    _, size = buffer.take()
+
+    appended = threading.Event()
+
+    def producer():
+        buffer.append("a", "2", False, 10)
+        appended.set()
+
+    thread = threading.Thread(target=producer)
+    thread.start()
+
+    assert not appended.wait(0.1)
+    buffer.done(size)
+    assert appended.wait(1)
+    thread.join()
+
+
+class RecordingSpool:
+    def __init__(self):
+        self.appended = []
+
+    def append(self, df, path, write_options=None):
+        self.appended.append((path, df, write_options))
+
+
+def test_flushed_rows_carry_the_writer_id(monkeypatch):
+    monkeypatch.setattr(raw_to_delta, "buffer", RecordBuffer())
+    raw_to_delta.buffer.append("a/b", "1", False, 10)
+    spool = RecordingSpool()
+
+    raw_to_delta.do_flush(spool, "replica-1")
+
+    [(path, df, write_options)] = spool.appended
+    assert path == "raw-mqtt"
+    assert df["writer_id"].to_list() == ["replica-1"]
+    # last_seen and count are only written with deduplication
+    assert df.schema == pl.Schema({c: t for c, t in raw_to_delta.RAW_MQTT.columns.items() if c not in ("last_seen", "count")})
+
+
+def test_shared_subscriptions():
+    assert shared("#", None) == "#"
+    assert shared("#", "archive") == "$share/archive/#"
+
+    with pytest.raises(argparse.ArgumentTypeError):
+        share_group("arch/ive")
+
+
+def test_repeated_payloads_are_collapsed_into_runs():
+    buffer = RecordBuffer(dedup=PayloadDeduplicator())
+    for topic, payload in [("a", "1"), ("a", "1"), ("b", "x"), ("a", "1"), ("a", "2"), ("a", "2")]:
+        buffer.append(topic, payload, False, 10)
+
+    batch, size = buffer.take()
+    df = batch.to_frame()
+
+    assert df.select("topic", "payload", "count").rows() == [("a", "1", 3), ("b", "x", 1), ("a", "2", 2)]
+    assert (df["last_seen"] >= df["arrival_timestamp"]).all()
+    assert size == 30
+
+    # runs are cut at a flush, so the next batch starts one of its own
+    buffer.append("a", "2", False, 10)
+    assert buffer.take()[0].to_frame().select("payload", "count").rows() == [("2", 1)]
+
+
+def test_deduplicator_forgets_the_least_recently_seen_topics():
+    dedup = PayloadDeduplicator(max_topics=2)
+
+    assert not dedup.repeated("a", "1")
+    assert not dedup.repeated("b", "1")
+    assert dedup.repeated("a", "1")
+    assert not dedup.repeated("c", "1")
+
+    assert len(dedup) == 2
+    assert not dedup.repeated("b", "1")
@@ -0,0 +1,133 @@
+import datetime
+
+import polars as pl
+
+from devices import MonitoringPlug, PresenceDetector
+from register import DeviceRegister, Series
+
+SOURCE = (("zone", "home"), ("area", "kitchen"), ("thing", "fridge"))
+
+
+def test_series_stores_rows_column_wise():
+    series = Series("electricity")
+    now = datetime.datetime(2025, 1, 1, 12)
+
+    series.append(now, SOURCE, [("power", 1.5), ("switch", True)])
+    series.append(now, SOURCE, [("power", 2.5), ("switch", False)])
+
+    df = series.take()
+
+    assert df.schema == pl.Schema({
+        "timestamp": pl.Datetime("us"),
+        "zone": pl.String,
+        "area": pl.String,
+        "thing": pl.String,
+        "power": pl.Float64,
+        "switch": pl.Boolean,
+    })
+    assert df["power"].to_list() == [1.5, 2.5]
+
+
+def test_series_pads_columns_first_seen_mid_batch():
+    series = Series("iot_device_uptime")
+    now = datetime.datetime(2025, 1, 1, 12)
+
+    series.append(now, SOURCE, [("uptime", 1)])
+    series.append(now, SOURCE, [("uptime", 2), ("extra", 3)])
+    series.append(now, SOURCE, [("uptime", 4)])
+
+    assert series.take()["extra"].to_list() == [None, 3, None]
+
+
+def test_series_upcasts_mixed_int_and_float_columns():
+    series = Series("iot_device_uptime")
+    now = datetime.datetime(2025, 1, 1, 12)
+
+    series.append(now, SOURCE, [("uptime", 60)])
+    series.append(now, SOURCE, [("uptime", 120.5)])
+
+    assert series.take()["uptime"].to_list() == [60.0, 120.5]
+
+
+def test_register_appends_to_an_empty_series():
+    register = DeviceRegister()
+    register.add_device_type("presence", PresenceDetector)
+    register.add_series(Series("iot_device_uptime"))
+
+    register.append_data("presence", SOURCE, ("sensor", "uptime_sensor", "state"), "60")
+
+    assert len(register.series["iot_device_uptime"]) == 1
+
+
+def test_registers_do_not_share_state():
+    first, second = DeviceRegister(), DeviceRegister()
+    first.add_device_type("plug", MonitoringPlug)
+
+    assert second.type_map == {}
+
+
+def test_series_throttles_per_source():
+    series = Series("presence", throttle=1)
+    now = datetime.datetime(2025, 1, 1, 12)
+
+    series.append(now, SOURCE, [("occupancy", True)])
+    series.append(now + datetime.timedelta(seconds=0.5), SOURCE, [("occupancy", False)])
+    series.append(now + datetime.timedelta(seconds=1), SOURCE, [("occupancy", False)])
+
+    assert series.take()["occupancy"].to_list() == [True, False]
+    assert len(series.take()) == 0
+
+
+def test_windowed_series_stores_one_aggregate_row_per_window():
+    series = Series("electricity", window=10)
+    start = datetime.datetime(2025, 1, 1, 12)
+
+    for offset, power, switch in [(0, 5.0, True), (3, 50.0, True), (9, 2.0, False), (10, 7.0, False)]:
+        series.append(start + datetime.timedelta(seconds=offset), SOURCE, [("power", power), ("switch", switch)])
+
+    assert len(series) == 1
+    series.close_windows()
+
+    df = series.take()
+    assert df["timestamp"].to_list() == [start, start + datetime.timedelta(seconds=10)]
+    assert df["power"].to_list() == [2.0, 7.0]
+    assert df["power_min"].to_list() == [2.0, 7.0]
+    assert df["power_max"].to_list() == [50.0, 7.0]
+    assert df["power_mean"].to_list() == [19.0, 7.0]
+    assert df["switch"].to_list() == [False, False]
+    assert df["samples"].to_list() == [3, 1]
+
+
+def test_windowed_series_closes_windows_as_later_records_arrive():
+    series = Series("multi-presence", window=1)
+    now = datetime.datetime.now()
+
+    series.append(now, SOURCE, [("occupancy", True)])
+    assert len(series.take()) == 0
+
+    series.append(now + datetime.timedelta(seconds=5), SOURCE, [("occupancy", False)])
+    assert len(series.take()) == 1
+
+    series.close_windows(now + datetime.timedelta(seconds=10))
+    assert series.take()["occupancy"].to_list() == [False]
+
+
+def test_register_declares_series_schemas_from_device_types():
+    register = DeviceRegister()
+    register.add_device_type("plug", MonitoringPlug)
+    register.add_device_type("presence", PresenceDetector)
+    uptime = Series("iot_device_uptime")
+    electricity = Series("electricity", window=10)
+    register.add_series(uptime)
+    register.add_series(electricity)
+
+    # plugs report uptime as an int, presence detectors as a float
+    assert uptime.schema.columns["uptime"] == pl.Float64
+    assert electricity.schema.columns["switch"] == pl.Boolean
+    assert electricity.schema.columns["power_mean"] == pl.Float64
+    assert "switch_mean" not in electricity.schema.columns
+    assert electricity.schema.columns["samples"] == pl.Int64
+
+    electricity.append(datetime.datetime(2025, 1, 1, 12), SOURCE, [("power", 1), ("switch", True)])
+    electricity.close_windows()
+    assert electricity.take().schema["power_min"] == pl.Float64
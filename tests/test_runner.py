@@ -0,0 +1,57 @@
+import paho.mqtt.client as mqtt
+
+from runner import Dispatcher, Pipeline
+
+
+def message(topic):
+    return mqtt.MQTTMessage(topic=topic.encode("utf-8"))
+
+
+def recording_pipeline(name, topics, seen, userdata=None):
+    def on_message(client, userdata, msg):
+        seen.append((name, userdata, msg.topic))
+
+    return Pipeline(name, topics, on_message, userdata=userdata)
+
+
+def test_messages_fan_out_to_every_matching_pipeline():
+    seen = []
+    dispatcher = Dispatcher()
+    dispatcher.add(recording_pipeline("raw", ["#"], seen, userdata="ignored"))
+    dispatcher.add(recording_pipeline("esphome", ["devices/#", "devices/+/kitchen/#"], seen))
+    dispatcher.add(recording_pipeline("zigbee", ["zigbee2mqtt/#"], seen))
+
+    dispatcher.on_message(None, None, message("devices/home/kitchen/plug/p/sensor/power/state"))
+    dispatcher.on_message(None, None, message("zigbee2mqtt/bridge/devices"))
+
+    assert seen == [
+        ("raw", "ignored", "devices/home/kitchen/plug/p/sensor/power/state"),
+        ("esphome", None, "devices/home/kitchen/plug/p/sensor/power/state"),
+        ("raw", "ignored", "zigbee2mqtt/bridge/devices"),
+        ("zigbee", None, "zigbee2mqtt/bridge/devices"),
+    ]
+
+
+def test_a_failing_pipeline_does_not_starve_the_others():
+    seen = []
+
+    def broken(client, userdata, msg):
+        raise RuntimeError("boom")
+
+    dispatcher = Dispatcher()
+    dispatcher.add(Pipeline("broken", ["#"], broken))
+    dispatcher.add(recording_pipeline("zigbee", ["zigbee2mqtt/#"], seen))
+
+    dispatcher.on_message(None, None, message("zigbee2mqtt/kitchen/zigbee/bulb"))
+
+    assert seen == [("zigbee", None, "zigbee2mqtt/kitchen/zigbee/bulb")]
+
+
+def test_subscriptions_leave_out_covered_filters():
+    dispatcher = Dispatcher()
+    dispatcher.add(Pipeline("esphome", ["devices/#"], None))
+    dispatcher.add(Pipeline("zigbee", ["zigbee2mqtt/#", "zigbee2mqtt/bridge/devices"], None))
+    assert dispatcher.subscriptions() == ["devices/#", "zigbee2mqtt/#"]
+
+    dispatcher.add(Pipeline("raw", ["#"], None))
+    assert dispatcher.subscriptions() == ["#"]
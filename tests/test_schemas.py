@@ -0,0 +1,44 @@
+import datetime
+
+import polars as pl
+import pytest
+from deltalake.exceptions import SchemaMismatchError
+
+import schemas
+from schemas import TableSchema
+
+
+def test_merge_adds_columns_and_widens_conflicting_types():
+    schema = TableSchema("t", {"a": pl.Int64, "b": pl.String}).merge({"a": pl.Float64, "c": pl.Boolean})
+
+    assert dict(schema.columns) == {"a": pl.Float64, "b": pl.String, "c": pl.Boolean}
+
+
+def test_frames_are_built_with_the_declared_types():
+    schema = TableSchema("t", {"timestamp": pl.Datetime("us"), "value": pl.Float64, "date": pl.Date})
+    now = datetime.datetime(2025, 1, 1, 12)
+
+    columns = schema.frame({"timestamp": [now], "value": [1], "extra": ["x"]})
+    rows = schema.frame([{"timestamp": now, "value": None, "ignored": 1}])
+
+    assert columns.schema == pl.Schema({"timestamp": pl.Datetime("us"), "value": pl.Float64, "extra": pl.String})
+    assert rows.schema == pl.Schema({"timestamp": pl.Datetime("us"), "value": pl.Float64})
+    assert schema.write_options == {"schema_mode": "merge", "partition_by": ["date"]}
+
+
+@pytest.mark.parametrize("value", [2.5, "x"])
+def test_values_that_do_not_fit_their_column_are_refused(value):
+    schema = TableSchema("t", {"value": pl.Int64})
+
+    with pytest.raises(SchemaMismatchError):
+        schema.frame({"value": [1, value]})
+    with pytest.raises(SchemaMismatchError):
+        schema.frame([{"value": 1}, {"value": value}])
+
+
+def test_registering_a_table_again_merges_its_columns():
+    schemas.register("test-registry", {"a": pl.Int64})
+    schema = schemas.register("test-registry", {"b": pl.String})
+
+    assert schemas.get("test-registry") is schema
+    assert list(schema.columns) == ["a", "b"]
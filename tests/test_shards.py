@@ -0,0 +1,73 @@
+import paho.mqtt.client as mqtt
+import polars as pl
+
+from shards import ShardPool
+from spool import Spool
+
+
+class RecordingClient:
+    def __init__(self):
+        self.appended = []
+
+    def append(self, df, path, write_options=None):
+        self.appended.append((path, df))
+
+
+def message(topic, payload):
+    msg = mqtt.MQTTMessage(topic=topic.encode("utf-8"))
+    msg.payload = payload.encode("utf-8")
+    return msg
+
+
+def test_a_device_always_lands_on_the_same_shard(tmp_path):
+    pool = ShardPool(4, str(tmp_path), 60)
+
+    shards = {pool.shard("devices/home/kitchen/presence/p1/" + s) for s in ["sensor/uptime_sensor/state", "binary_sensor/occupancy/state"]}
+    assert len(shards) == 1
+    assert pool.shard("devices/home") is None
+
+
+def test_workers_spool_what_they_were_sent(tmp_path):
+    pool = ShardPool(2, str(tmp_path), 60, batch_size=3)
+    pool.start()
+
+    for i in range(10):
+        pool.on_message(None, None, message("devices/home/area-%d/presence/p%d/binary_sensor/occupancy/state" % (i, i), "ON"))
+    pool.close(timeout=60)
+
+    dlc = RecordingClient()
+    assert Spool(str(tmp_path), dlc).drain()
+
+    df = pl.concat([df for path, df in dlc.appended if path == "presence"])
+    assert sorted(df["thing"].to_list()) == sorted("p%d" % i for i in range(10))
+    assert df["occupancy"].to_list() == [True] * 10
+
+
+def test_a_dead_worker_is_restarted_instead_of_blocking(tmp_path):
+    pool = ShardPool(1, str(tmp_path), 60, batch_size=1, max_queued=1, put_timeout=0.1)
+    pool.start()
+    pool._processes[0].kill()
+    pool._processes[0].join()
+
+    for i in range(10):
+        pool.on_message(None, None, message("devices/home/area-%d/presence/p%d/binary_sensor/occupancy/state" % (i, i), "ON"))
+    pool.close(timeout=60)
+
+    assert pool._processes[0].exitcode == 0
+
+    dlc = RecordingClient()
+    assert Spool(str(tmp_path), dlc).drain()
+    # at most the batch handed to the dead worker is lost
+    assert sum(len(df) for path, df in dlc.appended if path == "presence") >= 9
+
+
+def test_messages_a_worker_fails_on_are_counted(tmp_path):
+    pool = ShardPool(1, str(tmp_path), 60)
+    pool.start()
+    # a payload ingest can't decode
+    pool._put(0, [("devices/home/kitchen/presence/p1/binary_sensor/occupancy/state", None, 0.0)])
+    pool.on_message(None, None, message("devices/home/kitchen/presence/p1/binary_sensor/occupancy/state", "ON"))
+    pool.close(timeout=60)
+
+    assert pool.failures() == 1
+    assert pool._processes[0].exitcode == 0
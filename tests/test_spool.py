@@ -0,0 +1,86 @@
+import os
+import time
+
+import polars as pl
+from deltalake.exceptions import SchemaMismatchError
+
+from delta_client import DeltaLakeClient
+from spool import Spool
+
+
+class FlakyClient:
+    def __init__(self, failures):
+        self.failures = failures
+        self.appended = []
+
+    def append(self, df, path, write_options=None):
+        if self.failures:
+            error = self.failures.pop(0)
+            raise error
+        self.appended.append((path, len(df), write_options))
+
+
+def test_segments_stay_on_disk_until_upload_succeeds(tmp_path):
+    dlc = FlakyClient([OSError("s3 is down")])
+    spool = Spool(str(tmp_path), dlc)
+
+    spool.append(pl.DataFrame({"a": [1, 2]}), "t", {"partition_by": ["a"]})
+    spool.append(pl.DataFrame({"a": [3]}), "t", {"partition_by": ["a"]})
+
+    assert not spool.drain()
+    assert spool.pending() == {"t": 2}
+
+    assert spool.drain()
+    assert spool.pending() == {"t": 0}
+    assert dlc.appended == [("t", 3, {"partition_by": ["a"]})]
+
+
+def test_rejected_segment_is_set_aside(tmp_path):
+    dlc = FlakyClient([SchemaMismatchError("nope"), SchemaMismatchError("nope")])
+    spool = Spool(str(tmp_path), dlc)
+
+    spool.append(pl.DataFrame({"a": [1]}), "t")
+    spool.append(pl.DataFrame({"a": [2]}), "t")
+
+    assert spool.drain()
+    assert spool.pending() == {"t": 0}
+    assert dlc.appended == [("t", 1, {})]
+    assert len([n for n in os.listdir(tmp_path / "t") if n.endswith(".rejected")]) == 1
+
+
+def test_spooled_segments_reach_the_delta_table(tmp_path):
+    dlc = DeltaLakeClient(str(tmp_path / "delta") + "/", {})
+    spool = Spool(str(tmp_path / "spool"), dlc)
+
+    spool.append(pl.DataFrame({"a": [1, 2]}), "t")
+    spool.append(pl.DataFrame({"a": [3]}), "t")
+    spool.drain()
+
+    assert sorted(dlc.get("t")["a"].to_list()) == [1, 2, 3]
+
+
+class SlowClient:
+    def __init__(self, failing=()):
+        self.failing = failing
+        self.appended = []
+
+    def append(self, df, path, write_options=None):
+        time.sleep(0.2)
+        if path in self.failing:
+            raise OSError("can't write %s" % path)
+        self.appended.append(path)
+
+
+def test_tables_upload_in_parallel_and_fail_independently(tmp_path):
+    dlc = SlowClient(failing={"b"})
+    spool = Spool(str(tmp_path), dlc)
+
+    for table in ["a", "b", "c"]:
+        spool.append(pl.DataFrame({"x": [1]}), table)
+
+    started = time.monotonic()
+    assert not spool.drain()
+
+    assert time.monotonic() - started < 0.5
+    assert sorted(dlc.appended) == ["a", "c"]
+    assert spool.pending() == {"a": 0, "b": 1, "c": 0}
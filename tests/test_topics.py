@@ -0,0 +1,61 @@
+import paho.mqtt.client as mqtt
+import pytest
+
+from topics import TopicTrie, covers
+
+FILTERS = [
+    "#", "+", "a", "a/#", "a/+", "a/b", "a/+/c", "+/b/#", "a/b/c/#", "+/+", "$SYS/#", "b/#",
+]
+TOPICS = [
+    "a", "b", "a/b", "a/c", "a/b/c", "a/b/c/d", "x/b", "x/b/y", "$SYS/broker", "$SYS", "a//c",
+]
+
+
+@pytest.mark.parametrize("topic", TOPICS)
+def test_matches_agree_with_paho(topic):
+    trie = TopicTrie()
+    for topic_filter in FILTERS:
+        trie.add(topic_filter, topic_filter)
+
+    expected = tuple(f for f in FILTERS if mqtt.topic_matches_sub(f, topic))
+    assert trie.match(topic) == expected
+
+
+def test_first_match_follows_insertion_order():
+    trie = TopicTrie()
+    trie.add("zigbee2mqtt/bridge/devices", "devices")
+    trie.add("zigbee2mqtt/bridge/#", "bridge")
+    trie.add("zigbee2mqtt/#", "device")
+
+    assert trie.first("zigbee2mqtt/bridge/devices") == "devices"
+    assert trie.first("zigbee2mqtt/bridge/state") == "bridge"
+    assert trie.first("zigbee2mqtt/kitchen/sensor") == "device"
+    assert trie.first("devices/home", "none") == "none"
+
+
+def test_adding_a_filter_invalidates_cached_results():
+    trie = TopicTrie()
+    trie.add("a/b")
+    assert trie.match("a/c") == ()
+
+    trie.add("a/+")
+    assert trie.match("a/c") == (True,)
+
+
+@pytest.mark.parametrize("topic_filter", ["a/#/b", "a/b#", "a+/b"])
+def test_invalid_filters_are_rejected(topic_filter):
+    with pytest.raises(ValueError):
+        TopicTrie().add(topic_filter)
+
+
+@pytest.mark.parametrize("general", FILTERS)
+def test_covered_filters_match_no_topic_the_covering_one_misses(general):
+    for specific in FILTERS:
+        if covers(general, specific):
+            for topic in TOPICS:
+                assert not mqtt.topic_matches_sub(specific, topic) or mqtt.topic_matches_sub(general, topic)
+
+    assert covers("#", "zigbee2mqtt/#")
+    assert covers("a/+", "a/b")
+    assert not covers("a/+", "a/#")
+    assert not covers("#", "$SYS/#")
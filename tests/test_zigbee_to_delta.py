@@ -0,0 +1,185 @@
+import datetime
+import threading
+import time
+
+import polars as pl
+
+from delta_client import DeltaLakeClient
+from devices import ThermometerAndHygrometer, TradfriBulbHandler
+from spool import Spool
+from zigbee_to_delta import ZigbeeDeviceRegister, periodic_batch_writer
+
+
+class RecordingSpool:
+    def __init__(self):
+        self.appended = []
+
+    def append(self, df, path, write_options=None):
+        self.appended.append((path, df))
+
+
+def _register():
+    register = ZigbeeDeviceRegister()
+    register.add_handler(TradfriBulbHandler())
+    register.add_handler(ThermometerAndHygrometer())
+    register.set_spool(RecordingSpool())
+    register.try_registering_device({
+        "friendly_name": "kitchen/zigbee/ceiling",
+        "model_id": "TRADFRI bulb GU10 WW 345lm",
+        "ieee_address": "0x01",
+    })
+    return register
+
+
+def test_flushed_frames_have_the_declared_schema():
+    register = _register()
+
+    register.append("kitchen/zigbee/ceiling", b'{"state": "OFF", "brightness": 3, "linkquality": 90, "color_mode": "xy"}')
+    register.append("kitchen/zigbee/ceiling", b'{"state": "ON"}')
+    register.write_all_and_clear("")
+
+    [(path, df)] = register.spool.appended
+    assert path == "smart-bulbs"
+    assert df.schema == pl.Schema({
+        "zone": pl.String,
+        "area": pl.String,
+        "thing": pl.String,
+        "address": pl.String,
+        "timestamp": pl.Datetime("us"),
+        "on": pl.Boolean,
+        "brightness": pl.Int64,
+        "linkquality": pl.Int64,
+        "date": pl.Date,
+    })
+    assert df["on"].to_list() == [False, True]
+    assert df["brightness"].to_list() == [3, None]
+
+
+def test_records_that_do_not_fit_the_schema_are_dropped_not_retried():
+    register = _register()
+    register.append("kitchen/zigbee/ceiling", b'{"state": "ON", "brightness": 3}')
+    register.timeseries.peek()["smart-bulbs"][0]["brightness"] = 2.5
+
+    register.write_all_and_clear("")
+    register.write_all_and_clear("")
+
+    assert register.spool.appended == []
+    assert register.buffered_records("smart-bulbs") == 0
+
+
+class SlowSpool(RecordingSpool):
+    def append(self, df, path, write_options=None):
+        time.sleep(0.1)
+        super().append(df, path, write_options)
+
+
+def test_overlapping_flushes_spool_each_record_once():
+    register = _register()
+    register.set_spool(SlowSpool())
+    register.append("kitchen/zigbee/ceiling", b'{"state": "ON"}')
+
+    periodic = threading.Thread(target=register.write_all_and_clear, args=("",))
+    periodic.start()
+    time.sleep(0.05)
+    # the shutdown flush while the periodic one is still spooling
+    register.write_all_and_clear("")
+    periodic.join()
+
+    assert sum(len(df) for _, df in register.spool.appended) == 1
+
+
+def test_periodic_writer_returns_once_stopped():
+    register = _register()
+    stopping = threading.Event()
+    periodic = threading.Thread(target=periodic_batch_writer, args=(register, "", 60, stopping))
+    periodic.start()
+
+    stopping.set()
+    periodic.join(1)
+    assert not periodic.is_alive()
+
+
+def _bridge_devices(*names):
+    return [
+        {"type": "EndDevice", "ieee_address": "0x%02x" % i, "friendly_name": name, "model_id": "TS0201", "manufacturer": "m"}
+        for i, name in enumerate(names)
+    ]
+
+
+def test_device_mappings_are_only_appended_when_they_change(tmp_path):
+    dlc = DeltaLakeClient(str(tmp_path) + "/", {})
+    spool = Spool(str(tmp_path / "spool"), dlc)
+    register = _register()
+    register.set_deltalakeclient(dlc)
+    register.set_spool(spool)
+
+    register.register_devices(_bridge_devices("kitchen/zigbee/a", "hall/zigbee/b"))
+    assert spool.drain()
+    register.register_devices(_bridge_devices("kitchen/zigbee/a", "hall/zigbee/b"))
+    register.register_devices(_bridge_devices("kitchen/zigbee/a", "office/zigbee/b"))
+    assert spool.drain()
+
+    assert dlc.table("zigbee-devices").version() == 1
+    rows = pl.read_delta(dlc.uri("zigbee-devices")).sort("timestamp", "friendly_name")
+    assert rows["friendly_name"].to_list() == ["hall/zigbee/b", "kitchen/zigbee/a", "office/zigbee/b"]
+    assert "hall/zigbee/b" not in register.device_mappings
+
+    # after a restart the latest mappings are read back once
+    restarted = _register()
+    restarted.set_deltalakeclient(DeltaLakeClient(str(tmp_path) + "/", {}))
+    restarted.load_persisted_mappings()
+    restarted.register_devices(_bridge_devices("kitchen/zigbee/a", "office/zigbee/b"))
+
+    assert restarted.persisted_mappings == {"0x00": "kitchen/zigbee/a", "0x01": "office/zigbee/b"}
+    assert restarted.spool.appended == []
+
+
+class UnreachableClient:
+    def __init__(self, dlc, failures):
+        self.dlc = dlc
+        self.failures = failures
+
+    def table(self, path):
+        if self.failures:
+            self.failures -= 1
+            raise OSError("s3 is down")
+        return self.dlc.table(path)
+
+
+def test_device_mappings_are_loaded_again_after_a_failed_read(tmp_path):
+    dlc = DeltaLakeClient(str(tmp_path) + "/", {})
+    dlc.append(pl.DataFrame({
+        "timestamp": [datetime.datetime(2025, 1, 1)],
+        "address": ["0x00"],
+        "manufacturer": ["m"],
+        "model": ["TS0201"],
+        "friendly_name": ["kitchen/zigbee/a"],
+    }), "zigbee-devices")
+    register = _register()
+    register.set_deltalakeclient(UnreachableClient(dlc, failures=2))
+
+    register.load_persisted_mappings()
+    register.register_devices(_bridge_devices("kitchen/zigbee/a", "hall/zigbee/b"))
+
+    assert register.persisted_mappings is None
+    assert register.spool.appended == []
+
+    register.register_devices(_bridge_devices("kitchen/zigbee/a", "hall/zigbee/b"))
+
+    [(path, df)] = register.spool.appended
+    assert path == "zigbee-devices"
+    assert df["friendly_name"].to_list() == ["hall/zigbee/b"]
+
+
+def test_identity_is_built_once_at_registration():
+    register = _register()
+    register.try_registering_device({"friendly_name": "hall/ceiling", "model_id": "TS0201", "ieee_address": "0x02"})
+
+    mapping = register.device_mappings["kitchen/zigbee/ceiling"]
+    assert register.handlers_by_model["TS0201"] is register.handlers["ThermometerAndHygrometer"]
+    assert dict(mapping["identity"]) == {"zone": "home", "area": "kitchen", "thing": "ceiling", "address": "0x01"}
+
+    # a friendly name that doesn't fit area/zigbee/thing is registered but never appended
+    assert register.device_mappings["hall/ceiling"]["identity"] is None
+    register.append("hall/ceiling", b'{"temperature": 20}')
+    assert register.buffered_records("temperature-and-humidity") == 0